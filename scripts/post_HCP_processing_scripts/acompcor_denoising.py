@@ -0,0 +1,279 @@
+# C. Cocuzza, 2023. aCompCor (+ optional motion and spike regressors) nuisance regression; an alternative to ICA-FIX.
+# Requires create_masks_HCP.py (or create_masks_HCP.sh) to have been run on the same data; see post_hcp_main.sh
+
+# NOTES:
+# (1) aCompCor (Behzadi et al., 2007; Muschelli et al., 2014): the top principal components of white matter (WM) and
+#     ventricle (CSF) voxel timeseries are used as nuisance regressors. Masks: <subj>_<run>_wmMask_func_eroded.nii.gz and
+#     <subj>_<run>_ventricles_func_eroded.nii.gz (i.e., with the dilated gray matter mask subtracted).
+# (2) WM, CSF, and brain mask voxel timeseries are extracted together in 1 pass over the 4D volume, in TR chunks (only
+#     the voxels in these masks are kept in memory), and the top components come from a randomized truncated SVD
+#     (Halko et al., 2011) rather than a full decomposition.
+# (3) All regressors (aCompCor, optional motion, optional spike regressors as in QC_FD/GetSpikeRegressors.m) are
+#     combined into 1 design matrix, factorized once (regression.regression_factorize), and that same factorization is
+#     applied to the brain mask voxels (in voxel chunks) and to the surface (dense) data of the run. The denoised
+#     volume is written in TR chunks (nifti_reader.write_trs); voxels outside the brain mask are copied from a 2nd
+#     read of the input (from the gzip index built by the 1st pass, or from the uncompressed cache if <cacheDir>).
+# (4) This follows the recommendations in Ciric et al., 2017 (aCompCor + motion); see references in gsr_from_surface.py.
+
+# Behzadi, Y., Restom, K., Liau, J., & Liu, T. T. (2007). A component based noise correction method (CompCor) for BOLD and perfusion based fMRI. NeuroImage, 37(1), 90–101. https://doi.org/10.1016/j.neuroimage.2007.04.042
+
+# Muschelli, J., Nebel, M. B., Caffo, B. S., Barber, A. D., Pekar, J. J., & Mostofsky, S. H. (2014). Reduction of motion-related artifacts in resting state fMRI using aCompCor. NeuroImage, 96, 22–35. https://doi.org/10.1016/j.neuroimage.2014.03.028
+
+# Halko, N., Martinsson, P. G., & Tropp, J. A. (2011). Finding structure with randomness: Probabilistic algorithms for constructing approximate matrix decompositions. SIAM Review, 53(2), 217–288. https://doi.org/10.1137/090771806
+
+################################################
+# IMPORTS
+import numpy as np
+import nibabel as nib
+from scipy import signal
+
+import regression # see regression.py
+import cifti_utils # see cifti_utils.py
+import precision_utils # see precision_utils.py
+import censoring_utils # see censoring_utils.py
+import nifti_reader # see nifti_reader.py
+
+################################################
+# Timeseries extraction (TR chunks)
+def extract_masked_timeseries(timeSeriesVolumeFile,maskFile,chunkSize=100,precision='float64',cacheDir=None,makeCache=False):
+    '''
+    Returns voxels x TRs timeseries of the voxels in <maskFile> (a file name, or a boolean X x Y x Z array; voxels in
+    C order, as boolean indexing), reading the 4D volume <chunkSize> TRs at a time
+    (so only the masked voxels are ever held in memory for the whole run). Reads go through nifti_reader.py (indexed,
+    parallel gzip decompression; uses an uncompressed cache in <cacheDir> if one exists, or makes it if <makeCache>).
+    '''
+    if isinstance(maskFile,str):
+        maskHere = np.asarray(nib.load(maskFile).dataobj)>0
+    else:
+        maskHere = np.asarray(maskFile,dtype=bool)
+    funcReader = nifti_reader.NiftiReader(timeSeriesVolumeFile,cacheDir=cacheDir,makeCache=makeCache)
+    numTRs = funcReader.shape[3]
+    dtypeHere = precision_utils.get_dtype(precision)
+
+    maskedTS = np.zeros((int(np.sum(maskHere)),numTRs),dtype=dtypeHere)
+    for startIx,dataChunk in funcReader.iter_trs(chunkSize=chunkSize,dtype=dtypeHere):
+        maskedTS[:,startIx:startIx+dataChunk.shape[3]] = dataChunk[maskHere]
+    return maskedTS
+
+################################################
+# Randomized truncated SVD
+def randomized_svd(dataHere,numComponents,numOversamples=10,numPowerIters=2,seed=0):
+    '''
+    Top <numComponents> singular vectors/values of <dataHere> (observations x features, e.g., TRs x voxels) via a
+    randomized range finder with power iterations (Halko et al., 2011). Cost is O(TRs x voxels x (k + oversamples)),
+    versus a full SVD of the TRs x voxels matrix.
+
+    OUTPUT:
+        U (TRs x numComponents), S (numComponents), Vt (numComponents x voxels)
+    '''
+    rng = np.random.default_rng(seed)
+    numRows,numCols = dataHere.shape
+    numSamples = min(numComponents + numOversamples,numRows,numCols)
+
+    Q,_ = np.linalg.qr(np.matmul(dataHere,rng.standard_normal((numCols,numSamples)).astype(dataHere.dtype)))
+    for iterIx in range(numPowerIters):
+        Q,_ = np.linalg.qr(np.matmul(dataHere.T,Q))
+        Q,_ = np.linalg.qr(np.matmul(dataHere,Q))
+
+    Uhat,S,Vt = np.linalg.svd(np.matmul(Q.T,dataHere),full_matrices=False)
+    U = np.matmul(Q,Uhat)
+    return U[:,:numComponents],S[:numComponents],Vt[:numComponents,:]
+
+def compcor_components(maskedTS,numComponents=5,seed=0):
+    '''
+    aCompCor components from voxels x TRs timeseries: each voxel is detrended (constant + linear) and variance normalized,
+    then the top <numComponents> temporal components (TRs x numComponents) are returned with their explained variance ratio.
+    '''
+    dataHere = signal.detrend(maskedTS,axis=1,type='linear')
+    with np.errstate(divide='ignore',invalid='ignore'):
+        dataHere = precision_utils.variance_normalize(dataHere,axis=1)
+    dataHere = dataHere[~np.any(np.isnan(dataHere),axis=1)] # drop constant (e.g., 0) voxels
+
+    U,S,Vt = randomized_svd(dataHere.T,numComponents,seed=seed)
+    varianceExplained = S**2 / np.sum(np.square(dataHere,dtype=np.float64))
+    return U,varianceExplained
+
+################################################
+# Motion regressors (spike regressors: see censoring_utils.py)
+def load_motion_regressors(movementFile,motionModel='12'):
+    '''
+    HCP Movement_Regressors.txt (12 columns: 6 realignment parameters + their derivatives).
+    motionModel: '6' (parameters), '12' (+ derivatives), or '24' (12 + squares of those 12).
+    '''
+    motionHere = np.loadtxt(movementFile)
+    if motionModel=='6':
+        return motionHere[:,:6]
+    elif motionModel=='12':
+        return motionHere[:,:12]
+    elif motionModel=='24':
+        return np.hstack((motionHere[:,:12],motionHere[:,:12]**2))
+    print(f"WARNING: motionModel {motionModel} not recognized (options: '6', '12', '24'); using '12'.")
+    return motionHere[:,:12]
+
+################################################
+# Inputs (separate so run_scheduler.py can load the next run while the current run is denoised)
+def load_acompcor_inputs(wmMaskFile,csfMaskFile,timeSeriesVolumeFile,brainMaskFile=None,chunkSize=100,precision='float64',cacheDir=None):
+    '''Returns (WM mask, CSF mask, brain mask, union of the 3 masks, voxels x TRs timeseries of that union); see acompcor_denoising for inputs.'''
+    wmMask = np.asarray(nib.load(wmMaskFile).dataobj)>0
+    csfMask = np.asarray(nib.load(csfMaskFile).dataobj)>0
+    if brainMaskFile is not None:
+        brainMask = np.asarray(nib.load(brainMaskFile).dataobj)>0
+    else:
+        brainMask = np.ones(wmMask.shape,dtype=bool)
+    allMask = brainMask | wmMask | csfMask
+    maskedTS = extract_masked_timeseries(timeSeriesVolumeFile,allMask,chunkSize=chunkSize,precision=precision,
+                                         cacheDir=cacheDir,makeCache=cacheDir is not None)
+    return wmMask,csfMask,brainMask,allMask,maskedTS
+
+################################################
+# Main function
+def acompcor_denoising(subjID,
+                       functionalRunStr,
+                       wmMaskFile,
+                       csfMaskFile,
+                       timeSeriesVolumeFile,
+                       outputSavePath,
+                       timeSeriesSurfaceFile=None,
+                       brainMaskFile=None,
+                       movementFile=None,
+                       motionModel='12',
+                       useSpikeRegressors=False,
+                       fdFile=None,
+                       fdThreshold=0.25,
+                       numComponents=5,
+                       extraSaveStr='',
+                       chunkSize=100,
+                       precision='float64',
+                       cacheDir=None,
+                       loadedInputs=None,
+                       verbose=True):
+    '''
+    INPUTS:
+        subjID                : A string. The participant ID used throughout project's directories.
+        functionalRunStr      : A string. The functional run being processed. Should match project's directories.
+        wmMaskFile            : A string. Full path to the eroded white matter mask (functional space); e.g.,
+                                <subj>_<run>_wmMask_func_eroded.nii.gz from create_masks_HCP.py.
+        csfMaskFile           : A string. Full path to the eroded ventricle mask (functional space); e.g.,
+                                <subj>_<run>_ventricles_func_eroded.nii.gz.
+        timeSeriesVolumeFile  : A string. Full path to the 4D volumetric timeseries (x/y/z must match the masks).
+        outputSavePath        : A string. The full path (directory) for saving results to.
+        timeSeriesSurfaceFile : Optional. A string. Full path to the matching .dtseries.nii; if given, the same
+                                regression is applied to it.
+        brainMaskFile         : Optional. A string. Volume voxels outside this mask are left unchanged (saves time and
+                                memory); e.g., <subj>_<run>_wholebrainmask_func_dil1vox.nii.gz. Default: all voxels.
+        movementFile          : Optional. A string. HCP Movement_Regressors.txt; if given, motion regressors are included.
+        motionModel           : Optional. '6', '12' (default), or '24'; see load_motion_regressors.
+        useSpikeRegressors    : Optional. Boolean. If True, spike regressors (FD > fdThreshold) are included.
+        fdFile                : Optional. A string. Text file with 1 FD value per TR (e.g., Jenkinson FD from
+                                QC_FD/FD_estimation_thresholding.m). Default: Power FD computed from movementFile.
+        fdThreshold           : Optional. FD threshold for spike regressors; default 0.25 (as GetSpikeRegressors.m).
+        numComponents         : Optional. Number of aCompCor components per mask (WM, CSF); default 5.
+        extraSaveStr          : Optional. A string. Added string with info to append to saved results.
+        chunkSize             : Optional. Number of TRs read at once (extraction) and written at once (cifti output);
+                                also sets the number of voxels regressed at once (x 1000).
+        precision             : Optional. 'float64' (default) or 'float32'; see precision_utils.py (post_hcp_main.sh:
+                                --computePrecision).
+        cacheDir              : Optional. A string. Directory for an uncompressed copy of <timeSeriesVolumeFile> (made
+                                once, then re-used by later calls; see nifti_reader.py). Default: none (the .nii.gz is
+                                decompressed in this call).
+        loadedInputs          : Optional. Output of load_acompcor_inputs for this run (e.g., prefetched by run_scheduler.py
+                                while the previous run was being denoised). If None (default), inputs are loaded here.
+        verbose               : Optional. Boolean. Whether or not to print some extra info; useful for debugging.
+
+    OUTPUT:
+        - saves all regressors as: /<outputSavePath>/<functionalRunStr><extraSaveStr>_aCompCor_Regressors.txt (TRs x regressors)
+        - saves denoised volume as: /<outputSavePath>/<functionalRunStr><extraSaveStr>_aCompCor.nii.gz
+        - if timeSeriesSurfaceFile is given: /<outputSavePath>/<functionalRunStr><extraSaveStr>_aCompCor.dtseries.nii
+    '''
+    dtypeHere = precision_utils.get_dtype(precision)
+
+    #############################################
+    # WM, CSF, and brain mask voxels: 1 pass over the 4D volume
+    if loadedInputs is None:
+        loadedInputs = load_acompcor_inputs(wmMaskFile,csfMaskFile,timeSeriesVolumeFile,brainMaskFile=brainMaskFile,
+                                            chunkSize=chunkSize,precision=precision,cacheDir=cacheDir)
+    wmMask,csfMask,brainMask,allMask,maskedTS = loadedInputs
+    del loadedInputs
+
+    #############################################
+    # aCompCor components (WM and CSF separately)
+    regressorList = []
+    for maskLabel,maskHere in [('WM',wmMask),('CSF',csfMask)]:
+        components,varianceExplained = compcor_components(maskedTS[maskHere[allMask],:],numComponents=numComponents)
+        regressorList.append(components)
+        if verbose:
+            print(f"{maskLabel} aCompCor ({functionalRunStr}): {np.sum(maskHere)} voxels, top {numComponents} components explain {100*np.sum(varianceExplained):.1f}% of variance")
+
+    #############################################
+    # Motion and spike regressors
+    if movementFile is not None:
+        regressorList.append(load_motion_regressors(movementFile,motionModel=motionModel))
+    if useSpikeRegressors:
+        if fdFile is not None:
+            fdHere = np.loadtxt(fdFile)
+        elif movementFile is not None:
+            fdHere = censoring_utils.framewise_displacement(movementFile)
+        else:
+            print(f"WARNING: useSpikeRegressors=True requires fdFile or movementFile; skipping spike regressors.")
+            fdHere = None
+        if fdHere is not None:
+            spikeRegressors = censoring_utils.get_spike_regressors(fdHere,fdThreshold=fdThreshold)
+            regressorList.append(spikeRegressors)
+            if verbose:
+                print(f"Spike regressors ({functionalRunStr}): {spikeRegressors.shape[1]} TRs with FD > {fdThreshold}")
+
+    allRegressors = np.hstack(regressorList)
+    numTRs = allRegressors.shape[0]
+    if allRegressors.shape[1] + 1 >= numTRs: # + 1: constant
+        print(f"ERROR: {allRegressors.shape[1]} nuisance regressors (+ constant) for {numTRs} TRs in {functionalRunStr}; the "
+              f"regression would leave no degrees of freedom. Use fewer components, a smaller motionModel, or a higher "
+              f"fdThreshold; {functionalRunStr} not denoised.")
+        return None
+    np.savetxt(outputSavePath + '/' + functionalRunStr + extraSaveStr + '_aCompCor_Regressors.txt',allRegressors)
+    if verbose:
+        print(f"Regressing {allRegressors.shape[1]} nuisance regressors from {functionalRunStr}...")
+
+    #############################################
+    # 1 shared factorization for volume and surface data
+    factorization = regression.regression_factorize(allRegressors,constant=True,precision=precision)
+
+    #############################################
+    # Volume: brain mask voxels in voxel chunks (original mean is added back, as in fsl_regfilt)
+    brainIxs = np.flatnonzero(brainMask[allMask])
+    voxelChunk = chunkSize*1000
+    for startIx in range(0,brainIxs.shape[0],voxelChunk):
+        ixsHere = brainIxs[startIx:startIx+voxelChunk]
+        dataHere = maskedTS[ixsHere,:]
+        betas,resid = regression.regression(dataHere.T,None,factorization=factorization)
+        maskedTS[ixsHere,:] = resid.T + np.mean(dataHere,axis=1,dtype=np.float64,keepdims=True).astype(dtypeHere)
+
+    # Written in TR chunks: denoised brain mask voxels, and (unchanged) input values elsewhere (read again only if
+    # there are voxels outside all masks)
+    funcReader = nifti_reader.NiftiReader(timeSeriesVolumeFile,cacheDir=cacheDir)
+    numTRs = funcReader.shape[3]
+    def denoised_chunks():
+        for startIx in range(0,numTRs,chunkSize):
+            stopIx = min(startIx+chunkSize,numTRs)
+            if np.all(allMask):
+                dataChunk = np.empty(tuple(funcReader.shape[:3])+(stopIx-startIx,),dtype=dtypeHere,order='F')
+            else:
+                dataChunk = funcReader.read_trs(startIx,stopIx,dtype=dtypeHere)
+            dataChunk[allMask] = maskedTS[:,startIx:stopIx]
+            yield dataChunk
+    saveFileHere = outputSavePath + '/' + functionalRunStr + extraSaveStr + '_aCompCor.nii.gz'
+    # Saved in the input's data type (e.g., float32 for HCP outputs), as nib.save with the input header would
+    saveDtype = funcReader.header.get_data_dtype() if np.issubdtype(funcReader.header.get_data_dtype(),np.floating) else dtypeHere
+    nifti_reader.write_trs(saveFileHere,denoised_chunks(),funcReader.header,dtype=saveDtype)
+    del maskedTS
+
+    #############################################
+    # Surface (dense): same factorization
+    if timeSeriesSurfaceFile is not None:
+        # NOTE: assumes HCP dtseries convention of TRs x grayordinates
+        funcData = nib.load(timeSeriesSurfaceFile).get_fdata(dtype=dtypeHere)
+        betas,resid = regression.regression(funcData,None,factorization=factorization)
+        resid += np.mean(funcData,axis=0,dtype=np.float64).astype(resid.dtype)
+        del funcData
+
+        saveFileHere_Surf = outputSavePath + '/' + functionalRunStr + extraSaveStr + '_aCompCor.dtseries.nii'
+        cifti_utils.write_dtseries(resid.T,timeSeriesSurfaceFile,saveFileHere_Surf,chunkSize=chunkSize,verbose=verbose)
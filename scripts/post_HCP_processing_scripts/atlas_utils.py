@@ -0,0 +1,231 @@
+# C. Cocuzza, 2023. Loading and re-ordering utilities for the whole-brain atlas files (see ../atlas_files/).
+
+# atlas_files/ ships node order, region labels, network labels, network boundaries, and network RGB colors as
+# separate .npy files, for 2 cerebellum conventions:
+#   'Cerebellum_Seperate'      : 434 regions; left/right cerebellum are their own networks (22 networks)
+#   'Cerebellum_Cortical_Nets' : 465 regions; cerebellar regions are assigned to cortical networks (20 networks)
+# Everything here is loaded once per atlas variant (on first use) and cached, along with derived indices: the
+# re-ordering permutation and its inverse, flat indices to re-order whole FC stacks with a single np.take, and
+# network block slices (from the precomputed boundaries) for block summaries.
+
+# NOTE: "ordered" = network order, i.e., nodes re-ordered so each network is a contiguous block (for plotting, etc.).
+# "unordered" = the original parcellation order (i.e., the order of rows in parcellated timeseries and FC estimates).
+
+################################################
+# IMPORTS
+import os
+import numpy as np
+
+################################################
+# Atlas variants and default directory
+atlasVariants = ['Cerebellum_Seperate','Cerebellum_Cortical_Nets']
+
+# NOTE: in this repository atlas_files/ sits next to post_HCP_processing_scripts/; on the cluster it is inside ${baseDir_Scripts}
+scriptsDir = os.path.dirname(os.path.abspath(__file__))
+atlasDir_Default = os.path.join(scriptsDir,'atlas_files')
+if not os.path.isdir(atlasDir_Default):
+    atlasDir_Default = os.path.join(scriptsDir,'..','atlas_files')
+
+_atlasCache = {}
+_flatOrderCache = {}
+
+################################################
+# Load (and cache) all atlas info for a given variant
+def load_atlas(atlasVariant='Cerebellum_Seperate',atlasDir=atlasDir_Default):
+    '''
+    INPUTS:
+        atlasVariant : Optional. A string; either 'Cerebellum_Seperate' (default) or 'Cerebellum_Cortical_Nets'.
+        atlasDir     : Optional. A string; full path to the atlas_files directory.
+
+    OUTPUT:
+        atlasInfo    : A dictionary (cached; do not modify in place) with:
+                       'numNodes', 'numNetworks'
+                       'nodeOrder'              : permutation; unordered --> ordered (ordered = unordered[nodeOrder])
+                       'nodeOrder_Inverse'      : permutation; ordered --> unordered
+                       'networkNames'           : networks, in order
+                       'networkColors'          : networks x 3 (RGB, 0-1)
+                       'blockStarts', 'blockStops', 'blockSizes' : network boundaries (ordered space), integers
+                       'blockSlices'            : list of slice objects, 1 per network (ordered space)
+                       'networkIxs'             : network index of each node (ordered space)
+                       'networkIxs_Unordered'   : network index of each node (unordered space)
+                       'networkLabels'          : network label of each node (ordered space)
+                       'networkLabels_Unordered': network label of each node (unordered space)
+                       'regionLabels', 'regionLabels_Unordered', 'regionLabels_Abbreviated' : region names
+                                                  (ordered / unordered / abbreviated-ordered); None if not shipped for this variant
+    '''
+    cacheKey = (atlasVariant,os.path.abspath(atlasDir))
+    if cacheKey in _atlasCache:
+        return _atlasCache[cacheKey]
+
+    if atlasVariant not in atlasVariants:
+        print(f"ERROR: atlas variant {atlasVariant} not recognized, please use one of: {atlasVariants}.")
+        return None
+
+    def load_file(fileStr):
+        fileHere = os.path.join(atlasDir,'whole_brain_' + fileStr + '_' + atlasVariant + '.npy')
+        if not os.path.isfile(fileHere):
+            return None
+        return np.load(fileHere,allow_pickle=True)
+
+    # Required files (region labels and colors are optional; None if not shipped for this variant)
+    nodeOrder = load_file('node_order')
+    networkNames = load_file('network_order')
+    boundaries = load_file('network_boundaries_ordered')
+    for fileStr,arrayHere in zip(['node_order','network_order','network_boundaries_ordered'],[nodeOrder,networkNames,boundaries]):
+        if arrayHere is None:
+            print(f"ERROR: {os.path.join(atlasDir,'whole_brain_' + fileStr + '_' + atlasVariant + '.npy')} does not exist; aborting.")
+            return None
+    nodeOrder = nodeOrder.astype(int)
+    boundaries = boundaries.astype(int)
+    networkColors = load_file('network_order_colors_RGB')
+    networkLabels_Unordered = load_file('network_labels_by_region_unordered')
+    regionLabels_Unordered = load_file('region_labels_unordered')
+    regionLabels_Abbreviated = load_file('region_labels_abbreviated_ordered')
+
+    numNodes = nodeOrder.shape[0]
+    nodeOrder_Inverse = np.argsort(nodeOrder)
+
+    # Boundary file columns: start, stop, number of nodes (ordered space)
+    blockStarts = boundaries[:,0].copy()
+    blockStops = boundaries[:,1].copy()
+    blockSizes = boundaries[:,2].copy()
+    blockSlices = [slice(startIx,stopIx) for startIx,stopIx in zip(blockStarts,blockStops)]
+    networkIxs = np.repeat(np.arange(blockSizes.shape[0]),blockSizes)
+
+    if networkIxs.shape[0]!=numNodes:
+        print(f"WARNING: network boundaries cover {networkIxs.shape[0]} nodes, but node order has {numNodes}; please check atlas files in {atlasDir}.")
+
+    atlasInfo = {'numNodes':numNodes,
+                 'numNetworks':networkNames.shape[0],
+                 'nodeOrder':nodeOrder,
+                 'nodeOrder_Inverse':nodeOrder_Inverse,
+                 'networkNames':networkNames,
+                 'networkColors':networkColors,
+                 'blockStarts':blockStarts,
+                 'blockStops':blockStops,
+                 'blockSizes':blockSizes,
+                 'blockSlices':blockSlices,
+                 'networkIxs':networkIxs,
+                 'networkIxs_Unordered':networkIxs[nodeOrder_Inverse],
+                 'networkLabels':networkNames[networkIxs],
+                 'networkLabels_Unordered':networkLabels_Unordered,
+                 'regionLabels':None if regionLabels_Unordered is None else regionLabels_Unordered[nodeOrder],
+                 'regionLabels_Unordered':regionLabels_Unordered,
+                 'regionLabels_Abbreviated':regionLabels_Abbreviated}
+
+    _atlasCache[cacheKey] = atlasInfo
+    return atlasInfo
+
+################################################
+# Flat (raveled node x node) indices for re-ordering FC matrices in 1 gather
+def get_flat_order(atlasVariant='Cerebellum_Seperate',atlasDir=atlasDir_Default,inverse=False):
+    '''
+    Returns (cached) indices into a raveled nodes x nodes matrix such that
+    fc.ravel()[flatOrder].reshape(nodes,nodes) == fc[nodeOrder,:][:,nodeOrder] (or the inverse permutation).
+    '''
+    cacheKey = (atlasVariant,os.path.abspath(atlasDir),inverse)
+    if cacheKey not in _flatOrderCache:
+        atlasInfo = load_atlas(atlasVariant=atlasVariant,atlasDir=atlasDir)
+        if atlasInfo is None:
+            return None
+        orderHere = atlasInfo['nodeOrder_Inverse'] if inverse else atlasInfo['nodeOrder']
+        numNodes = atlasInfo['numNodes']
+        _flatOrderCache[cacheKey] = (orderHere[:,None]*numNodes + orderHere[None,:]).ravel()
+    return _flatOrderCache[cacheKey]
+
+################################################
+# Re-order a stack of FC matrices (both node axes at once)
+def reorder_fc(fcStack,atlasVariant='Cerebellum_Seperate',atlasDir=atlasDir_Default,inverse=False,stackAxisLast=False,out=None):
+    '''
+    INPUTS:
+        fcStack       : REQUIRED. nodes x nodes, or stack x nodes x nodes (e.g., subjects x nodes x nodes).
+        atlasVariant  : Optional. See load_atlas.
+        atlasDir      : Optional. See load_atlas.
+        inverse       : Optional. Boolean; if True, goes from network order back to the original parcellation order.
+        stackAxisLast : Optional. Boolean; set to True for nodes x nodes x stack arrays (e.g., fcEstimation with fcForSepBlocks=True).
+        out           : Optional. Pre-allocated, C-contiguous output array (same shape as fcStack after moving the stack axis 
+                        first, if need be); a ValueError is raised otherwise (a reshape of a non-contiguous array is a copy).
+
+    OUTPUT:
+        fcStack_Ordered : re-ordered FC array; stack x nodes x nodes (or nodes x nodes if input was 2D).
+                          NOTE: if stackAxisLast=True, the stack axis is returned first.
+    '''
+    fcStack = np.asarray(fcStack)
+    if stackAxisLast and fcStack.ndim==3:
+        fcStack = np.moveaxis(fcStack,-1,0)
+
+    numNodes = fcStack.shape[-1]
+    flatOrder = get_flat_order(atlasVariant=atlasVariant,atlasDir=atlasDir,inverse=inverse)
+    if flatOrder is None:
+        return None
+    if flatOrder.shape[0]!=numNodes*numNodes:
+        print(f"ERROR: FC has {numNodes} nodes, expected {int(np.sqrt(flatOrder.shape[0]))} for atlas {atlasVariant}; aborting.")
+        return None
+
+    # 1 gather over the raveled node axes (no per-subject copies)
+    leadShape = fcStack.shape[:-2]
+    fcFlat = fcStack.reshape(leadShape + (numNodes*numNodes,))
+    if out is not None:
+        if out.shape!=fcStack.shape or not out.flags.c_contiguous:
+            raise ValueError(f"reorder_fc: out must be a C-contiguous array of shape {fcStack.shape} (got shape {out.shape}, C-contiguous={out.flags.c_contiguous}).")
+        np.take(fcFlat,flatOrder,axis=-1,out=out.reshape(leadShape + (numNodes*numNodes,)))
+        return out
+    return np.take(fcFlat,flatOrder,axis=-1).reshape(fcStack.shape)
+
+################################################
+# Re-order node-wise data (e.g., regions x TRs timeseries, or regions vectors)
+def reorder_nodes(dataHere,atlasVariant='Cerebellum_Seperate',atlasDir=atlasDir_Default,inverse=False,axis=0):
+    '''
+    Re-orders 1 node axis (default: first axis; e.g., regions x TRs parcellated timeseries) into network order
+    (or back, with inverse=True).
+    '''
+    atlasInfo = load_atlas(atlasVariant=atlasVariant,atlasDir=atlasDir)
+    if atlasInfo is None:
+        return None
+    orderHere = atlasInfo['nodeOrder_Inverse'] if inverse else atlasInfo['nodeOrder']
+    return np.take(dataHere,orderHere,axis=axis)
+
+################################################
+# Network block sums/counts and summary (mean) matrices from precomputed boundaries
+def network_block_sums(fcStack,atlasVariant='Cerebellum_Seperate',atlasDir=atlasDir_Default,isOrdered=True,excludeDiagonal=True):
+    '''
+    INPUTS:
+        fcStack         : REQUIRED. stack x nodes x nodes (or nodes x nodes).
+        isOrdered       : Optional. Boolean; default True (fcStack already in network order, e.g., from reorder_fc).
+        excludeDiagonal : Optional. Boolean; if True (default), self-connections are excluded from sums and counts.
+        NaNs are ignored (treated as missing edges; also excluded from counts).
+
+    OUTPUT:
+        blockSums       : stack x networks x networks; sum of FC within (diagonal) and between each pair of networks
+        blockCounts     : stack x networks x networks; number of edges in each block
+    '''
+    atlasInfo = load_atlas(atlasVariant=atlasVariant,atlasDir=atlasDir)
+    if atlasInfo is None:
+        return None,None
+    fcStack = np.asarray(fcStack)
+    if fcStack.ndim==2:
+        fcStack = fcStack[None,:,:]
+    if not isOrdered:
+        fcStack = reorder_fc(fcStack,atlasVariant=atlasVariant,atlasDir=atlasDir)
+
+    validEdges = ~np.isnan(fcStack)
+    if excludeDiagonal:
+        diagIxs = np.arange(fcStack.shape[-1])
+        validEdges[:,diagIxs,diagIxs] = False
+    fcValid = np.where(validEdges,fcStack,0)
+
+    blockStarts = atlasInfo['blockStarts']
+    blockSums = np.add.reduceat(np.add.reduceat(fcValid,blockStarts,axis=1),blockStarts,axis=2)
+    blockCounts = np.add.reduceat(np.add.reduceat(validEdges.astype(np.int64),blockStarts,axis=1),blockStarts,axis=2)
+    return blockSums,blockCounts
+
+def network_block_summary(fcStack,atlasVariant='Cerebellum_Seperate',atlasDir=atlasDir_Default,isOrdered=True,excludeDiagonal=True):
+    '''
+    Mean FC within (diagonal) and between each pair of networks: stack x networks x networks (NaN for empty blocks,
+    e.g., within-network FC of 1-region networks). Inputs: see network_block_sums.
+    '''
+    blockSums,blockCounts = network_block_sums(fcStack,atlasVariant=atlasVariant,atlasDir=atlasDir,isOrdered=isOrdered,excludeDiagonal=excludeDiagonal)
+    if blockSums is None:
+        return None
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return blockSums / blockCounts
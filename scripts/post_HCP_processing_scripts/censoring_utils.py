@@ -0,0 +1,156 @@
+# C. Cocuzza, 2023. Frame censoring ("scrubbing") helpers for fcEstimation.py and acompcor_denoising.py.
+
+# FD estimation and thresholding for the TCP data release was done in MATLAB (see QC_FD/FD_estimation_thresholding.m,
+# Jenkinson FD). The functions here take either a per-TR keep-mask, or an FD vector (e.g., saved from that script, or
+# Power FD from HCP Movement_Regressors.txt; see framewise_displacement) plus a threshold, and:
+# (1) compute FC on retained frames only, without copying the timeseries: retained frames are split into contiguous
+#     segments (slices, i.e., numpy views), and row sums / cross-products are accumulated segment by segment in float64.
+# (2) optionally interpolate censored frames (all nodes at once), e.g., before temporal filtering, so that high-motion
+#     frames do not spread into neighbouring frames (Power et al., 2014). Interpolated frames are still excluded from FC.
+# (3) report retained frames and degrees of freedom per run.
+
+# Power, J. D., Mitra, A., Laumann, T. O., Snyder, A. Z., Schlaggar, B. L., & Petersen, S. E. (2014). Methods to detect, characterize, and remove motion artifact in resting state fMRI. NeuroImage, 84, 320–341. https://doi.org/10.1016/j.neuroimage.2013.08.048
+
+################################################
+# IMPORTS
+import numpy as np
+from scipy import interpolate, signal
+
+################################################
+# FD and keep-masks
+def framewise_displacement(movementFile,headRadius=50):
+    '''
+    Power et al. (2012) FD from HCP Movement_Regressors.txt (translations in mm, rotations in degrees).
+    NOTE: the TCP data release used Jenkinson FD (see QC_FD/FD_estimation_thresholding.m); an FD vector saved from that
+    script can be used instead wherever fdFile is an input.
+    '''
+    motionHere = np.loadtxt(movementFile)[:,:6].copy()
+    motionHere[:,3:] = np.deg2rad(motionHere[:,3:])*headRadius
+    fdHere = np.zeros(motionHere.shape[0])
+    fdHere[1:] = np.sum(np.abs(np.diff(motionHere,axis=0)),axis=1)
+    return fdHere
+
+def get_spike_regressors(fdHere,fdThreshold=0.25):
+    '''
+    Python version of QC_FD/GetSpikeRegressors.m: 1 regressor per TR with FD > fdThreshold (1 at that TR, 0 elsewhere).
+    Returns TRs x spikes (TRs x 0 if no spikes).
+    '''
+    spikeIxs = np.where(np.asarray(fdHere)>fdThreshold)[0]
+    spikeRegressors = np.zeros((fdHere.shape[0],spikeIxs.shape[0]))
+    spikeRegressors[spikeIxs,np.arange(spikeIxs.shape[0])] = 1
+    return spikeRegressors
+
+def make_keep_mask(fdHere,fdThreshold=0.25,censorBefore=0,censorAfter=0):
+    '''
+    Per-TR keep-mask (True = retained) from an FD vector: frames with FD > fdThreshold are censored, plus <censorBefore>
+    frames before and <censorAfter> frames after each of them (e.g., 1 and 2 as in Power et al., 2014).
+    fdHere can be an array or a text file (1 value per TR).
+    '''
+    if isinstance(fdHere,str):
+        fdHere = np.loadtxt(fdHere)
+    censorHere = np.asarray(fdHere)>fdThreshold
+    spikeIxs = np.where(censorHere)[0]
+    for shiftHere in range(-censorBefore,censorAfter+1):
+        shiftedIxs = spikeIxs + shiftHere
+        censorHere[shiftedIxs[(shiftedIxs>=0) & (shiftedIxs<censorHere.shape[0])]] = True
+    return ~censorHere
+
+def kept_segments(keepMask):
+    '''Contiguous runs of retained frames, as a list of slices (so dataHere[...,sliceHere] is a view, not a copy).'''
+    keepMask = np.asarray(keepMask,dtype=bool)
+    edgesHere = np.diff(np.concatenate(([0],keepMask.astype(np.int8),[0])))
+    return [slice(startIx,stopIx) for startIx,stopIx in zip(np.where(edgesHere==1)[0],np.where(edgesHere==-1)[0])]
+
+def censoring_summary(keepMask):
+    '''
+    Retained frames and degrees of freedom for 1 run. 'dof' is the number of retained frames minus 2, i.e., the
+    degrees of freedom of the t-test of each (pearson) FC estimate.
+    '''
+    keepMask = np.asarray(keepMask,dtype=bool)
+    numRetained = int(np.sum(keepMask))
+    return {'numTRs':int(keepMask.shape[0]),
+            'numRetained':numRetained,
+            'pctRetained':100*numRetained/keepMask.shape[0],
+            'numSegments':len(kept_segments(keepMask)),
+            'dof':numRetained-2}
+
+################################################
+# FC on retained frames
+def corrcoef_rows_censored(dataHere,keepMask):
+    '''
+    Pearson correlation between rows (space x time; no NaNs) using only the frames where keepMask is True. Same
+    precision handling as precision_utils.corrcoef_rows: row means and the cross-product accumulator are float64, each
+    segment is centered in the precision of <dataHere>. Only 1 segment-sized temporary is made at a time.
+    '''
+    segmentList = kept_segments(keepMask)
+    numRetained = int(np.sum(keepMask))
+    numNodes = dataHere.shape[0]
+
+    rowSums = np.zeros(numNodes,dtype=np.float64)
+    for segmentHere in segmentList:
+        rowSums += np.sum(dataHere[:,segmentHere],axis=1,dtype=np.float64)
+    rowMeans = (rowSums / numRetained).astype(dataHere.dtype)[:,None]
+
+    crossProducts = np.zeros((numNodes,numNodes),dtype=np.float64)
+    for segmentHere in segmentList:
+        centeredHere = dataHere[:,segmentHere] - rowMeans
+        crossProducts += np.matmul(centeredHere,centeredHere.T)
+
+    rowNorms = np.sqrt(np.diag(crossProducts))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        fcArray = crossProducts / np.outer(rowNorms,rowNorms)
+    np.clip(fcArray,-1,1,out=fcArray)
+    return fcArray.astype(dataHere.dtype,copy=False)
+
+################################################
+# Interpolation of censored frames (e.g., before filtering)
+def interpolate_censored_frames(dataHere,keepMask,method='linear'):
+    '''
+    Replaces censored frames (keepMask False) of space x time data, for all rows at once.
+        method: 'linear' (default; weights from the nearest retained frame on each side) or 'cubic' (cubic spline
+                through retained frames). Censored frames before the first / after the last retained frame take the
+                value of that frame.
+    Returns a new array (input is not modified).
+    '''
+    keepMask = np.asarray(keepMask,dtype=bool)
+    timeIxs = np.arange(keepMask.shape[0])
+    keptIxs = timeIxs[keepMask]
+    censoredIxs = timeIxs[~keepMask]
+    dataOut = dataHere.copy()
+    if censoredIxs.shape[0]==0:
+        return dataOut
+    if keptIxs.shape[0]<2:
+        print(f"WARNING: fewer than 2 retained frames; cannot interpolate censored frames.")
+        return dataOut
+
+    innerIxs = censoredIxs[(censoredIxs>keptIxs[0]) & (censoredIxs<keptIxs[-1])]
+    if method=='cubic':
+        splineHere = interpolate.CubicSpline(keptIxs,dataHere[:,keepMask],axis=1)
+        dataOut[:,innerIxs] = splineHere(innerIxs)
+    else:
+        if method!='linear':
+            print(f"WARNING: interpolation method {method} not recognized (options: 'linear', 'cubic'); using 'linear'.")
+        rightPos = np.searchsorted(keptIxs,innerIxs)
+        leftIxs = keptIxs[rightPos-1]
+        rightIxs = keptIxs[rightPos]
+        weightsHere = ((innerIxs - leftIxs) / (rightIxs - leftIxs)).astype(dataHere.dtype)
+        dataOut[:,innerIxs] = dataHere[:,leftIxs]*(1-weightsHere) + dataHere[:,rightIxs]*weightsHere
+
+    # Edges: nearest retained frame
+    dataOut[:,censoredIxs[censoredIxs<keptIxs[0]]] = dataHere[:,[keptIxs[0]]]
+    dataOut[:,censoredIxs[censoredIxs>keptIxs[-1]]] = dataHere[:,[keptIxs[-1]]]
+    return dataOut
+
+def bandpass_filter(dataHere,TR,highpassHz=0.009,lowpassHz=0.08,order=2):
+    '''
+    Zero-phase Butterworth filter along time (last axis) of space x time data, all rows at once. Set highpassHz or
+    lowpassHz to None for a low-pass or high-pass filter only.
+    '''
+    nyquistHz = 0.5/TR
+    if highpassHz is not None and lowpassHz is not None:
+        sosHere = signal.butter(order,[highpassHz/nyquistHz,lowpassHz/nyquistHz],btype='bandpass',output='sos')
+    elif highpassHz is not None:
+        sosHere = signal.butter(order,highpassHz/nyquistHz,btype='highpass',output='sos')
+    else:
+        sosHere = signal.butter(order,lowpassHz/nyquistHz,btype='lowpass',output='sos')
+    return signal.sosfiltfilt(sosHere,dataHere,axis=-1).astype(dataHere.dtype,copy=False)
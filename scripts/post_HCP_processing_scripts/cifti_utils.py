@@ -0,0 +1,227 @@
+# C. Cocuzza, 2023. CIFTI-2 output writers (.dtseries.nii, .ptseries.nii, .pconn.nii) for post-HCP results.
+
+# Most post-HCP steps here save bare .npy arrays, which loses the cifti header/structure info (brain models, parcels,
+# TR), so visualization and wb_command steps would otherwise need another npy --> cifti conversion job. The writers
+# below re-use the input file's brain-model axis (dense) or build a parcel axis from atlas labels (parcellated), and
+# write the data matrix in TR chunks directly into the output file (via a memory map), so the full output never has
+# to be held in memory.
+
+# NOTES:
+# (1) Data follow the conventions used throughout these scripts: space x time (grayordinates x TRs, regions x TRs) and
+#     regions x regions for FC. HCP files store time x space; the transposition is handled here (on disk, a CIFTI
+#     time x space matrix has time varying fastest, i.e., the same byte layout as a C-ordered space x time array).
+# (2) Data can also be passed as an iterable of space x TR-chunk arrays (e.g., from a generator), in which case only
+#     1 chunk is ever in memory; numTRs must then be given.
+# (3) See https://www.humanconnectome.org/software/workbench-command/-cifti-help for the CIFTI-2 file types.
+
+################################################
+# IMPORTS
+import io
+import numpy as np
+import nibabel as nib
+from nibabel import cifti2
+
+################################################
+# HCP conventions
+numVertsCort = 64984
+numVertsAll = 91282
+numVertsPerHemi = 32492
+
+ciftiIntents = {'dtseries':'NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES',
+                'ptseries':'NIFTI_INTENT_CONNECTIVITY_PARCELLATED_SERIES',
+                'pconn':'NIFTI_INTENT_CONNECTIVITY_PARCELLATED',
+                'dscalar':'NIFTI_INTENT_CONNECTIVITY_DENSE_SCALARS'}
+
+################################################
+# Axes from existing files / atlas labels
+def get_cifti_axes(ciftiFile):
+    '''
+    Returns the (row/time axis, column/space axis) of an existing cifti file, without loading its data.
+    For a .dtseries.nii: (SeriesAxis, BrainModelAxis).
+    '''
+    ciftiImg = nib.load(ciftiFile)
+    return ciftiImg.header.get_axis(0),ciftiImg.header.get_axis(1)
+
+def make_parcel_axis(atlasLabels,brainModelAxis,dropOutVals=np.nan,parcelNames=None,verbose=False):
+    '''
+    INPUTS:
+        atlasLabels    : REQUIRED. Atlas label vector (same as parcellate_timeseries.py): either 91282 (1 label per
+                         grayordinate) or 64984 (full left + right surfaces, incl. medial wall) labels.
+        brainModelAxis : REQUIRED. nibabel BrainModelAxis; e.g., from get_cifti_axes(<input .dtseries.nii>)[1].
+        dropOutVals    : Optional. np.nan (default) or 0; label value to ignore.
+        parcelNames    : Optional. List of parcel names (1 per unique non-dropout label, in sorted label order).
+                         Default: 'Parcel_<label>'.
+
+    OUTPUT:
+        parcelAxis     : nibabel ParcelsAxis, 1 parcel per unique (non-dropout) label of <atlasLabels> in sorted order (i.e.,
+                         the same rows as parcellate_timeseries.py output). Parcels with no grayordinate (e.g., labels
+                         only on the medial wall of a 64984-vertex atlas) are kept as empty parcels (NaN rows in the
+                         parcellated output), so rows always match.
+    '''
+    atlasLabels = np.asarray(atlasLabels,dtype=float)
+    numLabels = atlasLabels.shape[0]
+
+    # Map atlas labels onto grayordinates of the brain model axis
+    if numLabels==len(brainModelAxis):
+        labelsGray = atlasLabels.copy()
+    elif numLabels==numVertsCort:
+        labelsGray = np.full(len(brainModelAxis),np.nan)
+        for structureName,structureSlice,structureModel in brainModelAxis.iter_structures():
+            if structureName=='CIFTI_STRUCTURE_CORTEX_LEFT':
+                labelsGray[structureSlice] = atlasLabels[structureModel.vertex]
+            elif structureName=='CIFTI_STRUCTURE_CORTEX_RIGHT':
+                labelsGray[structureSlice] = atlasLabels[numVertsPerHemi + structureModel.vertex]
+    else:
+        print(f"ERROR: atlas has {numLabels} labels, expected {len(brainModelAxis)} (grayordinates) or {numVertsCort} (cortical surface); aborting.")
+        return None
+
+    if np.isnan(dropOutVals):
+        validLabels = ~np.isnan(labelsGray)
+        uniqueLabels = np.unique(atlasLabels[~np.isnan(atlasLabels)])
+    else:
+        validLabels = ~np.isnan(labelsGray) & (labelsGray!=dropOutVals)
+        uniqueLabels = np.unique(atlasLabels[~np.isnan(atlasLabels) & (atlasLabels!=dropOutVals)])
+    if parcelNames is None:
+        parcelNames = ['Parcel_' + str(int(labelHere)) for labelHere in uniqueLabels]
+    elif len(parcelNames)!=uniqueLabels.shape[0]:
+        print(f"ERROR: {len(parcelNames)} parcel names given, but atlas has {uniqueLabels.shape[0]} labels; aborting.")
+        return None
+    if verbose:
+        print(f"Building parcel axis with {uniqueLabels.shape[0]} parcels...")
+
+    parcelMasks = [validLabels & (labelsGray==labelHere) for labelHere in uniqueLabels]
+    isEmpty = np.array([not np.any(maskHere) for maskHere in parcelMasks])
+    if np.all(isEmpty):
+        print(f"ERROR: no atlas label falls on a grayordinate of the brain model axis; aborting.")
+        return None
+    nonEmptyAxis = cifti2.ParcelsAxis.from_brain_models([(str(parcelNames[parcelIx]),brainModelAxis[parcelMasks[parcelIx]])
+                                                          for parcelIx in np.where(~isEmpty)[0]])
+    if not np.any(isEmpty):
+        return nonEmptyAxis
+
+    # Keep empty parcels (no voxels / vertices) so rows match parcellate_timeseries.py output
+    print(f"WARNING: {np.sum(isEmpty)} parcel(s) have no grayordinates (labels: {uniqueLabels[isEmpty].astype(int).tolist()}); kept as empty parcels.")
+    voxelsList,verticesList = [],[]
+    nonEmptyIx = 0
+    for parcelIx in range(uniqueLabels.shape[0]):
+        if isEmpty[parcelIx]:
+            voxelsList.append(np.zeros((0,3),dtype=int))
+            verticesList.append({})
+        else:
+            voxelsList.append(nonEmptyAxis.voxels[nonEmptyIx])
+            verticesList.append(nonEmptyAxis.vertices[nonEmptyIx])
+            nonEmptyIx += 1
+    return cifti2.ParcelsAxis([str(nameHere) for nameHere in parcelNames],voxelsList,verticesList,
+                              nonEmptyAxis.affine,nonEmptyAxis.volume_shape,nonEmptyAxis.nvertices)
+
+################################################
+# Core writer
+def _write_header(outputFile,rowAxis,colAxis,ciftiType,dtype):
+    # Build the NIfTI-2 header + CIFTI-2 extension exactly as nibabel would, but write no data; returns data offset
+    ciftiHeader = cifti2.Cifti2Header.from_axes((rowAxis,colAxis))
+    niftiHeader = nib.Nifti2Header()
+    niftiHeader.set_data_shape((1,1,1,1,len(rowAxis),len(colAxis)))
+    niftiHeader.set_data_dtype(dtype)
+    niftiHeader.set_intent(ciftiIntents[ciftiType])
+    niftiHeader['pixdim'][:4] = 1
+    niftiHeader.extensions.append(cifti2.Cifti2Extension.from_bytes(ciftiHeader.to_xml()))
+
+    # Data offset: header + extensions, rounded up to a multiple of 16 (NIfTI convention)
+    headerBytes = io.BytesIO()
+    niftiHeader.set_data_offset(0)
+    niftiHeader.write_to(headerBytes)
+    dataOffset = int(np.ceil(len(headerBytes.getvalue()) / 16.0) * 16)
+    niftiHeader.set_data_offset(dataOffset)
+
+    with open(outputFile,'wb') as fileObj:
+        niftiHeader.write_to(fileObj)
+        fileObj.seek(dataOffset + len(rowAxis)*len(colAxis)*np.dtype(dtype).itemsize - 1)
+        fileObj.write(b'\x00')
+    return dataOffset
+
+def write_cifti(dataHere,rowAxis,colAxis,outputFile,ciftiType,numTRs=None,chunkSize=100,dtype=np.float32,verbose=False):
+    '''
+    INPUTS:
+        dataHere   : REQUIRED. Either a numpy array (space x time, or regions x regions for pconn; np.memmap / np.load
+                     with mmap_mode='r' also work), or an iterable of space x TR-chunk arrays (requires numTRs).
+        rowAxis    : REQUIRED. nibabel axis for the CIFTI rows (SeriesAxis for timeseries, ParcelsAxis for pconn).
+        colAxis    : REQUIRED. nibabel axis for the CIFTI columns (BrainModelAxis or ParcelsAxis).
+        outputFile : REQUIRED. A string; full path and file name, ending in .<ciftiType>.nii
+        ciftiType  : REQUIRED. A string; 'dtseries', 'ptseries', 'pconn', or 'dscalar'.
+        numTRs     : Optional. Only needed when dataHere is an iterable of chunks.
+        chunkSize  : Optional. Number of TRs (rows of the CIFTI matrix) written at once. Default is 100.
+        dtype      : Optional. Output data type; default is float32 (HCP convention).
+        verbose    : Optional. Boolean; if True, will print extra info.
+
+    OUTPUT:
+        Saves cifti file to <outputFile>.
+    '''
+    numRows,numCols = len(rowAxis),len(colAxis)
+    if isinstance(dataHere,np.ndarray) and dataHere.shape!=(numCols,numRows):
+        print(f"ERROR: data has shape {dataHere.shape}, expected {numCols} x {numRows} (space x time) from cifti axes; aborting.")
+        return
+    if not isinstance(dataHere,np.ndarray) and numTRs is not None and numTRs!=numRows:
+        print(f"ERROR: numTRs ({numTRs}) does not match cifti row axis ({numRows}); aborting.")
+        return
+
+    dataOffset = _write_header(outputFile,rowAxis,colAxis,ciftiType,dtype)
+    if verbose:
+        print(f"Writing {ciftiType} ({numCols} x {numRows}) to {outputFile} in chunks of {chunkSize}...")
+
+    # Space x time in C order == CIFTI time x space on disk
+    outputMap = np.memmap(outputFile,dtype=np.dtype(dtype).newbyteorder('='),mode='r+',offset=dataOffset,shape=(numCols,numRows))
+    if isinstance(dataHere,np.ndarray):
+        for startIx in range(0,numRows,chunkSize):
+            outputMap[:,startIx:startIx+chunkSize] = dataHere[:,startIx:startIx+chunkSize]
+    else:
+        startIx = 0
+        for dataChunk in dataHere:
+            if dataChunk.shape[0]!=numCols:
+                print(f"ERROR: data chunk has {dataChunk.shape[0]} rows, expected {numCols} from cifti axes; aborting.")
+                break
+            outputMap[:,startIx:startIx+dataChunk.shape[1]] = dataChunk
+            startIx += dataChunk.shape[1]
+        if startIx!=numRows:
+            print(f"WARNING: wrote {startIx} TRs, but cifti header expects {numRows}; please check {outputFile}.")
+    outputMap.flush()
+    del outputMap
+
+################################################
+# Convenience writers
+def write_dtseries(dataHere,templateFile,outputFile,numTRs=None,chunkSize=100,dtype=np.float32,verbose=False):
+    '''
+    Writes grayordinates x TRs data as .dtseries.nii, re-using brain models and TR info from <templateFile>
+    (e.g., the input <run>_Atlas_MSMAll_hp2000_clean.dtseries.nii). See write_cifti for other inputs.
+    '''
+    seriesAxis,brainModelAxis = get_cifti_axes(templateFile)
+    numTRsHere = dataHere.shape[1] if isinstance(dataHere,np.ndarray) else numTRs
+    if numTRsHere!=len(seriesAxis):
+        seriesAxis = cifti2.SeriesAxis(seriesAxis.start,seriesAxis.step,numTRsHere,seriesAxis.unit)
+    write_cifti(dataHere,seriesAxis,brainModelAxis,outputFile,'dtseries',numTRs=numTRs,chunkSize=chunkSize,dtype=dtype,verbose=verbose)
+
+def write_ptseries(dataHere,templateFile,outputFile,atlasLabels=None,parcelAxis=None,dropOutVals=np.nan,parcelNames=None,
+                   numTRs=None,chunkSize=100,dtype=np.float32,verbose=False):
+    '''
+    Writes regions x TRs data as .ptseries.nii. TR info (and brain models, if building the parcel axis) come from
+    <templateFile> (the dense timeseries that was parcellated). Either give <atlasLabels> (see make_parcel_axis) or a
+    pre-built <parcelAxis>. See write_cifti for other inputs.
+    '''
+    seriesAxis,brainModelAxis = get_cifti_axes(templateFile)
+    if parcelAxis is None:
+        parcelAxis = make_parcel_axis(atlasLabels,brainModelAxis,dropOutVals=dropOutVals,parcelNames=parcelNames,verbose=verbose)
+        if parcelAxis is None:
+            return
+    if isinstance(dataHere,np.ndarray) and dataHere.shape[0]!=len(parcelAxis):
+        print(f"ERROR: data has {dataHere.shape[0]} rows, but the parcel axis has {len(parcelAxis)} parcels; not writing {outputFile}.")
+        return
+    numTRsHere = dataHere.shape[1] if isinstance(dataHere,np.ndarray) else numTRs
+    if numTRsHere!=len(seriesAxis):
+        seriesAxis = cifti2.SeriesAxis(seriesAxis.start,seriesAxis.step,numTRsHere,seriesAxis.unit)
+    write_cifti(dataHere,seriesAxis,parcelAxis,outputFile,'ptseries',numTRs=numTRs,chunkSize=chunkSize,dtype=dtype,verbose=verbose)
+
+def write_pconn(fcArray,parcelAxis,outputFile,dtype=np.float32,verbose=False):
+    '''
+    Writes a regions x regions FC matrix as .pconn.nii. <parcelAxis>: nibabel ParcelsAxis, e.g., from the .ptseries.nii
+    used for FC estimation (get_cifti_axes(<ptseries>)[1]) or make_parcel_axis.
+    '''
+    write_cifti(np.asarray(fcArray),parcelAxis,parcelAxis,outputFile,'pconn',chunkSize=len(parcelAxis),dtype=dtype,verbose=verbose)
@@ -0,0 +1,233 @@
+# C. Cocuzza, 2023. Python version of create_masks_HCP.sh: physiological masks following HCP post minimal preprocessing best practices.
+# Adapted from scripts by MW Cole, R Mill, & T Ito (see create_masks_HCP.sh).
+
+# Usage: create physiological masks (whole brain, gray matter, white matter, ventricles) to later be used in aCompCor
+# portion of nuisance regression (Ciric et al., 2017) and in GSR (see gsr_from_surface.py).
+
+# Differences from create_masks_HCP.sh (outputs are the same files, same names, same steps):
+# (1) wmparc.nii.gz is loaded once per participant, and all anatomical masks are made at once with np.isin on the
+#     label sets below (instead of 1 AFNI 3dcalc call per FreeSurfer label, accumulating into a temp file).
+# (2) Resampling to functional space (nearest neighbour, as 3dresample) and dilation by 1 functional voxel (as
+#     3dLocalstat -nbhd 'SPHERE(-1)' -stat max) are done in-process.
+# (3) Anatomical masks are made once per participant: they are saved to the masks directory and re-loaded from there
+#     (if newer than wmparc.nii.gz) by later calls, e.g., the separate create_masks calls of post_hcp_main.sh for each
+#     variant (non-denoised, single-run ICA-FIX, multi-run ICA-FIX). Within a python session they are also cached in
+#     memory, and functional-space masks are cached per functional grid
+#     (affine + dimensions). All HCP MNINonLinear runs and variants (non-denoised, single-run ICA-FIX, multi-run ICA-FIX)
+#     share 1 grid, so resampling/dilation/erosion are done once, and only writing the run-named files is repeated.
+#     Only the header of each functional run is read (no timeseries data).
+# (4) Per-run output files are written in parallel (threads; gzip compression releases the GIL).
+# As in create_masks_HCP.sh, wmparc.nii.gz is copied into the masks directory.
+
+################################################
+# IMPORTS
+import os
+import shutil
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
+
+################################################
+# FreeSurfer label sets (wmparc.nii.gz); same as create_masks_HCP.sh
+gmLabels = np.array([8, 9, 10, 11, 12, 13, 16, 17, 18, 19, 20, 26, 27, 28, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 58, 59, 60, 96, 97] +
+                    list(range(1000,1036)) + list(range(2000,2036)))
+wmLabels = np.array([250, 251, 252, 253, 254, 255] + list(range(3000,3036)) + list(range(4000,4036)) + [5001, 5002])
+ventricleLabels = np.array([4, 43, 14, 15])
+
+# Anatomical mask files (same names as create_masks_HCP.sh): mask name --> file suffix
+anatMaskFiles = [('wholebrain','_wholebrainmask'),('gm','_gmMask'),('wm','_wmMask'),('ventricles','_ventricles')]
+
+# Per-participant caches (in memory, for the life of the python session)
+_anatMaskCache = {}
+_funcMaskCache = {}
+
+################################################
+# Anatomical masks (once per participant)
+def make_anatomical_masks(segparcFile,subjMaskDir=None,subjID='',verbose=False):
+    '''
+    INPUTS:
+        segparcFile : REQUIRED. A string; full path to <subj>/MNINonLinear/wmparc.nii.gz
+        subjMaskDir : Optional. A string; if given, anatomical masks are saved here (same names as create_masks_HCP.sh):
+                      <subjID>_wholebrainmask.nii.gz, <subjID>_gmMask.nii.gz, <subjID>_wmMask.nii.gz, <subjID>_ventricles.nii.gz
+                      If these files already exist (and are newer than <segparcFile>), they are loaded instead of re-made.
+        subjID      : Optional. A string; participant ID used in file names.
+        verbose     : Optional. Boolean; if True, will print extra info.
+
+    OUTPUT:
+        anatMasks   : A dictionary with boolean arrays 'wholebrain', 'gm', 'wm', 'ventricles' and the anatomical 'affine'.
+    '''
+    cacheKey = os.path.abspath(segparcFile)
+    if cacheKey in _anatMaskCache:
+        return _anatMaskCache[cacheKey]
+
+    # Re-use masks saved by an earlier call (e.g., another variant's create_masks stage)
+    if subjMaskDir is not None:
+        maskFileList = [os.path.join(subjMaskDir,subjID + fileStr + '.nii.gz') for maskName,fileStr in anatMaskFiles]
+        if all(os.path.isfile(maskFile) and os.path.getmtime(maskFile)>=os.path.getmtime(segparcFile) for maskFile in maskFileList):
+            if verbose:
+                print(f"Loading anatomical masks from {subjMaskDir}...")
+            anatMasks = {}
+            for (maskName,fileStr),maskFile in zip(anatMaskFiles,maskFileList):
+                maskImg = nib.load(maskFile)
+                anatMasks[maskName] = np.asarray(maskImg.dataobj)>0
+            anatMasks['affine'] = maskImg.affine
+            _anatMaskCache[cacheKey] = anatMasks
+            return anatMasks
+
+    if verbose:
+        print(f"Creating whole brain, gray matter, white matter, and ventricle masks from {segparcFile}...")
+    segparcImg = nib.load(segparcFile)
+    segparc = np.asarray(segparcImg.dataobj).astype(np.int32)
+
+    anatMasks = {'wholebrain':segparc>0,
+                 'gm':np.isin(segparc,gmLabels),
+                 'wm':np.isin(segparc,wmLabels),
+                 'ventricles':np.isin(segparc,ventricleLabels),
+                 'affine':segparcImg.affine}
+
+    if subjMaskDir is not None:
+        for maskName,fileStr in anatMaskFiles:
+            save_mask(anatMasks[maskName],segparcImg.affine,os.path.join(subjMaskDir,subjID + fileStr + '.nii.gz'))
+
+    _anatMaskCache[cacheKey] = anatMasks
+    return anatMasks
+
+################################################
+# Resampling and dilation (AFNI equivalents)
+def resample_mask_nearest(maskAnat,affineAnat,shapeFunc,affineFunc):
+    '''
+    Nearest-neighbour resampling of a boolean mask onto a functional grid (as 3dresample -master <func> -inset <mask>):
+    each functional voxel takes the value of the anatomical voxel at its center (False if outside the anatomical grid).
+    '''
+    funcToAnat = np.linalg.solve(affineAnat,affineFunc)
+    ijkFunc = np.indices(shapeFunc).reshape(3,-1)
+    ijkAnat = np.rint(funcToAnat[:3,:3] @ ijkFunc + funcToAnat[:3,3:4]).astype(int)
+    inBounds = np.all((ijkAnat>=0) & (ijkAnat<np.array(maskAnat.shape)[:,None]),axis=0)
+
+    maskFunc = np.zeros(ijkFunc.shape[1],dtype=bool)
+    maskFunc[inBounds] = maskAnat[ijkAnat[0,inBounds],ijkAnat[1,inBounds],ijkAnat[2,inBounds]]
+    return maskFunc.reshape(shapeFunc)
+
+def dilate_mask_1vox(maskHere):
+    '''Dilation by 1 voxel (face neighbours), as 3dLocalstat -nbhd 'SPHERE(-1)' -stat 'max'.'''
+    return ndimage.binary_dilation(maskHere,structure=ndimage.generate_binary_structure(3,1))
+
+################################################
+# Functional-space masks (once per functional grid)
+def make_functional_masks(anatMasks,shapeFunc,affineFunc):
+    '''
+    INPUTS:
+        anatMasks  : REQUIRED. Output of make_anatomical_masks.
+        shapeFunc  : REQUIRED. x/y/z dimensions of the functional run (e.g., 91 x 109 x 91 for HCP 2 mm MNI).
+        affineFunc : REQUIRED. Affine of the functional run.
+
+    OUTPUT:
+        funcMasks  : A dictionary of boolean arrays (same steps as create_masks_HCP.sh):
+                     'wholebrainmask_func', 'wholebrainmask_func_dil1vox', 'gmMask_func', 'gmMask_func_dil1vox',
+                     'wmMask_func', 'wmMask_func_eroded' (WM minus dilated GM), 'ventricles_func',
+                     'ventricles_func_eroded' (ventricles minus dilated GM)
+    '''
+    shapeFunc = tuple(int(dimHere) for dimHere in shapeFunc[:3])
+    cacheKey = (id(anatMasks),shapeFunc,np.round(affineFunc,4).tobytes())
+    if cacheKey in _funcMaskCache:
+        return _funcMaskCache[cacheKey]
+
+    funcMasks = {}
+    for maskName,fileStr in [('wholebrain','wholebrainmask'),('gm','gmMask'),('wm','wmMask'),('ventricles','ventricles')]:
+        funcMasks[fileStr + '_func'] = resample_mask_nearest(anatMasks[maskName],anatMasks['affine'],shapeFunc,affineFunc)
+
+    funcMasks['wholebrainmask_func_dil1vox'] = dilate_mask_1vox(funcMasks['wholebrainmask_func'])
+    funcMasks['gmMask_func_dil1vox'] = dilate_mask_1vox(funcMasks['gmMask_func'])
+
+    # Subtract (dilated) gray matter mask from white matter and ventricles, i.e., step(a-b) in 3dcalc
+    funcMasks['wmMask_func_eroded'] = funcMasks['wmMask_func'] & ~funcMasks['gmMask_func_dil1vox']
+    funcMasks['ventricles_func_eroded'] = funcMasks['ventricles_func'] & ~funcMasks['gmMask_func_dil1vox']
+
+    _funcMaskCache[cacheKey] = funcMasks
+    return funcMasks
+
+def save_mask(maskHere,affineHere,outputFile):
+    '''Saves a boolean mask as a binary (uint8) nifti file.'''
+    maskImg = nib.Nifti1Image(maskHere.astype(np.uint8),affineHere)
+    maskImg.set_data_dtype(np.uint8)
+    nib.save(maskImg,outputFile)
+
+################################################
+# Main function
+def create_masks_HCP(subjID,
+                     runNames_Directory,
+                     runNames_TimeSeriesFile,
+                     baseDir_Input,
+                     baseDir_Output,
+                     saveAnatomical=True,
+                     numWorkers=4,
+                     verbose=True):
+    '''
+    INPUTS:
+        subjID                  : REQUIRED. A string; participant ID, e.g., "sub-PCM001" (same as create_masks_HCP.sh 1st input).
+        runNames_Directory      : REQUIRED. A string or list of strings; functional run name(s) used for HCP directory naming
+                                  (same as create_masks_HCP.sh 2nd input), e.g., ['task-restAP_run-01_bold', ...].
+        runNames_TimeSeriesFile : REQUIRED. A string or list of strings (1 per run above); functional run name(s) used for
+                                  file naming (same as create_masks_HCP.sh 3rd input), e.g., ['task-restAP_run-01_bold_hp2000_clean', ...].
+                                  NOTE: multiple variants of the same run can be given at once (repeat the directory name).
+        baseDir_Input           : REQUIRED. A string; input directory (every subfolder before subject ID).
+        baseDir_Output          : REQUIRED. A string; output directory (masks saved to <baseDir_Output>/<subjID>/masks/).
+        saveAnatomical          : Optional. Boolean; save anatomical-space masks too (as create_masks_HCP.sh). Default True.
+                                  These are also re-loaded by later calls for the same participant (see note 3 at top of script).
+        numWorkers              : Optional. Number of threads used to write the per-run mask files. Default 4.
+        verbose                 : Optional. Boolean; if True, will print extra info.
+
+    OUTPUT:
+        Saves, per run: <subjID>_<runName_TimeSeriesFile>_<mask>.nii.gz for each mask in make_functional_masks, to
+        <baseDir_Output>/<subjID>/masks/ (same names as create_masks_HCP.sh).
+    '''
+    if isinstance(runNames_Directory,str):
+        runNames_Directory = [runNames_Directory]
+    if isinstance(runNames_TimeSeriesFile,str):
+        runNames_TimeSeriesFile = [runNames_TimeSeriesFile]
+    if len(runNames_Directory)!=len(runNames_TimeSeriesFile):
+        print(f"ERROR: {len(runNames_Directory)} run directory names but {len(runNames_TimeSeriesFile)} run file names, please check and re-run.")
+        return
+
+    subjDir = os.path.join(baseDir_Input,subjID)
+    if not os.path.isdir(subjDir):
+        print(f"{subjDir} does not exist, please check directory and/or subject ID.")
+        return
+
+    subjMaskDir = os.path.join(baseDir_Output,subjID,'masks')
+    if not os.path.isdir(subjMaskDir):
+        print(f"{subjMaskDir} does not yet exist, creating it now...")
+        os.makedirs(subjMaskDir)
+
+    ################################################
+    # Anatomical masks: once per participant
+    segparcFile = os.path.join(subjDir,'MNINonLinear','wmparc.nii.gz')
+    segparcCopy = os.path.join(subjMaskDir,'wmparc.nii.gz') # copied as in create_masks_HCP.sh
+    if not os.path.isfile(segparcCopy) or os.path.getmtime(segparcCopy)<os.path.getmtime(segparcFile):
+        shutil.copy2(segparcFile,segparcCopy)
+    anatMasks = make_anatomical_masks(segparcFile,
+                                      subjMaskDir=subjMaskDir if saveAnatomical else None,
+                                      subjID=subjID,
+                                      verbose=verbose)
+
+    ################################################
+    # Functional-space masks: once per functional grid; only file writing is run-specific
+    saveJobs = []
+    for runName_Directory,runName_TimeSeriesFile in zip(runNames_Directory,runNames_TimeSeriesFile):
+        funcRunFile = os.path.join(subjDir,'MNINonLinear','Results',runName_Directory,runName_TimeSeriesFile + '.nii.gz')
+        if not os.path.isfile(funcRunFile):
+            print(f"WARNING: {funcRunFile} does not exist; skipping masks for this run.")
+            continue
+
+        funcImg = nib.load(funcRunFile) # header only
+        funcMasks = make_functional_masks(anatMasks,funcImg.shape[:3],funcImg.affine)
+        if verbose:
+            print(f"Creating gray, white, ventricle, whole brain masks for subject {subjID}, {runName_TimeSeriesFile}...")
+
+        for maskName,maskHere in funcMasks.items():
+            outputFile = os.path.join(subjMaskDir,subjID + '_' + runName_TimeSeriesFile + '_' + maskName + '.nii.gz')
+            saveJobs.append((maskHere,funcImg.affine,outputFile))
+
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        list(executor.map(lambda saveJob: save_mask(*saveJob),saveJobs))
@@ -0,0 +1,238 @@
+# C. Cocuzza, 2023. Sliding-window (time-resolved) functional connectivity; see fcEstimation.py for static FC.
+
+# Recomputing a correlation matrix for every window costs O(windows x nodes^2 x window length). Here, weighted running
+# sums and cross-products are kept instead, and updated as the window slides: frames leaving the window are subtracted
+# and frames entering are added (O(nodes^2 x step size) per window). This is exact for:
+#   - taper=None           : rectangular windows (all frames weighted 1)
+#   - taper='exponential'  : exponentially tapered windows (newest frame weighted 1, halving every <taperParam> TRs)
+# taper='gaussian' (rectangle convolved with a gaussian of sd <taperParam> TRs; Allen et al., 2014) has no exact
+# incremental form, so each window is computed directly (1 weighted matrix product per window).
+# To bound accumulated rounding error, the running sums are recomputed from scratch every <refreshEvery> windows, and
+# the data are centered (run mean removed; does not change windowed correlations) beforehand.
+
+# Output: windows x edges (upper triangle, k=1, row-major as np.triu_indices) float32, written to a .npy memmap window by
+# window (so the full output is never held in memory). Optionally, each window is assigned to a connectivity "state":
+# either nearest of given centroids (on the fly), or online (MacQueen) k-means. For online k-means, the centroids are
+# seeded by k-means++ (Arthur & Vassilvitskii, 2007) on <numSeedWindows> windows spread evenly across the run (not the
+# first windows, which are nearly identical with overlapping windows), then all windows are passed through in order,
+# read back from the output.
+
+# Arthur, D., & Vassilvitskii, S. (2007). k-means++: The advantages of careful seeding. Proceedings of the Eighteenth Annual ACM-SIAM Symposium on Discrete Algorithms, 1027–1035.
+
+# Allen, E. A., Damaraju, E., Plis, S. M., Erhardt, E. B., Eichele, T., & Calhoun, V. D. (2014). Tracking whole-brain connectivity dynamics in the resting state. Cerebral Cortex, 24(3), 663–676. https://doi.org/10.1093/cercor/bhs352
+
+################################################
+# IMPORTS
+import numpy as np
+import precision_utils # see precision_utils.py
+
+################################################
+# Window weights
+def window_weights(windowLength,taper=None,taperParam=3):
+    '''Weights for each position of a window (oldest to newest frame); see notes at top of script for <taper> options.'''
+    if taper=='exponential':
+        return 0.5**(np.arange(windowLength)[::-1]/taperParam)
+    elif taper=='gaussian':
+        gaussHalfWidth = int(np.ceil(3*taperParam))
+        gaussHere = np.exp(-0.5*(np.arange(-gaussHalfWidth,gaussHalfWidth+1)/taperParam)**2)
+        weightsHere = np.convolve(np.ones(windowLength),gaussHere/np.sum(gaussHere),mode='full')[gaussHalfWidth:gaussHalfWidth+windowLength]
+        return weightsHere/np.max(weightsHere)
+    elif taper is not None:
+        print(f"WARNING: taper {taper} not recognized (options: None, 'exponential', 'gaussian'); using rectangular windows.")
+    return np.ones(windowLength)
+
+################################################
+# Online state assignment
+def kmeans_plus_plus(candidatesHere,numStates,seed=0):
+    '''
+    k-means++ seeding: <numStates> rows of <candidatesHere> (windows x edges), the 1st chosen at random and each next one
+    with probability proportional to its squared distance from the nearest row already chosen.
+    '''
+    rng = np.random.default_rng(seed)
+    candidatesHere = np.asarray(candidatesHere,dtype=np.float64)
+    chosenIxs = [int(rng.integers(candidatesHere.shape[0]))]
+    minDistances = np.sum((candidatesHere - candidatesHere[chosenIxs[0]])**2,axis=1)
+    for stateIx in range(1,numStates):
+        if np.sum(minDistances)>0:
+            nextIx = int(rng.choice(candidatesHere.shape[0],p=minDistances/np.sum(minDistances)))
+        else:
+            nextIx = int(rng.integers(candidatesHere.shape[0])) # all candidates identical
+        chosenIxs.append(nextIx)
+        minDistances = np.minimum(minDistances,np.sum((candidatesHere - candidatesHere[nextIx])**2,axis=1))
+    return candidatesHere[chosenIxs].copy()
+
+class OnlineStates:
+    '''
+    Assigns each window's FC (edges vector) to a connectivity state as windows are passed to update().
+        centroids   : states x edges array (e.g., group-level k-means centroids); windows are assigned to the nearest one.
+        numStates   : if centroids is None, online (MacQueen) k-means: centroids are seeded by k-means++ on <seedWindows>,
+                      and each new window moves its nearest centroid by 1/(number of windows assigned to it).
+        seedWindows : candidates x edges array for k-means++ seeding (required for online k-means); e.g., windows spread
+                      across the run (see sliding_window_fc).
+        seed        : seed for k-means++.
+    '''
+    def __init__(self,centroids=None,numStates=None,seedWindows=None,seed=0):
+        self.isFixed = centroids is not None
+        if self.isFixed:
+            self.centroids = np.asarray(centroids,dtype=np.float64)
+            self.numStates = self.centroids.shape[0]
+        else:
+            if seedWindows is None or np.shape(seedWindows)[0]<numStates:
+                raise ValueError(f"Online k-means needs at least numStates ({numStates}) seedWindows for k-means++ seeding.")
+            self.numStates = numStates
+            self.centroids = kmeans_plus_plus(seedWindows,numStates,seed=seed)
+        self.counts = np.zeros(self.numStates,dtype=np.int64)
+        self.states = []
+
+    def update(self,edgesHere):
+        stateHere = int(np.argmin(np.sum((self.centroids - edgesHere)**2,axis=1)))
+        if not self.isFixed:
+            self.centroids[stateHere] += (edgesHere - self.centroids[stateHere]) / (self.counts[stateHere] + 1)
+        self.counts[stateHere] += 1
+        self.states.append(stateHere)
+        return stateHere
+
+################################################
+# Sliding-window FC
+def sliding_window_fc(dataHere,windowLength,stepSize=1,taper=None,taperParam=3,outputFile=None,
+                      kmeansCentroids=None,numStates=None,numSeedWindows=100,refreshEvery=50,verbose=False):
+    '''
+    INPUTS:
+        dataHere        : REQUIRED. nodes x TRs array (no NaNs).
+        windowLength    : REQUIRED. Window length in TRs.
+        stepSize        : OPTIONAL. Number of TRs the window moves by; default 1.
+        taper           : OPTIONAL. None (rectangular; default), 'exponential', or 'gaussian'; see notes at top of script.
+        taperParam      : OPTIONAL. Half-life ('exponential') or gaussian sd ('gaussian') in TRs; default 3.
+        outputFile      : OPTIONAL. A string ending in .npy; windows x edges output is written here window by window. If None,
+                          an in-memory array is returned instead.
+        kmeansCentroids : OPTIONAL. states x edges array (or .npy file); assign each window to the nearest centroid.
+        numStates       : OPTIONAL. Number of states for online k-means (used if kmeansCentroids is None).
+        numSeedWindows  : OPTIONAL. Number of windows (spread evenly across the run) used for k-means++ seeding of online
+                          k-means; default 100.
+        refreshEvery    : OPTIONAL. Running sums are recomputed from scratch every this many windows; default 50.
+        verbose         : OPTIONAL. If True, will print extra info.
+
+    OUTPUT:
+        dfcDict : dictionary with 'fcWindows' (windows x edges float32; a memmap if outputFile was given), 'windowStarts'
+                  (first TR of each window), 'edgeIxs' (row, column node indices of each edge; np.triu_indices k=1), and,
+                  if states were requested, 'states' (per window) and 'centroids'.
+    '''
+    numNodes,numTRs = dataHere.shape
+    numWindows = (numTRs - windowLength)//stepSize + 1
+    if numWindows<1:
+        print(f"ERROR: window length ({windowLength}) is longer than the timeseries ({numTRs} TRs); aborting.")
+        return None
+    edgeIxs = np.triu_indices(numNodes,k=1)
+    windowStarts = np.arange(numWindows)*stepSize
+
+    if outputFile is not None:
+        fcWindows = np.lib.format.open_memmap(outputFile,mode='w+',dtype=np.float32,shape=(numWindows,edgeIxs[0].shape[0]))
+    else:
+        fcWindows = np.zeros((numWindows,edgeIxs[0].shape[0]),dtype=np.float32)
+
+    # Fixed centroids: states assigned on the fly. Online k-means: after all windows are computed (see notes at top of script)
+    stateTracker = None
+    if kmeansCentroids is not None:
+        if isinstance(kmeansCentroids,str):
+            kmeansCentroids = np.load(kmeansCentroids)
+        stateTracker = OnlineStates(centroids=kmeansCentroids)
+    elif numStates is not None and numWindows<numStates:
+        print(f"ERROR: fewer windows ({numWindows}) than states ({numStates}); aborting.")
+        return None
+
+    # Centered, float64 data (windows sums are accumulated in float64)
+    dataHere = np.asarray(dataHere,dtype=np.float64)
+    dataHere = dataHere - np.mean(dataHere,axis=1,keepdims=True)
+
+    weightsHere = window_weights(windowLength,taper=taper,taperParam=taperParam)
+    sumWeights = np.sum(weightsHere)
+    isIncremental = taper!='gaussian' and stepSize<windowLength
+    decayPerStep = weightsHere[0]/weightsHere[1] if (taper=='exponential' and windowLength>1) else 1.0
+    decayHere = decayPerStep**stepSize
+
+    if verbose:
+        print(f"Sliding-window FC: {numWindows} windows of {windowLength} TRs (step {stepSize}, taper {taper}), {edgeIxs[0].shape[0]} edges; "
+              f"{'incremental' if isIncremental else 'direct'} updates.")
+
+    for windowIx,startIx in enumerate(windowStarts):
+        if not isIncremental or windowIx%refreshEvery==0:
+            # From scratch
+            windowData = dataHere[:,startIx:startIx+windowLength]
+            runningSums = np.matmul(windowData,weightsHere)
+            runningCross = np.matmul(windowData*weightsHere,windowData.T)
+        else:
+            # Slide: decay, remove <stepSize> oldest frames, add <stepSize> newest frames
+            leavingData = dataHere[:,startIx-stepSize:startIx]
+            leavingWeights = decayHere*weightsHere[:stepSize]
+            enteringData = dataHere[:,startIx+windowLength-stepSize:startIx+windowLength]
+            enteringWeights = weightsHere[windowLength-stepSize:]
+            runningSums = decayHere*runningSums - np.matmul(leavingData,leavingWeights) + np.matmul(enteringData,enteringWeights)
+            runningCross = (decayHere*runningCross - np.matmul(leavingData*leavingWeights,leavingData.T)
+                            + np.matmul(enteringData*enteringWeights,enteringData.T))
+
+        meansHere = runningSums/sumWeights
+        covHere = runningCross/sumWeights - np.outer(meansHere,meansHere)
+        stdHere = np.sqrt(np.clip(np.diag(covHere),0,None))
+        with np.errstate(divide='ignore',invalid='ignore'):
+            edgesHere = covHere[edgeIxs] / (stdHere[edgeIxs[0]]*stdHere[edgeIxs[1]])
+        np.clip(edgesHere,-1,1,out=edgesHere)
+        fcWindows[windowIx] = edgesHere
+
+        if stateTracker is not None:
+            stateTracker.update(edgesHere)
+
+    if kmeansCentroids is None and numStates is not None:
+        seedIxs = np.unique(np.round(np.linspace(0,numWindows-1,max(min(numSeedWindows,numWindows),numStates))).astype(int))
+        stateTracker = OnlineStates(numStates=numStates,seedWindows=fcWindows[seedIxs])
+        for windowIx in range(numWindows):
+            stateTracker.update(np.asarray(fcWindows[windowIx],dtype=np.float64))
+
+    if outputFile is not None:
+        fcWindows.flush()
+
+    dfcDict = {'fcWindows':fcWindows,'windowStarts':windowStarts,'edgeIxs':edgeIxs}
+    if stateTracker is not None:
+        dfcDict['states'] = np.array(stateTracker.states)
+        dfcDict['centroids'] = stateTracker.centroids
+    return dfcDict
+
+################################################
+# File-level wrapper (same inputs/naming as fcEstimation.py)
+def dynamic_fc_estimation(inputDataFile,outputPath,subjID,windowLength,extraSaveStr='',stepSize=1,taper=None,taperParam=3,
+                          flipDims=False,kmeansCentroids=None,numStates=None,numSeedWindows=100,verbose=False):
+    '''
+    INPUTS:
+        inputDataFile : REQUIRED. A string; full path to a 2D (nodes x TRs) timeseries: '.ptseries.nii', '.dtseries.nii', or '.npy'.
+                        Use flipDims=True for TRs x nodes data (e.g., HCP cifti files).
+        outputPath    : REQUIRED. A string; full output path to save results.
+        subjID        : REQUIRED. A string; participant ID as used throughout study.
+        windowLength  : REQUIRED. Window length in TRs.
+        Other inputs  : see sliding_window_fc.
+
+    OUTPUTS:
+        Saves windows x edges (float32) as: ~/<outputPath>/"DynFC_<subjID>_win<windowLength>_step<stepSize><extraSaveStr>.npy"
+        Saves window starts (and states/centroids if requested) as: ~/<outputPath>/"DynFC_<subjID>_win<windowLength>_step<stepSize><extraSaveStr>_Info.npz"
+    '''
+    if '.nii' in inputDataFile or inputDataFile.endswith('.npy'):
+        dataHere = precision_utils.load_data(inputDataFile,precision='float64')
+    else:
+        print(f"ERROR: file type in <inputDataFile> is not a nifti or numpy array, please check and re-run; aborting.\n")
+        return None
+    if flipDims:
+        dataHere = dataHere.T
+    if dataHere.ndim!=2:
+        print(f"ERROR: data in <inputDataFile> must be 2D (nodes x TRs), please check and re-run; aborting.")
+        return None
+
+    outputFileHere = outputPath + 'DynFC_' + subjID + '_win' + str(windowLength) + '_step' + str(stepSize) + extraSaveStr + '.npy'
+    dfcDict = sliding_window_fc(dataHere,windowLength,stepSize=stepSize,taper=taper,taperParam=taperParam,outputFile=outputFileHere,
+                                kmeansCentroids=kmeansCentroids,numStates=numStates,numSeedWindows=numSeedWindows,verbose=verbose)
+    if dfcDict is None:
+        return None
+
+    infoDict = {'windowStarts':dfcDict['windowStarts'],'numNodes':dataHere.shape[0]}
+    if 'states' in dfcDict:
+        infoDict['states'] = dfcDict['states']
+        infoDict['centroids'] = dfcDict['centroids']
+    np.savez(outputFileHere.replace('.npy','_Info.npz'),**infoDict)
+    return dfcDict
@@ -3,8 +3,12 @@
 import numpy as np
 import nibabel as nib
 import numpy.ma as ma
+import cifti_utils # see cifti_utils.py
+import precision_utils # see precision_utils.py
+import censoring_utils # see censoring_utils.py
 
-def fcEstimation(inputDataFile,outputPath,subjID,extraSaveStr='',fcMethod='pearson',fillDiagVal='nan',fcForSepBlocks=False,flipDims=False,verbose=False):
+def fcEstimation(inputDataFile,outputPath,subjID,extraSaveStr='',fcMethod='pearson',fillDiagVal='nan',fcForSepBlocks=False,flipDims=False,saveCifti=False,precision='float64',
+                 keepMask=None,fdFile=None,fdThreshold=0.25,censorBefore=0,censorAfter=0,interpolateCensored=None,bandpassFilter=None,verbose=False):
     '''
     ######################################################
     INPUTS:
@@ -20,21 +24,35 @@ def fcEstimation(inputDataFile,outputPath,subjID,extraSaveStr='',fcMethod='pears
         fcForSepBlocks : OPTIONAL. Boolean; set to True if you want the last dimension to be treated as separate blocks/conditions/etc. and have FC estimation performed seperately for each. 
                                    IMPORTANT NOTE: MUST be used if data is 3D (nodes x TRs x blocks). 
         flipDims       : OPTIONAL. Boolean; only use for 2D data that is time x space, to put into space x time. 
+        saveCifti      : OPTIONAL. Boolean; only for '.ptseries.nii' inputs. If True, also saves FC as a .pconn.nii, using the parcel axis of the input.
+        precision      : OPTIONAL. A string; 'float64' (default) or 'float32'. Precision data are loaded and FC is computed/saved in (see precision_utils.py).
+        keepMask       : OPTIONAL. Per-TR boolean array (True = retained frame), or a text file with 1 value (1/0) per TR. If given, FC is estimated on
+                                   retained frames only (see censoring_utils.py; no copy of the timeseries is made). For 3D data: TRs, or TRs x blocks.
+        fdFile         : OPTIONAL. Alternative to keepMask: FD vector (array, or text file with 1 value per TR; e.g., from QC_FD/FD_estimation_thresholding.m).
+                                   Frames with FD > <fdThreshold> (default 0.25) are censored, plus <censorBefore> / <censorAfter> frames around each (default 0).
+        interpolateCensored : OPTIONAL. None (default), 'linear', or 'cubic'. Interpolates censored frames (all nodes at once) before bandpassFilter. 
+                                   Interpolated frames are still excluded from FC.
+        bandpassFilter : OPTIONAL. None (default), or (TR, highpassHz, lowpassHz), e.g., (0.8, 0.009, 0.08); zero-phase Butterworth filter applied before FC.
+                                   With censoring, use interpolateCensored so high-motion frames do not spread into retained frames.
         verbose        : OPTIONAL. If True, will print extra info.
         
     ######################################################
     OUTPUTS:
         Saves result as: ~/<outputPath>/"FC_<subjID>_<fcMethod>_<extraSaveStr>.npy"
+        If saveCifti=True (and input is .ptseries.nii): ~/<outputPath>/"FC_<subjID>_<fcMethod>_<extraSaveStr>.pconn.nii"
+        If censoring (keepMask or fdFile): ~/<outputPath>/"FC_<subjID>_<fcMethod>_<extraSaveStr>_Censoring.npz", with the keep-mask, number of retained 
+                                           frames, and retained degrees of freedom (retained frames - 2) per run (or per block for 3D data).
     '''
     
     ################################################
     # LOAD data 
+    dtypeHere = precision_utils.get_dtype(precision)
     if '.nii' in inputDataFile:
-        dataHere = nib.load(inputDataFile).get_fdata().copy()
+        dataHere = nib.load(inputDataFile).get_fdata(dtype=dtypeHere)
         goodToRun = True
         
     elif '.npy' in inputDataFile:
-        dataHere = np.load(inputDataFile).copy()
+        dataHere = np.asarray(np.load(inputDataFile),dtype=dtypeHere)
         goodToRun = True
         
     else:
@@ -75,7 +93,63 @@ def fcEstimation(inputDataFile,outputPath,subjID,extraSaveStr='',fcMethod='pears
             print(f"ERROR: data in <inputDataFile> is neither 2D, 3D, or 4D, Please check and re-run; aborting.")
             goodToRun2 = False
                 
+        ################################################
+        # Frame censoring (optional)
+        keepMaskHere = None
+        if goodToRun2 and (keepMask is not None or fdFile is not None):
+            if keepMask is not None:
+                keepMaskHere = np.loadtxt(keepMask) if isinstance(keepMask,str) else keepMask
+                keepMaskHere = np.asarray(keepMaskHere,dtype=bool)
+            else:
+                keepMaskHere = censoring_utils.make_keep_mask(fdFile,fdThreshold=fdThreshold,censorBefore=censorBefore,censorAfter=censorAfter)
+            
+            if numDims==4:
+                print(f"ERROR: frame censoring is only supported for 2D or 3D (blocks) data; aborting.")
+                goodToRun2 = False
+            elif keepMaskHere.ndim not in ([1] if numDims==2 else [1,2]):
+                print(f"ERROR: keep-mask has shape {keepMaskHere.shape}; expected TRs{'' if numDims==2 else ' or TRs x blocks'} for {numDims}D data, please check and re-run; aborting.")
+                goodToRun2 = False
+            elif keepMaskHere.shape[0]!=numTRs:
+                print(f"ERROR: keep-mask / FD vector has {keepMaskHere.shape[0]} values but data has {numTRs} TRs, please check and re-run; aborting.")
+                goodToRun2 = False
+            elif numDims==3 and keepMaskHere.ndim==2 and keepMaskHere.shape[1]!=numBlocks:
+                print(f"ERROR: keep-mask has {keepMaskHere.shape[1]} blocks (columns) but data has {numBlocks} blocks, please check and re-run; aborting.")
+                goodToRun2 = False
+            elif numDims==3 and keepMaskHere.ndim==1:
+                keepMaskHere = np.repeat(keepMaskHere[:,None],numBlocks,axis=1)
+            
+            if goodToRun2:
+                if numDims==2:
+                    censorInfoList = [censoring_utils.censoring_summary(keepMaskHere)]
+                else:
+                    censorInfoList = [censoring_utils.censoring_summary(keepMaskHere[:,blockNum]) for blockNum in range(numBlocks)]
+                for censorInfoHere in censorInfoList:
+                    if censorInfoHere['dof']<1:
+                        print(f"WARNING: only {censorInfoHere['numRetained']} frames retained after censoring; FC will be NaN.")
+                    if verbose:
+                        print(f"Censoring: {censorInfoHere['numRetained']} of {censorInfoHere['numTRs']} frames retained ({censorInfoHere['pctRetained']:.1f}%), dof = {censorInfoHere['dof']}")
+        
         if goodToRun2:
+            ################################################
+            # Interpolate censored frames and/or filter (optional)
+            if bandpassFilter is not None or (interpolateCensored is not None and keepMaskHere is not None):
+                if np.isnan(dataHere).any():
+                    print(f"WARNING: data contain NaNs; skipping interpolation/filtering.")
+                else:
+                    if keepMaskHere is not None and interpolateCensored is None:
+                        print(f"WARNING: filtering censored data without interpolateCensored; high-motion frames will spread into retained frames.")
+                    for blockNum in range(numBlocks if numDims==3 else 1):
+                        dataBlock = dataHere[:,:,blockNum] if numDims==3 else dataHere
+                        keepBlock = None if keepMaskHere is None else (keepMaskHere[:,blockNum] if numDims==3 else keepMaskHere)
+                        if keepBlock is not None and interpolateCensored is not None:
+                            dataBlock = censoring_utils.interpolate_censored_frames(dataBlock,keepBlock,method=interpolateCensored)
+                        if bandpassFilter is not None:
+                            dataBlock = censoring_utils.bandpass_filter(dataBlock,bandpassFilter[0],highpassHz=bandpassFilter[1],lowpassHz=bandpassFilter[2])
+                        if numDims==3:
+                            dataHere[:,:,blockNum] = dataBlock
+                        else:
+                            dataHere = dataBlock
+            
             ################################################
             # Estimate FC 
             if fillDiagVal=='nan':
@@ -86,22 +160,35 @@ def fcEstimation(inputDataFile,outputPath,subjID,extraSaveStr='',fcMethod='pears
             if fcMethod=='pearson':
                 
                 # NOTE: in case NaN's are present in data, using numpy.ma and mask invalid skips them. Can also use pandas in future if need be.
+                # When there are no NaN's, the (much faster) standardized matrix product in precision_utils.corrcoef_rows is used instead.
                 
                 if numDims == 3:
                     if verbose:
                         print(f"Estimating FC with pearsons correlation over each block/condition (3D timeseries data)...")
-                    fcArray = np.zeros((numNodes,numNodes,numBlocks))
+                    fcArray = np.zeros((numNodes,numNodes,numBlocks),dtype=dtypeHere)
                     for blockNum in range(numBlocks):
-                        fcArray_ThisBlock = ma.corrcoef(ma.masked_invalid(dataHere[:,:,blockNum]),rowvar=True).copy() 
-                        fcArray_ThisBlock = ma.getdata(fcArray_ThisBlock).copy()
+                        if np.isnan(dataHere[:,:,blockNum]).any():
+                            dataBlock = dataHere[:,:,blockNum] if keepMaskHere is None else dataHere[:,keepMaskHere[:,blockNum],blockNum]
+                            fcArray_ThisBlock = ma.corrcoef(ma.masked_invalid(dataBlock),rowvar=True).copy() 
+                            fcArray_ThisBlock = ma.getdata(fcArray_ThisBlock).copy()
+                        elif keepMaskHere is not None:
+                            fcArray_ThisBlock = censoring_utils.corrcoef_rows_censored(dataHere[:,:,blockNum],keepMaskHere[:,blockNum])
+                        else:
+                            fcArray_ThisBlock = precision_utils.corrcoef_rows(dataHere[:,:,blockNum])
                         np.fill_diagonal(fcArray_ThisBlock,fillDiagVal)
                         fcArray[:,:,blockNum] = fcArray_ThisBlock.copy()
                         
                 elif numDims == 2:
                     if verbose:
                         print(f"Estimating FC with pearsons correlation on 2D timeseries data...")
-                    fcArray = ma.corrcoef(ma.masked_invalid(dataHere),rowvar=True).copy() 
-                    fcArray = ma.getdata(fcArray).copy()
+                    if np.isnan(dataHere).any():
+                        dataCensored = dataHere if keepMaskHere is None else dataHere[:,keepMaskHere]
+                        fcArray = ma.corrcoef(ma.masked_invalid(dataCensored),rowvar=True).copy() 
+                        fcArray = ma.getdata(fcArray).astype(dtypeHere)
+                    elif keepMaskHere is not None:
+                        fcArray = censoring_utils.corrcoef_rows_censored(dataHere,keepMaskHere)
+                    else:
+                        fcArray = precision_utils.corrcoef_rows(dataHere)
                     np.fill_diagonal(fcArray,fillDiagVal)
                 
             #elif fcMethod=='multiple_regression':
@@ -110,4 +197,18 @@ def fcEstimation(inputDataFile,outputPath,subjID,extraSaveStr='',fcMethod='pears
             ################################################
             # SAVE results 
             outputFileHere = outputPath + 'FC_' + subjID + '_' + fcMethod + extraSaveStr + '.npy'
-            np.save(outputFileHere,fcArray)
\ No newline at end of file
+            np.save(outputFileHere,fcArray)
+            
+            if keepMaskHere is not None:
+                np.savez(outputFileHere.replace('.npy','_Censoring.npz'),
+                         keepMask=keepMaskHere,
+                         numTRs=np.array([infoHere['numTRs'] for infoHere in censorInfoList]),
+                         numRetained=np.array([infoHere['numRetained'] for infoHere in censorInfoList]),
+                         dof=np.array([infoHere['dof'] for infoHere in censorInfoList]))
+            
+            if saveCifti:
+                if inputDataFile.endswith('.ptseries.nii') and numDims==2:
+                    parcelAxis = cifti_utils.get_cifti_axes(inputDataFile)[1]
+                    cifti_utils.write_pconn(fcArray,parcelAxis,outputFileHere.replace('.npy','.pconn.nii'),verbose=verbose)
+                else:
+                    print(f"WARNING: saveCifti=True is only supported for 2D .ptseries.nii inputs; skipping .pconn.nii output.")
\ No newline at end of file
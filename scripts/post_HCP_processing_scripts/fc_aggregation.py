@@ -0,0 +1,287 @@
+# C. Cocuzza, 2023. Multi-run FC from per-run sufficient statistics (e.g., the 4 TCP rest runs per participant).
+
+# Instead of concatenating all runs' timeseries in memory before fcEstimation.py, each run is reduced once to its
+# sufficient statistics: number of frames N_r, row sums s_r, and centered cross-products C_r (nodes x nodes), which are
+# added to running sums (C_r itself is only kept if keepRunCross=True). From the same accumulators:
+#   - per-run FC                : r_r = C_r / sqrt(diag(C_r) diag(C_r)'); written while the run is added (runFCFile), or
+#                                 later from the kept C_r (keepRunCross=True)
+#   - concatenated-run FC       : 'demean' (default; each run demeaned before concatenation): sum_r C_r
+#                                 'none'   (runs concatenated as they are): sum_r C_r + sum_r N_r m_r m_r' - N m m'
+#                                          (m_r = s_r/N_r; m = sum_r s_r / N), i.e., a rank-(runs) correction
+#                                 'zscore' (each run variance normalized before concatenation): sum_r (N_r/N) r_r
+#                                          (running sum of N_r r_r), i.e., the run-length-weighted mean of per-run FC
+#   - run-averaged Fisher-z FC  : running sum of arctanh(per-run FC), divided by the number of runs
+# Adding a (late-arriving) run costs 1 pass over that run's data plus O(nodes^2) updates; nothing is recomputed for the
+# other runs.
+
+# Dense (grayordinate) data: with storeDir, every nodes x nodes array is a memmap on disk, and all products /
+# normalizations are done in blocks of <blockSize> rows, so memory is bounded by ~blockSize x nodes (plus 1 run's
+# timeseries), not nodes^2. The accumulator state is saved in storeDir, so runs can be added in later python calls
+# (FCAccumulator.load). Without storeDir (e.g., parcellated data), everything is kept in memory.
+# DISK (or memory) FOOTPRINT: this moves the nodes^2 cost to disk, it does not remove it. Accumulators: sum of C_r
+# (float64; 8 bytes x nodes^2), and sums of Fisher-z FC and of N_r r_r (float32; 4 bytes x nodes^2 each), i.e.,
+# 16 bytes x nodes^2 in total; + 4 bytes x nodes^2 per run with keepRunCross=True; + 4 bytes x nodes^2 per FC output
+# (.npy). For 91282 grayordinates: 8 bytes x nodes^2 = 67 GB, so ~133 GB of accumulators per participant (any number
+# of runs), plus 33 GB per output / kept run. For 400 parcels: ~2.6 MB in total.
+
+################################################
+# IMPORTS
+import os
+import json
+import numpy as np
+import precision_utils # see precision_utils.py
+import censoring_utils # see censoring_utils.py
+
+concatModes = ['demean','none','zscore']
+
+################################################
+# Accumulator
+class FCAccumulator:
+    '''
+    INPUTS:
+        numNodes  : REQUIRED. Number of rows (regions or grayordinates) of every run.
+        storeDir  : OPTIONAL. Directory for on-disk (memmap) accumulators and state; required for dense data.
+        blockSize    : OPTIONAL. Rows per block for products / normalizations; default 2000.
+        keepRunCross : OPTIONAL. Boolean; keep each run's cross-products (float32; 4 bytes x nodes^2 per run) so that
+                       run_fc can be called after the run was added. Default False (per-run FC can still be written
+                       while the run is added; see add_run).
+    '''
+    def __init__(self,numNodes,storeDir=None,blockSize=2000,keepRunCross=False):
+        self.numNodes = numNodes
+        self.storeDir = storeDir
+        self.blockSize = blockSize
+        self.keepRunCross = keepRunCross
+        self.runNames = []
+        self.runN = []
+        self.runSums = []
+        self.runCross = []
+        if storeDir is not None and not os.path.isdir(storeDir):
+            os.makedirs(storeDir)
+        self.sumCross = self._new_matrix('sumCross')
+        self.sumFisherZ = self._new_matrix('sumFisherZ',dtype=np.float32)
+        self.sumWeightedFC = self._new_matrix('sumWeightedFC',dtype=np.float32)
+
+    ################################################
+    # Storage helpers
+    def _new_matrix(self,nameHere,mode='w+',dtype=np.float64):
+        if self.storeDir is None:
+            return np.zeros((self.numNodes,self.numNodes),dtype=dtype)
+        if mode=='r+':
+            return np.load(os.path.join(self.storeDir,nameHere + '.npy'),mmap_mode='r+')
+        return np.lib.format.open_memmap(os.path.join(self.storeDir,nameHere + '.npy'),mode=mode,dtype=dtype,shape=(self.numNodes,self.numNodes))
+
+    def _blocks(self):
+        for startIx in range(0,self.numNodes,self.blockSize):
+            yield slice(startIx,min(startIx+self.blockSize,self.numNodes))
+
+    def save_state(self):
+        '''Saves run names, N and row sums (the nodes x nodes accumulators are already on disk) to <storeDir>/state.json.'''
+        if self.storeDir is None:
+            return
+        for matrixHere in [self.sumCross,self.sumFisherZ,self.sumWeightedFC] + self.runCross:
+            matrixHere.flush()
+        np.save(os.path.join(self.storeDir,'runSums.npy'),np.array(self.runSums).reshape(len(self.runSums),self.numNodes))
+        with open(os.path.join(self.storeDir,'state.json'),'w') as fileHere:
+            json.dump({'numNodes':self.numNodes,'blockSize':self.blockSize,'keepRunCross':self.keepRunCross,
+                       'runNames':self.runNames,'runN':self.runN},fileHere)
+
+    @classmethod
+    def load(cls,storeDir):
+        '''Re-opens an accumulator saved in <storeDir> (e.g., to add a late-arriving run).'''
+        with open(os.path.join(storeDir,'state.json')) as fileHere:
+            stateHere = json.load(fileHere)
+        accumHere = cls.__new__(cls)
+        accumHere.numNodes = stateHere['numNodes']
+        accumHere.storeDir = storeDir
+        accumHere.blockSize = stateHere['blockSize']
+        accumHere.keepRunCross = stateHere['keepRunCross']
+        accumHere.runNames = stateHere['runNames']
+        accumHere.runN = stateHere['runN']
+        accumHere.runSums = list(np.load(os.path.join(storeDir,'runSums.npy')))
+        accumHere.sumCross = accumHere._new_matrix('sumCross',mode='r+')
+        accumHere.sumFisherZ = accumHere._new_matrix('sumFisherZ',mode='r+')
+        accumHere.sumWeightedFC = accumHere._new_matrix('sumWeightedFC',mode='r+')
+        if accumHere.keepRunCross:
+            accumHere.runCross = [accumHere._new_matrix('runCross_' + runName,mode='r+') for runName in accumHere.runNames]
+        else:
+            accumHere.runCross = []
+        return accumHere
+
+    ################################################
+    # Adding runs
+    def add_run(self,dataHere,runName,keepMask=None,runFCFile=None,fillDiagVal=np.nan):
+        '''
+        Adds 1 run: dataHere is nodes x TRs (no NaNs). keepMask (optional; per-TR, True = retained) restricts the run's
+        statistics to retained frames (see censoring_utils.py). runFCFile (optional; .npy): the run's pearson FC is
+        written here as the run is added (float32, diagonal = fillDiagVal).
+        '''
+        if dataHere.shape[0]!=self.numNodes:
+            print(f"ERROR: run {runName} has {dataHere.shape[0]} rows, expected {self.numNodes}; run not added.")
+            return
+        if runName in self.runNames:
+            print(f"ERROR: run {runName} was already added; run not added.")
+            return
+
+        # Retained frames, centered (float64); 1 copy of the run's timeseries
+        if keepMask is not None:
+            segmentList = censoring_utils.kept_segments(keepMask)
+            dataHere = np.concatenate([dataHere[:,segmentHere] for segmentHere in segmentList],axis=1)
+        numFrames = dataHere.shape[1]
+        rowSums = np.sum(dataHere,axis=1,dtype=np.float64)
+        dataCentered = np.asarray(dataHere,dtype=np.float64) - (rowSums/numFrames)[:,None]
+        rowNorms = np.sqrt(np.sum(dataCentered**2,axis=1))
+
+        runCross = self._new_matrix('runCross_' + runName,dtype=np.float32) if self.keepRunCross else None
+        runFC = None if runFCFile is None else self._output_matrix(runFCFile)
+        for blockHere in self._blocks():
+            crossBlock = np.matmul(dataCentered[blockHere],dataCentered.T)
+            if runCross is not None:
+                runCross[blockHere] = crossBlock
+            self.sumCross[blockHere] += crossBlock
+            with np.errstate(divide='ignore',invalid='ignore'):
+                fcBlock = crossBlock / np.outer(rowNorms[blockHere],rowNorms)
+            if runFC is not None:
+                runFC[blockHere] = fcBlock
+            self.sumWeightedFC[blockHere] += numFrames*fcBlock
+            self.sumFisherZ[blockHere] += np.arctanh(np.clip(fcBlock,-1+1e-7,1-1e-7))
+        if runFC is not None:
+            self._finish(runFC,fillDiagVal)
+
+        self.runNames.append(runName)
+        self.runN.append(int(numFrames))
+        self.runSums.append(rowSums)
+        if runCross is not None:
+            self.runCross.append(runCross)
+        self.save_state()
+
+    def add_run_from_file(self,inputDataFile,runName,flipDims=False,keepMask=None,precision='float64'):
+        '''add_run from a .npy / .ptseries.nii / .dtseries.nii file; flipDims=True for TRs x nodes (HCP cifti) files.'''
+        dataHere = precision_utils.load_data(inputDataFile,precision=precision)
+        if flipDims:
+            dataHere = dataHere.T
+        self.add_run(dataHere,runName,keepMask=keepMask)
+
+    ################################################
+    # FC outputs (blockwise; written to outputFile as .npy if given)
+    def _output_matrix(self,outputFile):
+        if outputFile is None:
+            return np.zeros((self.numNodes,self.numNodes),dtype=np.float32)
+        return np.lib.format.open_memmap(outputFile,mode='w+',dtype=np.float32,shape=(self.numNodes,self.numNodes))
+
+    def _finish(self,fcOut,fillDiagVal):
+        for blockHere in self._blocks():
+            blockIxs = np.arange(blockHere.start,blockHere.stop)
+            fcOut[blockIxs,blockIxs] = fillDiagVal
+        if isinstance(fcOut,np.memmap):
+            fcOut.flush()
+        return fcOut
+
+    def run_fc(self,runName,outputFile=None,fillDiagVal=np.nan):
+        '''Per-run pearson FC (needs keepRunCross=True; otherwise, use add_run's runFCFile).'''
+        if not self.keepRunCross:
+            print(f"ERROR: per-run cross-products were not kept (keepRunCross=False); FC for run {runName} not computed.")
+            return None
+        runCross = self.runCross[self.runNames.index(runName)]
+        rowNorms = np.sqrt(np.diag(runCross))
+        fcOut = self._output_matrix(outputFile)
+        for blockHere in self._blocks():
+            with np.errstate(divide='ignore',invalid='ignore'):
+                fcOut[blockHere] = runCross[blockHere] / np.outer(rowNorms[blockHere],rowNorms)
+        return self._finish(fcOut,fillDiagVal)
+
+    def concatenated_fc(self,concatMode='demean',outputFile=None,fillDiagVal=np.nan):
+        '''Pearson FC over all runs' frames, concatenated; see notes at top of script for <concatMode>.'''
+        if concatMode not in concatModes:
+            print(f"WARNING: concatMode {concatMode} not recognized (options: {concatModes}); using 'demean'.")
+            concatMode = 'demean'
+        fcOut = self._output_matrix(outputFile)
+
+        if concatMode=='zscore':
+            # Each z-scored run contributes N_r r_r to the concatenated cross-products, and N_r to each row's norm^2
+            totalN = np.sum(self.runN)
+            for blockHere in self._blocks():
+                fcOut[blockHere] = self.sumWeightedFC[blockHere] / totalN
+            return self._finish(fcOut,fillDiagVal)
+
+        if concatMode=='none':
+            # Rank-(runs) correction for differences between run means: sum_r N_r m_r m_r' - N m m'
+            runMeans = np.array([sumsHere/nHere for sumsHere,nHere in zip(self.runSums,self.runN)]) # runs x nodes
+            totalN = np.sum(self.runN)
+            grandMean = np.sum(self.runSums,axis=0)/totalN
+            meanDeviations = (runMeans - grandMean) * np.sqrt(np.array(self.runN))[:,None] # runs x nodes
+            diagHere = np.diag(self.sumCross) + np.sum(meanDeviations**2,axis=0)
+        else:
+            diagHere = np.diag(self.sumCross).copy()
+
+        rowNorms = np.sqrt(diagHere)
+        for blockHere in self._blocks():
+            crossBlock = np.array(self.sumCross[blockHere])
+            if concatMode=='none':
+                crossBlock += np.matmul(meanDeviations[:,blockHere].T,meanDeviations)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                fcOut[blockHere] = crossBlock / np.outer(rowNorms[blockHere],rowNorms)
+        return self._finish(fcOut,fillDiagVal)
+
+    def run_averaged_fc(self,outputFile=None,returnFisherZ=True,fillDiagVal=np.nan):
+        '''Mean of per-run Fisher-z FC (returnFisherZ=False: back-transformed to r with tanh).'''
+        fcOut = self._output_matrix(outputFile)
+        for blockHere in self._blocks():
+            zBlock = self.sumFisherZ[blockHere] / len(self.runNames)
+            fcOut[blockHere] = zBlock if returnFisherZ else np.tanh(zBlock)
+        return self._finish(fcOut,fillDiagVal)
+
+################################################
+# File-level wrapper (fcEstimation.py naming)
+def aggregate_fc_runs(inputDataFileList,runNameList,outputPath,subjID,extraSaveStr='',storeDir=None,flipDims=False,
+                      keepMaskList=None,concatMode='demean',saveRunFC=True,precision='float64',verbose=True):
+    '''
+    INPUTS:
+        inputDataFileList : REQUIRED. List of timeseries files (1 per run; nodes x TRs, or TRs x nodes with flipDims=True).
+        runNameList       : REQUIRED. List of run names (used in output file names).
+        outputPath        : REQUIRED. A string; full output path to save results.
+        subjID            : REQUIRED. A string; participant ID as used throughout study.
+        extraSaveStr      : OPTIONAL. A string; suffix for output file names (e.g., parcellation).
+        storeDir          : OPTIONAL. Directory for on-disk accumulators (use for dense data). If it already holds an
+                            accumulator, only runs not yet in it are added (late-arriving runs).
+        keepMaskList      : OPTIONAL. List of per-TR keep-masks (or None), 1 per run (see censoring_utils.py).
+        concatMode        : OPTIONAL. 'demean' (default), 'none', or 'zscore'; see notes at top of script.
+        saveRunFC         : OPTIONAL. Boolean; also save per-run FC (default True), written as each run is added (runs
+                            already in <storeDir> are not re-written).
+        precision         : OPTIONAL. 'float64' (default) or 'float32'; precision the timeseries are loaded in (see
+                            precision_utils.py). Accumulation is always float64.
+
+    OUTPUTS (float32 .npy, diagonal = NaN):
+        ~/<outputPath>/FC_<subjID>_pearson_Concatenated<extraSaveStr>.npy
+        ~/<outputPath>/FC_<subjID>_pearson_RunAveragedFisherZ<extraSaveStr>.npy
+        ~/<outputPath>/FC_<subjID>_pearson_<runName><extraSaveStr>.npy (if saveRunFC)
+    '''
+    if storeDir is not None and os.path.isfile(os.path.join(storeDir,'state.json')):
+        fcAccum = FCAccumulator.load(storeDir)
+        if verbose:
+            print(f"Loaded accumulator with runs: {fcAccum.runNames}")
+    else:
+        fcAccum = None
+
+    outputBase = outputPath + 'FC_' + subjID + '_pearson_'
+    for runIx,(inputDataFile,runName) in enumerate(zip(inputDataFileList,runNameList)):
+        if fcAccum is not None and runName in fcAccum.runNames:
+            continue
+        keepMask = None if keepMaskList is None else keepMaskList[runIx]
+        dataHere = precision_utils.load_data(inputDataFile,precision=precision)
+        if flipDims:
+            dataHere = dataHere.T
+        if fcAccum is None:
+            fcAccum = FCAccumulator(dataHere.shape[0],storeDir=storeDir)
+        if verbose:
+            print(f"Adding run {runName} ({dataHere.shape[0]} nodes x {dataHere.shape[1]} TRs)...")
+        runFCFile = outputBase + runName + extraSaveStr + '.npy' if saveRunFC else None
+        fcAccum.add_run(dataHere,runName,keepMask=keepMask,runFCFile=runFCFile)
+        del dataHere
+
+    if fcAccum is None:
+        print(f"ERROR: no runs given for {subjID} (and no existing accumulator in storeDir); FC not estimated.")
+        return None
+
+    fcAccum.concatenated_fc(concatMode=concatMode,outputFile=outputBase + 'Concatenated' + extraSaveStr + '.npy')
+    fcAccum.run_averaged_fc(outputFile=outputBase + 'RunAveragedFisherZ' + extraSaveStr + '.npy')
+    return fcAccum
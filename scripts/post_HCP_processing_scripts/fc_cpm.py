@@ -0,0 +1,282 @@
+# C. Cocuzza, 2023. Connectome-based predictive modeling (CPM) of behavioural scores from FC edges, with fast
+# cross-validation and permutation testing.
+
+# CPM (Shen et al., 2017): in each training fold, every edge is correlated with the behavioural score; edges with
+# p < <pThreshold> (positive and negative separately) are selected; each participant's "network strength" is the sum
+# of their selected edges; a linear model (score ~ strength) is fit on the training fold and applied to the test fold.
+# Models: 'positive' (positive edges), 'negative' (negative edges), 'combined' (positive - negative strength).
+
+# Speed-ups (participants x edges FC, e.g., 240 x ~500k):
+# (1) Edge-behaviour correlations from cached sufficient statistics. Sums, sums of squares, and the edges x scores
+#     cross-product X'y are computed once over all participants (1 matrix product). The training fold's statistics
+#     are those minus the test participants' contributions (a rank-one downdate for leave-one-out; rank-<fold size>
+#     for k-fold), so each fold costs O(test participants x edges) instead of O(participants x edges).
+# (2) Permutation nulls are columns: the observed score and <numPermutations> permuted scores form 1 participants x
+#     (1 + permutations) matrix, so all permutations share the same matrix products and fold downdates (in chunks of
+#     <permChunkSize> columns). The same folds are used for all permutations.
+# (3) Network strengths are sparse products: the selection masks (columns x edges) are sparse (under the null, ~
+#     pThreshold of edges are selected), so strengths cost O(selected edges x participants), not O(edges x participants).
+# (4) Edge selection without square roots or divisions of columns x edges arrays: with numerator
+#     n = N sum(xy) - sum(x) sum(y) and var(.) = N sum(.^2) - sum(.)^2, r > rCrit is n / sqrt(var(y)) > rCrit sqrt(var(x)),
+#     i.e., each score column is scaled by 1 number and compared with 1 edge vector (r < -rCrit: < -rCrit sqrt(var(x))).
+#     The fold downdate and the sum(x) sum(y) term are 1 matrix product: n/N = sum(xy) - [y_test', sum(y)/N] [x_test; sum(x)].
+#     Selected (column, edge) pairs come from np.flatnonzero of the C-ordered columns x edges comparison, which is
+#     already the sparse (CSR) mask layout.
+# (5) Folds are run in parallel (threads; the large numpy operations release the GIL). Each worker holds 1 float64 and
+#     1 boolean <permChunkSize> x edges array, re-used across its folds (e.g., 500k edges x 50 columns: ~0.25 GB), so memory
+#     scales with <numWorkers>.
+# Inputs are centered once over all participants (correlations do not change), which keeps the downdated sums accurate.
+
+# Shen, X., Finn, E. S., Scheinost, D., Rosenberg, M. D., Chun, M. M., Papademetris, X., & Constable, R. T. (2017). Using connectome-based predictive modeling to predict individual behavior from brain connectivity. Nature Protocols, 12(3), 506–518. https://doi.org/10.1038/nprot.2016.178
+
+# Finn, E. S., Shen, X., Scheinost, D., Rosenberg, M. D., Huang, J., Chun, M. M., Papademetris, X., & Constable, R. T. (2015). Functional connectome fingerprinting: Identifying individuals using patterns of brain connectivity. Nature Neuroscience, 18(11), 1664–1671. https://doi.org/10.1038/nn.4135
+
+################################################
+# IMPORTS
+import csv
+import numpy as np
+from scipy import stats
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+
+cpmModels = ['positive','negative','combined']
+
+################################################
+# Helpers
+def make_folds(numSubj,kFolds=None,seed=0):
+    '''List of test-participant index arrays; kFolds=None is leave-one-out.'''
+    if kFolds is None or kFolds>=numSubj:
+        return [np.array([subjIx]) for subjIx in range(numSubj)]
+    permIxs = np.random.default_rng(seed).permutation(numSubj)
+    return [np.sort(foldIxs) for foldIxs in np.array_split(permIxs,kFolds)]
+
+def r_threshold(pThreshold,numSubj):
+    '''Pearson r corresponding to a 2-sided p-value of <pThreshold> with <numSubj> participants.'''
+    tCrit = stats.t.ppf(1-pThreshold/2,numSubj-2)
+    return tCrit/np.sqrt(numSubj-2+tCrit**2)
+
+def _fit_predict(strengthTrain,scoreTrain,strengthTest):
+    '''Least-squares fit of score ~ strength per column (training participants x columns); predictions for test participants.'''
+    strengthMean = strengthTrain.mean(axis=0)
+    scoreMean = scoreTrain.mean(axis=0)
+    strengthCentered = strengthTrain - strengthMean
+    with np.errstate(divide='ignore',invalid='ignore'):
+        slopeHere = np.sum(strengthCentered*(scoreTrain-scoreMean),axis=0)/np.sum(strengthCentered**2,axis=0)
+    slopeHere = np.nan_to_num(slopeHere) # no edges selected: predict the training mean
+    return scoreMean + slopeHere*(strengthTest - strengthMean)
+
+def _selection_masks(numerScaled,edgeThresh,maskBuffer,dtype):
+    '''
+    Sparse (columns x edges, CSR) positive and negative selection masks, numerScaled > edgeThresh and numerScaled <
+    -edgeThresh (columns x edges vs. edges; see note 4 at top of script). maskBuffer is a boolean columns x edges buffer.
+    '''
+    numCols,numEdges = numerScaled.shape
+    maskList = []
+    for signHere in [1,-1]:
+        if signHere==1:
+            np.greater(numerScaled,edgeThresh,out=maskBuffer)
+        else:
+            np.less(numerScaled,-edgeThresh,out=maskBuffer)
+        flatIxs = np.flatnonzero(maskBuffer)
+        rowPointers = np.searchsorted(flatIxs,np.arange(numCols+1)*numEdges)
+        maskList.append(sparse.csr_matrix((np.ones(flatIxs.shape[0],dtype=dtype),flatIxs%numEdges,rowPointers),
+                                          shape=(numCols,numEdges)))
+    return maskList
+
+def _corr_columns(predHere,scoreHere):
+    '''Pearson r between matching columns of 2 participants x columns arrays.'''
+    predCentered = predHere - predHere.mean(axis=0)
+    scoreCentered = scoreHere - scoreHere.mean(axis=0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.sum(predCentered*scoreCentered,axis=0)/np.sqrt(np.sum(predCentered**2,axis=0)*np.sum(scoreCentered**2,axis=0))
+
+################################################
+# Main function
+def cpm(fcEdges,behavScore,pThreshold=0.01,kFolds=None,numPermutations=0,permChunkSize=50,numWorkers=4,seed=0,verbose=False):
+    '''
+    INPUTS:
+        fcEdges         : REQUIRED. A numpy array, participants x edges (e.g., upper-triangle FC from fcEstimation.py; float32 is fine).
+        behavScore      : REQUIRED. A numpy array of behavioural scores, 1 per participant (e.g., a PCA component).
+        pThreshold      : OPTIONAL. Edge selection threshold (2-sided p-value of the edge-behaviour correlation); default 0.01.
+        kFolds          : OPTIONAL. Number of cross-validation folds; default None (leave-one-out).
+        numPermutations : OPTIONAL. Number of permutations of behavScore for null distributions; default 0 (none).
+        permChunkSize   : OPTIONAL. Score columns (observed + permutations) per batch (memory ~ edges x permChunkSize x 8 bytes x a few).
+        numWorkers      : OPTIONAL. Number of threads, each running a share of the folds; default 4. Memory scales with this (see notes at top of script).
+        seed            : OPTIONAL. Seed for folds and permutations.
+        verbose         : OPTIONAL. Boolean; if True, will print extra info.
+
+    OUTPUT:
+        cpmDict : A dictionary:
+                  'predicted_<model>'    : participants; cross-validated predictions (<model> = positive, negative, combined)
+                  'r_<model>'            : correlation between predicted and observed scores
+                  'null_r_<model>'       : permutations; null distribution of r (if numPermutations > 0)
+                  'p_<model>'            : permutation p-value, (1 + #null >= observed) / (1 + permutations)
+                  'edge_freq_positive'   : edges; fraction of folds in which each edge was selected (positive)
+                  'edge_freq_negative'   : edges; same, negative edges
+                  'r_threshold'          : r threshold used for edge selection (training fold size of the 1st fold)
+    '''
+    numSubj,numEdges = fcEdges.shape
+    behavScore = np.asarray(behavScore,dtype=np.float64).reshape(-1)
+    if behavScore.shape[0]!=numSubj:
+        print(f"ERROR: {behavScore.shape[0]} scores for {numSubj} participants; aborting.")
+        return None
+    if np.any(np.isnan(behavScore)) or np.any(np.isnan(fcEdges)):
+        print(f"ERROR: NaNs in fcEdges or behavScore; remove those participants / edges first; aborting.")
+        return None
+
+    rng = np.random.default_rng(seed)
+    foldList = make_folds(numSubj,kFolds=kFolds,seed=seed)
+    if verbose:
+        print(f"CPM: {numSubj} participants x {numEdges} edges; {len(foldList)} folds; {numPermutations} permutations.")
+
+    # Centered edges (once) and their cached sufficient statistics
+    fcCentered = fcEdges - fcEdges.mean(axis=0,dtype=np.float64).astype(fcEdges.dtype)
+    fcCenteredT = np.ascontiguousarray(fcCentered.T) # edges x participants, for the sparse strength products
+    sumX = fcCentered.sum(axis=0,dtype=np.float64)
+    sumXX = np.einsum('se,se->e',fcCentered,fcCentered,dtype=np.float64)
+    foldSumX = [fcCentered[testIxs].sum(axis=0,dtype=np.float64) for testIxs in foldList]
+    foldSumXX = [np.einsum('se,se->e',fcCentered[testIxs],fcCentered[testIxs],dtype=np.float64) for testIxs in foldList]
+
+    # Score columns: observed, then permutations
+    scoreCols = [behavScore - behavScore.mean()] + [rng.permutation(behavScore - behavScore.mean()) for permIx in range(numPermutations)]
+    scoreCols = np.stack(scoreCols,axis=1) # participants x (1 + permutations)
+
+    predDict = {modelName:np.zeros(scoreCols.shape) for modelName in cpmModels}
+    edgeFreq = {'positive':np.zeros(numEdges),'negative':np.zeros(numEdges)}
+    rCritList = [r_threshold(pThreshold,numSubj-testIxs.shape[0]) for testIxs in foldList]
+
+    def run_folds(foldIxList,scoreChunk,sumXY,sumY,sumYY,colSlice):
+        '''
+        Folds <foldIxList> for 1 chunk of score columns: edge selection, strengths, and test predictions (written to
+        predDict). Returns the edges selected for the observed scores (column 0) per fold.
+        '''
+        # Per-worker buffers, re-used across folds (new edges x columns arrays per fold cost more than the arithmetic)
+        numerBuffer = np.empty(sumXY.shape)
+        maskBuffer = np.empty(sumXY.shape,dtype=bool)
+        selectedEdges = []
+        for foldIx in foldIxList:
+            testIxs = foldList[foldIx]
+            trainIxs = np.setdiff1d(np.arange(numSubj),testIxs)
+            numTrain = trainIxs.shape[0]
+
+            # Training statistics = all participants - test participants (downdate)
+            sumX_Tr = sumX - foldSumX[foldIx]
+            sumXX_Tr = sumXX - foldSumXX[foldIx]
+            sumY_Tr = sumY - scoreChunk[testIxs].sum(axis=0)
+            sumYY_Tr = sumYY - np.sum(scoreChunk[testIxs]**2,axis=0)
+
+            # Correlation numerator / numTrain (columns x edges), scaled per column; edge thresholds (see note 4 at top of script)
+            downdateLeft = np.hstack((scoreChunk[testIxs].T,(sumY_Tr/numTrain)[:,None])) # columns x (test participants + 1)
+            downdateRight = np.vstack((fcCentered[testIxs],sumX_Tr[None,:]))
+            np.matmul(-downdateLeft,downdateRight,out=numerBuffer)
+            numerBuffer += sumXY
+            varX = np.maximum(numTrain*sumXX_Tr - sumX_Tr**2,0)
+            varY = numTrain*sumYY_Tr - sumY_Tr**2
+            with np.errstate(divide='ignore',invalid='ignore'):
+                numerBuffer *= (1/np.sqrt(varY/numTrain))[:,None]
+            edgeThresh = rCritList[foldIx]*np.sqrt(varX/numTrain)
+            posMask,negMask = _selection_masks(numerBuffer,edgeThresh,maskBuffer,fcCentered.dtype)
+
+            # Network strengths (sparse products), fit on training participants, predict test participants
+            posStrength = np.asarray(posMask @ fcCenteredT,dtype=np.float64).T # participants x columns
+            negStrength = np.asarray(negMask @ fcCenteredT,dtype=np.float64).T
+            for modelName,strengthHere in zip(cpmModels,[posStrength,negStrength,posStrength-negStrength]):
+                predDict[modelName][testIxs,colSlice] = _fit_predict(strengthHere[trainIxs],scoreChunk[trainIxs],strengthHere[testIxs])
+            selectedEdges.append((posMask[0].indices,negMask[0].indices))
+        return selectedEdges
+
+    workerFolds = [foldIxs for foldIxs in np.array_split(np.arange(len(foldList)),max(numWorkers,1)) if foldIxs.shape[0]>0]
+    with ThreadPoolExecutor(max_workers=len(workerFolds)) as executor:
+        for chunkStart in range(0,scoreCols.shape[1],permChunkSize):
+            scoreChunk = scoreCols[:,chunkStart:chunkStart+permChunkSize]
+            numCols = scoreChunk.shape[1]
+            sumXY = np.asarray(scoreChunk.T.astype(fcCentered.dtype) @ fcCentered,dtype=np.float64) # columns x edges (1 matrix product)
+            sumY = scoreChunk.sum(axis=0)
+            sumYY = np.sum(scoreChunk**2,axis=0)
+            colSlice = slice(chunkStart,chunkStart+numCols)
+
+            futuresList = [executor.submit(run_folds,foldIxs,scoreChunk,sumXY,sumY,sumYY,colSlice) for foldIxs in workerFolds]
+            for futureHere in futuresList:
+                for posEdges,negEdges in futureHere.result():
+                    if chunkStart==0:
+                        edgeFreq['positive'][posEdges] += 1
+                        edgeFreq['negative'][negEdges] += 1
+
+            if verbose:
+                print(f"Done with score columns {chunkStart}-{chunkStart+numCols-1} of {scoreCols.shape[1]}...")
+
+    rCritFirst = rCritList[0]
+    cpmDict = {'r_threshold':rCritFirst,
+               'edge_freq_positive':edgeFreq['positive']/len(foldList),
+               'edge_freq_negative':edgeFreq['negative']/len(foldList)}
+    for modelName in cpmModels:
+        rAll = _corr_columns(predDict[modelName],scoreCols)
+        cpmDict['predicted_' + modelName] = predDict[modelName][:,0] + behavScore.mean()
+        cpmDict['r_' + modelName] = rAll[0]
+        if numPermutations>0:
+            cpmDict['null_r_' + modelName] = rAll[1:]
+            cpmDict['p_' + modelName] = (1 + np.sum(rAll[1:]>=rAll[0]))/(1 + numPermutations)
+        if verbose:
+            print(f"{modelName}: r = {rAll[0]:.3f}" + (f", p = {cpmDict['p_' + modelName]:.4f}" if numPermutations>0 else ''))
+    return cpmDict
+
+################################################
+# Wrapper for FC files saved by fcEstimation.py and a behavioural scores table
+def load_behaviour_scores(behaviourFile,subjIDList,subjIDColumn='subjID',scoreColumns=None):
+    '''
+    Scores (participants x scores, in the order of <subjIDList>) from a .csv table with a header row (e.g., PCA
+    component scores written out from behavioural_analyses/PCA_on_clean_imputed_behavioural_data.Rmd). Participants
+    not in the table get NaN. Returns (scores array, score column names).
+    '''
+    with open(behaviourFile,newline='') as fileHere:
+        rowList = list(csv.DictReader(fileHere))
+    if scoreColumns is None:
+        scoreColumns = [columnName for columnName in rowList[0].keys() if columnName not in [subjIDColumn,'']]
+    rowDict = {rowHere[subjIDColumn]:rowHere for rowHere in rowList}
+    scoresHere = np.full((len(subjIDList),len(scoreColumns)),np.nan)
+    for subjIx,subjID in enumerate(subjIDList):
+        if subjID not in rowDict:
+            print(f"WARNING: {subjID} not found in {behaviourFile}; scores set to NaN.")
+            continue
+        for scoreIx,columnName in enumerate(scoreColumns):
+            valueHere = rowDict[subjID][columnName]
+            scoresHere[subjIx,scoreIx] = float(valueHere) if valueHere not in ['','NA'] else np.nan
+    return scoresHere,scoreColumns
+
+def cpm_from_files(fcFileList,subjIDList,behaviourFile,outputPath,extraSaveStr='',subjIDColumn='subjID',scoreColumns=None,
+                   pThreshold=0.01,kFolds=None,numPermutations=0,seed=0,verbose=True):
+    '''
+    INPUTS:
+        fcFileList    : REQUIRED. A list of FC .npy files (nodes x nodes; e.g., from fcEstimation), 1 per participant.
+        subjIDList    : REQUIRED. A list of participant IDs, matching fcFileList and the <subjIDColumn> of behaviourFile.
+        behaviourFile : REQUIRED. A .csv of behavioural scores (see load_behaviour_scores); each score column is modeled separately.
+        outputPath    : REQUIRED. A string; full output path to save results.
+        extraSaveStr  : OPTIONAL. A string; suffix to specify things like: pipeline stage, parcellation, etc.
+        Remaining inputs: see load_behaviour_scores and cpm. Participants with a missing (NaN) score are left out of that score's model.
+
+    OUTPUT:
+        Saves result per score column as: ~/<outputPath>/"CPM_<scoreColumn><extraSaveStr>.npz" (keys: see cpm, plus
+        'subjIDs' used and 'edgeIxs': 2 x edges node indices, upper triangle with k=1, as np.triu_indices).
+    '''
+    edgeIxs = None
+    fcEdges = None
+    for subjIx,fcFile in enumerate(fcFileList):
+        fcHere = np.load(fcFile)
+        if edgeIxs is None:
+            edgeIxs = np.triu_indices(fcHere.shape[0],k=1)
+            fcEdges = np.zeros((len(fcFileList),edgeIxs[0].shape[0]),dtype=np.float32)
+        fcEdges[subjIx] = fcHere[edgeIxs]
+
+    scoresHere,scoreColumns = load_behaviour_scores(behaviourFile,subjIDList,subjIDColumn=subjIDColumn,scoreColumns=scoreColumns)
+    cpmResults = {}
+    for scoreIx,columnName in enumerate(scoreColumns):
+        isValid = ~np.isnan(scoresHere[:,scoreIx])
+        if verbose:
+            print(f"CPM for {columnName} ({np.sum(isValid)} participants)...")
+        cpmDict = cpm(fcEdges[isValid],scoresHere[isValid,scoreIx],pThreshold=pThreshold,kFolds=kFolds,
+                      numPermutations=numPermutations,seed=seed,verbose=verbose)
+        if cpmDict is not None:
+            outputFileHere = outputPath + 'CPM_' + columnName + extraSaveStr + '.npz'
+            np.savez(outputFileHere,subjIDs=np.asarray(subjIDList)[isValid],edgeIxs=np.asarray(edgeIxs),**cpmDict)
+        cpmResults[columnName] = cpmDict
+    return cpmResults
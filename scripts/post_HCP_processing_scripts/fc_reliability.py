@@ -0,0 +1,205 @@
+# C. Cocuzza, 2023. Edge-wise test-retest reliability (ICC) of FC across repeated runs, for all edges at once.
+
+# Input: a subjects x runs x edges array (e.g., upper-triangle FC edges from fcEstimation.py, for the 4 rest runs or the
+# Stroop AP/PA runs); missing runs (or edges) are NaN. For each edge, the additive two-way model
+#     y_ij = mu + subject_i + run_j + error_ij
+# is fit with variance components estimated by the method of fitting constants (Henderson method III), which handles
+# missing runs (unbalanced data) and reduces to the usual two-way ANOVA mean squares when no runs are missing, i.e.:
+#   ICC(2,1) = var_subject / (var_subject + var_run + var_error)   (absolute agreement; random runs)
+#   ICC(3,1) = var_subject / (var_subject + var_error)             (consistency; fixed runs)
+# (McGraw & Wong, 1996; Shrout & Fleiss, 1979). Negative variance component estimates are kept (not truncated), as in
+# the usual ANOVA-based ICC formulas, so ICC values can be negative.
+
+# Every quantity is a (weighted) sum over subjects of a few per-subject statistics (run values, run sums, sums of
+# squares), so all edges are done with a handful of matrix products; the only per-model (not per-edge) operation is
+# the pseudo-inverse of a runs x runs matrix. Edges are grouped by missingness pattern (usually just 1 pattern: a run
+# missing for a participant is missing for all edges).
+
+# Bootstrap confidence intervals: participants are resampled with replacement. A resample is a vector of counts
+# (how many times each participant was drawn); the per-subject statistics weighted by these counts give every
+# resample's fit, so all resamples are done at once as (resamples x subjects) @ (subjects x edges) matrix products,
+# in chunks of <edgeChunkSize> edges. Percentile intervals.
+
+# McGraw, K. O., & Wong, S. P. (1996). Forming inferences about some intraclass correlation coefficients. Psychological Methods, 1(1), 30–46. https://doi.org/10.1037/1082-989X.1.1.30
+
+# Shrout, P. E., & Fleiss, J. L. (1979). Intraclass correlations: Uses in assessing rater reliability. Psychological Bulletin, 86(2), 420–428. https://doi.org/10.1037/0033-2909.86.2.420
+
+# Searle, S. R., Casella, G., & McCulloch, C. E. (1992). Variance Components. Wiley. (Chapter 5: Henderson's method III)
+
+# Noble, S., Scheinost, D., & Constable, R. T. (2019). A decade of test-retest reliability of functional connectivity: A systematic review and meta-analysis. NeuroImage, 203, 116157. https://doi.org/10.1016/j.neuroimage.2019.116157
+
+################################################
+# IMPORTS
+import os
+import numpy as np
+
+################################################
+# Per-subject statistics and variance components
+def _subject_stats(dataHere,obsMask):
+    '''Per-subject statistics for 1 missingness pattern; dataHere: subjects x runs x edges, obsMask: subjects x runs.'''
+    dataZeroed = np.where(obsMask[:,:,None],dataHere,0).astype(np.float64)
+    numRunsSubj = obsMask.sum(axis=1)
+    numRunsSafe = np.maximum(numRunsSubj,1)[:,None]
+    subjSums = dataZeroed.sum(axis=1) # subjects x edges
+    statsDict = {'sumSq':np.sum(dataZeroed**2,axis=1),
+                 'subjSumSqOverN':subjSums**2/numRunsSafe,
+                 'runValues':dataZeroed, # subjects x runs x edges
+                 'runSubjMeans':obsMask[:,:,None]*(subjSums/numRunsSafe)[:,None,:],
+                 'isValid':(numRunsSubj>0).astype(np.float64),
+                 'numRunsSubj':numRunsSubj.astype(np.float64),
+                 'obsMask':obsMask.astype(np.float64)}
+    # Reduced (run effects, subjects absorbed) normal-equation matrix per subject: diag(o_i) - o_i o_i' / n_i
+    obsHere = statsDict['obsMask']
+    statsDict['runMatrix'] = (obsHere[:,:,None]*np.eye(obsHere.shape[1])[None]) - (obsHere[:,:,None]*obsHere[:,None,:])/numRunsSafe[:,:,None]
+    return statsDict
+
+def _variance_components(statsDict,subjWeights):
+    '''
+    Fits of the additive subjects + runs model for each row of subjWeights (resamples x subjects; counts), all edges at once.
+    Returns a dictionary of resamples x edges arrays (var_subject, var_run, var_error, icc21, icc31, and mean squares).
+    '''
+    numSubj,numRuns,numEdges = statsDict['runValues'].shape
+    numResamples = subjWeights.shape[0]
+
+    sumSq = subjWeights @ statsDict['sumSq']
+    sumSubjSqOverN = subjWeights @ statsDict['subjSumSqOverN']
+    runSums = (subjWeights @ statsDict['runValues'].reshape(numSubj,-1)).reshape(numResamples,numRuns,numEdges)
+    runQ = runSums - (subjWeights @ statsDict['runSubjMeans'].reshape(numSubj,-1)).reshape(numResamples,numRuns,numEdges)
+    runCounts = subjWeights @ statsDict['obsMask'] # resamples x runs
+    runMatrix = (subjWeights @ statsDict['runMatrix'].reshape(numSubj,-1)).reshape(numResamples,numRuns,numRuns)
+    numSubjHere = subjWeights @ statsDict['isValid']
+    numObs = subjWeights @ statsDict['numRunsSubj']
+
+    # Residual sums of squares: subjects only, runs only, subjects + runs
+    sse_Subj = sumSq - sumSubjSqOverN
+    with np.errstate(divide='ignore',invalid='ignore'):
+        sse_Run = sumSq - np.sum(np.where(runCounts[:,:,None]>0,runSums**2/runCounts[:,:,None],0),axis=1)
+    runMatrixPinv = np.linalg.pinv(runMatrix)
+    rankRuns = np.linalg.matrix_rank(runMatrix).astype(np.float64)
+    ss_RunGivenSubj = np.einsum('bje,bjl,ble->be',runQ,runMatrixPinv,runQ)
+    sse_Full = sse_Subj - ss_RunGivenSubj
+    ss_SubjGivenRun = sse_Run - sse_Full
+
+    # Degrees of freedom and expected mean square coefficients (Henderson method III)
+    numRunsObs = np.sum(runCounts>0,axis=1).astype(np.float64)
+    df_Error = (numObs - numSubjHere - rankRuns)[:,None]
+    df_Subj = (numSubjHere + rankRuns - numRunsObs)[:,None]
+    df_Run = rankRuns[:,None]
+    coef_Subj = (numObs - numRunsObs)[:,None]/df_Subj
+    coef_Run = np.trace(runMatrix,axis1=1,axis2=2)[:,None]/df_Run
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ms_Error = sse_Full/df_Error
+        ms_Subj = ss_SubjGivenRun/df_Subj
+        ms_Run = ss_RunGivenSubj/df_Run
+        var_Error = ms_Error
+        var_Subj = (ms_Subj - ms_Error)/coef_Subj
+        var_Run = (ms_Run - ms_Error)/coef_Run
+        icc21 = var_Subj/(var_Subj + var_Run + var_Error)
+        icc31 = var_Subj/(var_Subj + var_Error)
+
+    return {'icc21':icc21,'icc31':icc31,'var_subject':var_Subj,'var_run':var_Run,'var_error':var_Error,
+            'ms_subject':ms_Subj,'ms_run':ms_Run,'ms_error':ms_Error}
+
+def _missingness_groups(dataHere):
+    '''List of (subjects x runs observed mask, edge indices), 1 per missingness pattern.'''
+    obsAll = ~np.isnan(dataHere)
+    if np.all(obsAll==obsAll[:,:,:1]):
+        return [(obsAll[:,:,0],np.arange(dataHere.shape[2]))]
+    patternBytes = np.packbits(obsAll.reshape(-1,dataHere.shape[2]),axis=0).T
+    uniquePatterns,patternIxs = np.unique(patternBytes,axis=0,return_inverse=True)
+    groupList = []
+    for patternIx in range(uniquePatterns.shape[0]):
+        edgeIxs = np.where(patternIxs.reshape(-1)==patternIx)[0]
+        groupList.append((obsAll[:,:,edgeIxs[0]],edgeIxs))
+    return groupList
+
+################################################
+# Main function
+def edgewise_icc(dataHere,numBootstrap=0,ciLevel=0.95,edgeChunkSize=5000,seed=0,verbose=False):
+    '''
+    INPUTS:
+        dataHere      : REQUIRED. A numpy array, subjects x runs x edges (or subjects x runs for 1 edge); NaN = missing.
+        numBootstrap  : OPTIONAL. Number of bootstrap resamples (of participants) for confidence intervals; default 0 (none).
+        ciLevel       : OPTIONAL. Confidence level of the percentile intervals; default 0.95.
+        edgeChunkSize : OPTIONAL. Edges per bootstrap chunk (memory ~ numBootstrap x runs x edgeChunkSize x 8 bytes).
+        seed          : OPTIONAL. Seed for the bootstrap resamples (the same resamples are used for every edge).
+        verbose       : OPTIONAL. Boolean; if True, will print extra info.
+
+    OUTPUT:
+        iccDict : A dictionary of numpy arrays (1 value per edge):
+                  'icc21', 'icc31'                         : ICC(2,1) and ICC(3,1)
+                  'var_subject', 'var_run', 'var_error'    : variance components
+                  'ms_subject', 'ms_run', 'ms_error'       : mean squares (subjects and runs adjusted for each other)
+                  'icc21_ci', 'icc31_ci'                   : 2 x edges (lower, upper); only if numBootstrap > 0
+    '''
+    if dataHere.ndim==2:
+        dataHere = dataHere[:,:,None]
+    numSubj,numRuns,numEdges = dataHere.shape
+    if numRuns<2:
+        print(f"ERROR: at least 2 runs are needed for ICC (got {numRuns}); aborting.")
+        return None
+
+    groupList = _missingness_groups(dataHere)
+    if verbose:
+        print(f"{numSubj} participants x {numRuns} runs x {numEdges} edges; {len(groupList)} missingness pattern(s).")
+
+    outKeys = ['icc21','icc31','var_subject','var_run','var_error','ms_subject','ms_run','ms_error']
+    iccDict = {keyHere:np.full(numEdges,np.nan) for keyHere in outKeys}
+    if numBootstrap>0:
+        rng = np.random.default_rng(seed)
+        bootWeights = rng.multinomial(numSubj,np.ones(numSubj)/numSubj,size=numBootstrap).astype(np.float64)
+        ciPercentiles = [100*(1-ciLevel)/2,100*(1+ciLevel)/2]
+        iccDict['icc21_ci'] = np.full((2,numEdges),np.nan)
+        iccDict['icc31_ci'] = np.full((2,numEdges),np.nan)
+
+    for obsMask,groupEdgeIxs in groupList:
+        for chunkStart in range(0,groupEdgeIxs.shape[0],edgeChunkSize):
+            edgeIxs = groupEdgeIxs[chunkStart:chunkStart+edgeChunkSize]
+            statsDict = _subject_stats(dataHere[:,:,edgeIxs],obsMask)
+
+            fitDict = _variance_components(statsDict,np.ones((1,numSubj)))
+            for keyHere in outKeys:
+                iccDict[keyHere][edgeIxs] = fitDict[keyHere][0]
+
+            if numBootstrap>0:
+                bootDict = _variance_components(statsDict,bootWeights)
+                for keyHere in ['icc21','icc31']:
+                    iccDict[keyHere + '_ci'][:,edgeIxs] = np.nanpercentile(bootDict[keyHere],ciPercentiles,axis=0)
+
+    return iccDict
+
+################################################
+# Wrapper for FC files saved by fcEstimation.py
+def edgewise_icc_from_files(fcFileArray,outputPath,extraSaveStr='',numBootstrap=0,ciLevel=0.95,seed=0,verbose=True):
+    '''
+    INPUTS:
+        fcFileArray  : REQUIRED. A list (participants) of lists (runs) of FC .npy files (nodes x nodes; e.g., from fcEstimation).
+                       Missing runs: None (or a file that does not exist). Run order must be the same for all participants.
+        outputPath   : REQUIRED. A string; full output path to save results.
+        extraSaveStr : OPTIONAL. A string; suffix to specify things like: pipeline stage (minProc / FIX / GSR), parcellation, etc.
+        Remaining inputs: see edgewise_icc.
+
+    OUTPUT:
+        Saves result as: ~/<outputPath>/"ICC_Edgewise<extraSaveStr>.npz" (keys: see edgewise_icc, plus 'edgeIxs': 2 x edges
+        node indices of each edge, upper triangle with k=1, as np.triu_indices).
+    '''
+    edgeIxs = None
+    dataHere = None
+    for subjIx,runFileList in enumerate(fcFileArray):
+        for runIx,fcFile in enumerate(runFileList):
+            if fcFile is None or not os.path.isfile(fcFile):
+                if verbose:
+                    print(f"WARNING: participant {subjIx} run {runIx} missing ({fcFile}); treated as missing.")
+                continue
+            fcHere = np.load(fcFile)
+            if edgeIxs is None:
+                edgeIxs = np.triu_indices(fcHere.shape[0],k=1)
+                dataHere = np.full((len(fcFileArray),max(len(runList) for runList in fcFileArray),edgeIxs[0].shape[0]),np.nan,dtype=np.float32)
+            dataHere[subjIx,runIx] = fcHere[edgeIxs]
+
+    iccDict = edgewise_icc(dataHere,numBootstrap=numBootstrap,ciLevel=ciLevel,seed=seed,verbose=verbose)
+    if iccDict is not None:
+        outputFileHere = outputPath + 'ICC_Edgewise' + extraSaveStr + '.npz'
+        np.savez(outputFileHere,edgeIxs=np.asarray(edgeIxs),**iccDict)
+    return iccDict
@@ -22,19 +22,29 @@
 # Import python tools
 import numpy as np
 import os
-import sys
 import nibabel as nib
 from scipy import signal
-import hcp_utils as hcp
 
-# Note: this can be improved/modified: 
-sys.path.insert(0, '/gpfs/milgram/project/holmes/cvc23/ClinicalNetDynamics/docs/scripts/post_hcp_processing/')
 import regression
+import cifti_utils # see cifti_utils.py; writes .dtseries.nii directly (re-using input brain models)
+import precision_utils # see precision_utils.py
+import hcp_constants # see hcp_constants.py; replaces hcp_utils.cortex_data
 
 ################################################
 # Define variables 
 numCortVerts = 64984 # HCP convention
 
+################################################
+# Loading (separate so that run_scheduler.py can prefetch the next run)
+def load_gsr_inputs(globalMaskFile,timeSeriesSurfaceFile,timeSeriesVolumeFile,precision='float64'):
+    '''Returns (global mask, volumetric timeseries, surface timeseries as space x time); see gsr_from_surface for inputs.'''
+    globalMask = nib.load(globalMaskFile).get_fdata().copy()
+    dtypeHere = precision_utils.get_dtype(precision)
+    fMRI4d = nib.load(timeSeriesVolumeFile).get_fdata(dtype=dtypeHere)
+    # NOTE: assumes HCP dtseries convention of flipping dimensions; can add catch for this though if needed 
+    funcData = nib.load(timeSeriesSurfaceFile).get_fdata(dtype=dtypeHere).T
+    return globalMask,fMRI4d,funcData
+
 ################################################
 # Main function
 def gsr_from_surface(subjID,
@@ -45,6 +55,10 @@ def gsr_from_surface(subjID,
                      outputSavePath,
                      extraSaveStr='',
                      useDerivatives=False,
+                     saveCifti=False,
+                     precision='float64',
+                     loadedInputs=None,
+                     saveOutput=True,
                      verbose=True):
     '''
     INPUTS:
@@ -63,25 +77,31 @@ def gsr_from_surface(subjID,
         outputSavePath        : A string. The full path (directory) for saving the final result to. 
         extraSaveStr          : Optional. A string. Added string with info to append to your saved result. 
         useDerivatives        : Optional. Boolean. Whether or not to use derivatives of global signal in regression.
+        saveCifti             : Optional. Boolean. If True, also saves the residualized timeseries as a .dtseries.nii 
+                                (brain models and TR info taken from <timeSeriesSurfaceFile>), so no npy --> cifti 
+                                conversion is needed downstream. Written in TR chunks (see cifti_utils.py).
+        precision             : Optional. A string; 'float64' (default) or 'float32'. Load/compute precision; the global 
+                                signal mean and the regression Gram matrix are always accumulated in float64.
+        loadedInputs          : Optional. Output of load_gsr_inputs for this run (e.g., prefetched by run_scheduler.py while 
+                                the previous run was being processed). If None (default), inputs are loaded here.
+        saveOutput            : Optional. Boolean. If True (default), saves the outputs below (see save_gsr_outputs). If
+                                False, returns the residualized timeseries instead (e.g., to be saved by run_scheduler.py's
+                                writer thread).
         verbose               : Optional. Boolean. Whether or not to print some extra info; useful for debugging. 
     
     OUTPUT:
         - saves residualized timeseries as: /<outputSavePath>/<functionalRunStr><extraSaveStr>'_GSR_From_Surface.npy'
         - also saves residualized timeseries with HCP-style surface adjustment as: /<outputSavePath>/<functionalRunStr><extraSaveStr>'_GSR_From_Surface_SurfAdj.npy'
+        - if saveCifti=True, also saves: /<outputSavePath>/<functionalRunStr><extraSaveStr>'_GSR_From_Surface.dtseries.nii'
     '''
     #############################################
     # LOAD DATA 
-    globalMask = nib.load(globalMaskFile).get_fdata().copy()
+    if loadedInputs is None:
+        loadedInputs = load_gsr_inputs(globalMaskFile,timeSeriesSurfaceFile,timeSeriesVolumeFile,precision=precision)
+    globalMask,fMRI4d,funcData = loadedInputs
     if verbose:
         print(f"Global mask dimensions: {globalMask.shape}")
-
-    fMRI4d = nib.load(timeSeriesVolumeFile).get_fdata().copy()
-    if verbose:
         print(f"Functional data volumetric dimensions ({functionalRunStr}): {fMRI4d.shape}")
-
-    # NOTE: assumes HCP dtseries convention of flipping dimensions; can add catch for this though if needed 
-    funcData = nib.load(timeSeriesSurfaceFile).get_fdata().T.copy()
-    if verbose:
         print(f"Functional data surface dimensions ({functionalRunStr}): {funcData.shape}")
 
     #############################################
@@ -90,7 +110,7 @@ def gsr_from_surface(subjID,
     globaldata = fMRI4d[globalMask].copy() # mask
     globaldata = signal.detrend(globaldata,axis=1,type='constant') # detrend constant 
     globaldata = signal.detrend(globaldata,axis=1,type='linear') # detrend linear 
-    global_signal1d = np.nanmean(globaldata,axis=0) # get mean of masked voxels 
+    global_signal1d = np.nanmean(globaldata,axis=0,dtype=np.float64) # get mean of masked voxels (accumulated in float64)
 
     #############################################
     # Create derivative time series (with backward differentiation, consistent with 1d_tool.py -derivative option)
@@ -108,23 +128,36 @@ def gsr_from_surface(subjID,
         
     #############################################
     # Run regression 
-    betas, resid = regression.regression(funcData.T, globalRegressors.T, constant=True)
+    betas, resid = regression.regression(funcData.T, globalRegressors.T, constant=True, precision=precision)
     betas = betas.T.copy()
     residual_ts = resid.T.copy()
 
+    if not saveOutput:
+        return residual_ts
+
     #############################################
     # SAVE 
+    save_gsr_outputs(residual_ts,functionalRunStr,timeSeriesSurfaceFile,outputSavePath,extraSaveStr=extraSaveStr,
+                     saveCifti=saveCifti,verbose=verbose)
+
+################################################
+# Saving (separate so that run_scheduler.py can write a run while the next run is processed)
+def save_gsr_outputs(residual_ts,functionalRunStr,timeSeriesSurfaceFile,outputSavePath,extraSaveStr='',saveCifti=False,verbose=True):
+    '''Saves the outputs of gsr_from_surface (see there) from the residualized timeseries (space x time).'''
     saveFileHere = outputSavePath + '/' + functionalRunStr + extraSaveStr + '_GSR_From_Surface.npy'
     np.save(saveFileHere,residual_ts)
 
+    if saveCifti:
+        saveFileHere_Cifti = outputSavePath + '/' + functionalRunStr + extraSaveStr + '_GSR_From_Surface.dtseries.nii'
+        cifti_utils.write_dtseries(residual_ts,timeSeriesSurfaceFile,saveFileHere_Cifti,verbose=verbose)
+
     #############################################
     # Adjust for HCP surface space and save (to be able to use Homotopic cortical parcellations)
-    #residual_ts_SurfAdj = np.zeros_like(residual_ts)
-    residual_ts_SurfAdj = np.zeros((numCortVerts,residual_ts.shape[1]))
-    for timePointIx in range(residual_ts.shape[1]):
-        #residual_ts_SurfAdj[:numCortVerts,timePointIx] = hcp.cortex_data(residual_ts[:numCortVerts,:][:,timePointIx]).copy()
-        #residual_ts_SurfAdj[numCortVerts:,timePointIx] = residual_ts[numCortVerts:,:][:,timePointIx].copy()
-        residual_ts_SurfAdj[:,timePointIx] = hcp.cortex_data(residual_ts[:numCortVerts,:][:,timePointIx]).copy()
+    # (all TRs at once; same as hcp.cortex_data per TR)
+    residual_ts_SurfAdj = hcp_constants.cortex_data(residual_ts,fill=0)
+    if residual_ts_SurfAdj is None:
+        print(f"ERROR: HCP constants not available; surface-adjusted timeseries not saved for {functionalRunStr}.")
+        return
 
     saveFileHere_Adj = outputSavePath + '/' + functionalRunStr + extraSaveStr + '_GSR_From_Surface_SurfAdj.npy'
-    np.save(saveFileHere_Adj,residual_ts_SurfAdj)
\ No newline at end of file
+    np.save(saveFileHere_Adj,residual_ts_SurfAdj)
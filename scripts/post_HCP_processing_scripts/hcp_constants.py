@@ -0,0 +1,103 @@
+# C. Cocuzza, 2023. HCP 91k grayordinate constants, shipped as data (replaces computing them with hcp_utils at import time).
+
+# HCP CIFTI (91282 grayordinates) files store 59412 cortical grayordinates: 29696 left + 29716 right hemisphere
+# vertices of the 32k fs_LR meshes (32492 vertices per hemisphere; the medial wall is left out). Mapping cortical
+# grayordinates back onto the full 64984-vertex surface (e.g., for surface-based / homotopic atlases) only needs the
+# mesh vertex index of each cortical grayordinate. These indices are the same for every HCP 91k file, so they are
+# stored once in <atlasDir>/hcp_91k_cortex_vertex_indices.npz (shipped with this repository; same values as
+# hcp_utils.vertex_info.grayl / grayr) and loaded (and cached) on first use. hcp_utils is not needed to run anything.
+
+# To (re)create the data file: build_hcp_constants(sourceFile=<any 91282-grayordinate .dtseries.nii / .dscalar.nii>),
+# or build_hcp_constants() with hcp_utils installed (uses hcp_utils.vertex_info, i.e., what hcp.cortex_data used).
+
+################################################
+# IMPORTS
+import os
+import numpy as np
+import atlas_utils # see atlas_utils.py; for the atlas_files directory
+
+################################################
+# Constants
+numVertsPerHemi = 32492
+numVertsCort = 64984
+numVertsAll = 91282
+numVertsCort_Dropped = 59412 # cortical grayordinates (i.e., without the medial wall)
+
+hcpConstantsFile_Default = os.path.join(atlas_utils.atlasDir_Default,'hcp_91k_cortex_vertex_indices.npz')
+
+_hcpConstantsCache = {}
+
+################################################
+# Build / load
+def build_hcp_constants(sourceFile=None,outputFile=hcpConstantsFile_Default,verbose=True):
+    '''
+    INPUTS:
+        sourceFile : Optional. A string; any 91282-grayordinate cifti file (brain models are read from its header). If None,
+                     hcp_utils is used (must be installed).
+        outputFile : Optional. A string; where to save the .npz (default: atlas_files/hcp_91k_cortex_vertex_indices.npz).
+
+    OUTPUT:
+        hcpConstants : dictionary with 'vertexLeft' and 'vertexRight' (mesh vertex index of each left / right cortical
+                       grayordinate) and 'numVertsPerHemi'; also saved to <outputFile>.
+    '''
+    if sourceFile is not None:
+        import nibabel as nib
+        brainModelAxis = nib.load(sourceFile).header.get_axis(1)
+        vertexDict = {structureName:brainModel.vertex for structureName,slc,brainModel in brainModelAxis.iter_structures()}
+        vertexLeft = vertexDict['CIFTI_STRUCTURE_CORTEX_LEFT']
+        vertexRight = vertexDict['CIFTI_STRUCTURE_CORTEX_RIGHT']
+    else:
+        import hcp_utils as hcp # See here for install info if need be: https://pypi.org/project/hcp-utils/
+        vertexLeft = hcp.vertex_info.grayl
+        vertexRight = hcp.vertex_info.grayr
+
+    hcpConstants = {'vertexLeft':np.asarray(vertexLeft,dtype=np.int32),
+                    'vertexRight':np.asarray(vertexRight,dtype=np.int32),
+                    'numVertsPerHemi':numVertsPerHemi}
+    if hcpConstants['vertexLeft'].shape[0] + hcpConstants['vertexRight'].shape[0] != numVertsCort_Dropped:
+        print(f"WARNING: {hcpConstants['vertexLeft'].shape[0]} + {hcpConstants['vertexRight'].shape[0]} cortical grayordinates, expected {numVertsCort_Dropped} (HCP 91k).")
+
+    if outputFile is not None:
+        np.savez(outputFile,**hcpConstants)
+        if verbose:
+            print(f"Saved HCP 91k constants to {outputFile}")
+    _hcpConstantsCache[outputFile] = hcpConstants
+    return hcpConstants
+
+def get_hcp_constants(constantsFile=hcpConstantsFile_Default):
+    '''Loads (once) the HCP 91k constants; returns None (with an ERROR) if the data file does not exist.'''
+    if constantsFile not in _hcpConstantsCache:
+        if not os.path.isfile(constantsFile):
+            print(f"ERROR: HCP constants file {constantsFile} does not exist; it ships in atlas_files/, or re-create it with build_hcp_constants (see notes at top of script).")
+            return None
+        with np.load(constantsFile) as fileHere:
+            _hcpConstantsCache[constantsFile] = {keyHere:fileHere[keyHere] for keyHere in fileHere.files}
+    return _hcpConstantsCache[constantsFile]
+
+################################################
+# Mapping grayordinates <--> surface vertices
+def cortex_data(dataHere,fill=0,constantsFile=hcpConstantsFile_Default):
+    '''
+    Same as hcp_utils.cortex_data, for all columns at once: maps the first 59412 rows (cortical grayordinates) of
+    <dataHere> (grayordinates, or grayordinates x TRs) onto the 64984 surface vertices; medial wall vertices = <fill>.
+    '''
+    hcpConstants = get_hcp_constants(constantsFile)
+    if hcpConstants is None:
+        return None
+    vertexLeft,vertexRight = hcpConstants['vertexLeft'],hcpConstants['vertexRight']
+    numLeft,numRight = vertexLeft.shape[0],vertexRight.shape[0]
+
+    dataOut = np.full((numVertsCort,)+dataHere.shape[1:],fill,dtype=np.result_type(dataHere.dtype,np.min_scalar_type(fill)))
+    dataOut[vertexLeft] = dataHere[:numLeft]
+    dataOut[numVertsPerHemi + vertexRight] = dataHere[numLeft:numLeft+numRight]
+    return dataOut
+
+def dropped_cortex_vertices(constantsFile=hcpConstantsFile_Default):
+    '''Indices (of 64984) of the surface vertices with no grayordinate (medial wall; 5572 for HCP 91k).'''
+    hcpConstants = get_hcp_constants(constantsFile)
+    if hcpConstants is None:
+        return None
+    isKept = np.zeros(numVertsCort,dtype=bool)
+    isKept[hcpConstants['vertexLeft']] = True
+    isKept[numVertsPerHemi + hcpConstants['vertexRight']] = True
+    return np.where(~isKept)[0]
@@ -0,0 +1,193 @@
+# C. Cocuzza, 2023. Common network diagnostics on stacked functional connectivity (FC) matrices.
+
+# Computes degree/strength, within- and between-network connectivity, participation coefficient, and segregation for
+# a whole stack of FC matrices at once (e.g., subjects x nodes x nodes, or runs x nodes x nodes for 1 participant).
+# Network assignments come from the whole-brain atlas files in atlas_files/ (loaded and cached via atlas_utils.py),
+# where nodes are re-ordered so that each network is a contiguous block; every network-level quantity is then a block
+# reduction (np.add.reduceat) over the precomputed network boundaries, rather than a loop over participants and a
+# graph library call per matrix.
+
+# NOTES:
+# (1) Self-connections (the diagonal) are always ignored; fcEstimation.py fills them with NaN or 0, either is fine here.
+# (2) Participation coefficient and strength follow Brain Connectivity Toolbox conventions (positive weights only);
+#     see bctpy (https://github.com/aestrivex/bctpy) for the per-matrix reference implementations.
+# (3) Segregation follows Chan et al., 2014 (PNAS): (mean within-network FC - mean between-network FC) / mean within-network FC.
+
+# Some useful references:
+
+# Rubinov, M., & Sporns, O. (2010). Complex network measures of brain connectivity: Uses and interpretations. NeuroImage, 52(3), 1059–1069. https://doi.org/10.1016/j.neuroimage.2009.10.003
+
+# Guimerà, R., & Nunes Amaral, L. A. (2005). Functional cartography of complex metabolic networks. Nature, 433(7028), 895–900. https://doi.org/10.1038/nature03288
+
+# Chan, M. Y., Park, D. C., Savalia, N. K., Petersen, S. E., & Wig, G. S. (2014). Decreased segregation of brain systems across the healthy adult lifespan. PNAS, 111(46), E4997–E5006. https://doi.org/10.1073/pnas.1415122111
+
+################################################
+# IMPORTS
+import numpy as np
+import atlas_utils # see atlas_utils.py; loads and caches atlas_files/ info per atlas variant
+
+################################################
+# Main function
+def network_metrics(fcStack,
+                    atlasVariant='Cerebellum_Seperate',
+                    atlasDir=atlas_utils.atlasDir_Default,
+                    isOrdered=False,
+                    stackAxisLast=False,
+                    useAbsolute=False,
+                    degreeThreshold=0,
+                    verbose=False):
+    '''
+    INPUTS:
+        fcStack         : REQUIRED. A numpy array of FC matrices, stack x nodes x nodes (e.g., subjects x nodes x nodes).
+                          A single nodes x nodes matrix is also accepted (treated as a stack of 1).
+        atlasVariant    : Optional. A string; either 'Cerebellum_Seperate' (default) or 'Cerebellum_Cortical_Nets' (see atlas_utils.py).
+                          Number of nodes must match the atlas.
+        atlasDir        : Optional. A string; full path to the atlas_files directory.
+        isOrdered       : Optional. Boolean; set to True if fcStack is already in network order (see whole_brain_node_order_*.npy).
+                          Default is False, i.e., nodes are in the original parcellation order and are re-ordered here.
+        stackAxisLast   : Optional. Boolean; set to True for nodes x nodes x stack arrays (e.g., fcEstimation with fcForSepBlocks=True).
+        useAbsolute     : Optional. Boolean; if True, absolute FC values are used for all metrics (default is signed FC).
+        degreeThreshold : Optional. Edges with FC > degreeThreshold are counted towards degree. Default is 0.
+        verbose         : Optional. Boolean; if True, will print extra info.
+
+    OUTPUT:
+        metricsDict     : A dictionary of numpy arrays, all in network order (see 'nodeOrder' and 'networkNames'):
+                          'degree'                  : stack x nodes
+                          'strength'                : stack x nodes; sum of positive weights
+                          'strength_neg'            : stack x nodes; sum of magnitudes of negative weights
+                          'participation_coef'      : stack x nodes; positive weights
+                          'network_fc'              : stack x networks x networks; mean FC within (diagonal) and between blocks
+                          'within_network_fc'       : stack x networks
+                          'between_network_fc'      : stack x networks; mean FC of each network with all other nodes
+                          'network_segregation'     : stack x networks
+                          'segregation'             : stack; system-wide segregation
+    '''
+    membership = atlas_utils.load_atlas(atlasVariant=atlasVariant,atlasDir=atlasDir)
+    if membership is None:
+        return None
+
+    ################################################
+    # Data management
+    fcStack = np.asarray(fcStack)
+    if fcStack.ndim==2:
+        fcStack = fcStack[None,:,:]
+    elif stackAxisLast:
+        fcStack = np.moveaxis(fcStack,-1,0)
+
+    numStack,numNodes,numNodes2 = fcStack.shape
+    if numNodes!=numNodes2 or numNodes!=membership['nodeOrder'].shape[0]:
+        print(f"ERROR: FC stack has {numNodes} x {numNodes2} nodes, expected {membership['nodeOrder'].shape[0]} x {membership['nodeOrder'].shape[0]} for atlas {atlasVariant}; aborting.")
+        return None
+    if verbose:
+        print(f"Computing network metrics on {numStack} FC matrices ({numNodes} nodes, {membership['blockSizes'].shape[0]} networks)...")
+
+    # Re-order both node axes at once (no per-matrix copies)
+    if not isOrdered:
+        fcStack = atlas_utils.reorder_fc(fcStack,atlasVariant=atlasVariant,atlasDir=atlasDir)
+    else:
+        fcStack = fcStack.copy()
+
+    if useAbsolute:
+        fcStack = np.abs(fcStack)
+
+    # Network block sums and counts of valid (non-NaN, off-diagonal) edges; see atlas_utils.py
+    blockSums,blockCounts = atlas_utils.network_block_sums(fcStack,atlasVariant=atlasVariant,atlasDir=atlasDir,isOrdered=True,excludeDiagonal=True)
+
+    # Self-connections and missing values are ignored (node-level metrics)
+    fcStack[np.isnan(fcStack)] = 0
+    diagIxs = np.arange(numNodes)
+    fcStack[:,diagIxs,diagIxs] = 0
+
+    fcPos = np.maximum(fcStack,0)
+    blockStarts = membership['blockStarts']
+
+    ################################################
+    # Node-level: degree and strength
+    degree = np.sum(fcStack>degreeThreshold,axis=2)
+    strength = np.sum(fcPos,axis=2)
+    strengthNeg = -np.sum(np.minimum(fcStack,0),axis=2)
+
+    ################################################
+    # Participation coefficient: 1 - sum over networks of (node-to-network strength / node strength)^2
+    nodeToNetwork = np.add.reduceat(fcPos,blockStarts,axis=2)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        participationCoef = 1 - np.sum((nodeToNetwork / strength[:,:,None])**2,axis=2)
+    participationCoef[strength==0] = 0
+
+    ################################################
+    # Network-level: block means over precomputed boundaries (NaN edges excluded from sums and counts)
+    withinSums = np.diagonal(blockSums,axis1=1,axis2=2)
+    withinCounts = np.diagonal(blockCounts,axis1=1,axis2=2)
+    betweenSums = np.sum(blockSums,axis=2) - withinSums
+    betweenCounts = np.sum(blockCounts,axis=2) - withinCounts
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        networkFC = blockSums / blockCounts
+        withinNetworkFC = withinSums / withinCounts
+        betweenNetworkFC = betweenSums / betweenCounts
+        networkSegregation = (withinNetworkFC - betweenNetworkFC) / withinNetworkFC
+
+        # System-wide segregation pools all within- and all between-network edges
+        withinMean = np.sum(withinSums,axis=1) / np.sum(withinCounts,axis=1)
+        betweenMean = np.sum(betweenSums,axis=1) / np.sum(betweenCounts,axis=1)
+        segregation = (withinMean - betweenMean) / withinMean
+
+    metricsDict = {'degree':degree,
+                   'strength':strength,
+                   'strength_neg':strengthNeg,
+                   'participation_coef':participationCoef,
+                   'network_fc':networkFC,
+                   'within_network_fc':withinNetworkFC,
+                   'between_network_fc':betweenNetworkFC,
+                   'network_segregation':networkSegregation,
+                   'segregation':segregation,
+                   'nodeOrder':membership['nodeOrder'],
+                   'networkNames':membership['networkNames']}
+
+    return metricsDict
+
+################################################
+# Wrapper for FC files saved by fcEstimation.py
+def network_metrics_from_files(fcFileList,
+                               outputPath,
+                               subjID,
+                               extraSaveStr='',
+                               atlasVariant='Cerebellum_Seperate',
+                               atlasDir=atlas_utils.atlasDir_Default,
+                               isOrdered=False,
+                               useAbsolute=False,
+                               verbose=False):
+    '''
+    INPUTS:
+        fcFileList   : REQUIRED. A list of strings; full paths to FC .npy files (e.g., from fcEstimation, 1 per run).
+                       Each file can be nodes x nodes, or nodes x nodes x blocks (fcForSepBlocks=True); all are stacked.
+        outputPath   : REQUIRED. A string; full output path to save results.
+        subjID       : REQUIRED. A string; participant ID as used throughout study.
+        extraSaveStr : OPTIONAL. A string; suffix to specify things like: rest vs task, parcellation, etc.
+        Remaining inputs: see network_metrics.
+
+    OUTPUT:
+        Saves result as: ~/<outputPath>/"NetMetrics_<subjID><extraSaveStr>.npz" (keys: see network_metrics, plus 'fcFileList')
+    '''
+    fcList = []
+    for fcFile in fcFileList:
+        fcHere = np.load(fcFile)
+        if fcHere.ndim==3:
+            fcList.extend(np.moveaxis(fcHere,-1,0))
+        else:
+            fcList.append(fcHere)
+    if verbose:
+        print(f"Loaded {len(fcList)} FC matrices from {len(fcFileList)} files...")
+
+    metricsDict = network_metrics(np.stack(fcList,axis=0),
+                                  atlasVariant=atlasVariant,
+                                  atlasDir=atlasDir,
+                                  isOrdered=isOrdered,
+                                  useAbsolute=useAbsolute,
+                                  verbose=verbose)
+
+    if metricsDict is not None:
+        outputFileHere = outputPath + 'NetMetrics_' + subjID + extraSaveStr + '.npz'
+        np.savez(outputFileHere,fcFileList=np.asarray(fcFileList),**metricsDict)
+
+    return metricsDict
@@ -0,0 +1,285 @@
+# C. Cocuzza, 2023. Random-access, parallel reading of gzipped NIfTI timeseries (.nii.gz), and writing in TR chunks.
+
+# nibabel decompresses .nii.gz files single-threaded from the start of the file, even when only a few TRs are needed,
+# and again for every stage that reads the same file. Here (same idea as zran.c / indexed_gzip):
+# (1) a checkpoint (compressed offset, uncompressed offset, copy of the zlib decompressor state) is stored every
+#     <spacing> compressed bytes. There is no separate indexing pass: the index is built as a by-product of the first
+#     front-to-back read (e.g., NiftiReader.iter_trs), so that read costs 1 decompression, as nibabel's get_fdata does.
+#     The index is cached per file for the life of the python session (e.g., across stages in 1 python call, or in a
+#     worker process).
+# (2) any byte range (e.g., a range of TRs; NIfTI volumes are contiguous on disk) that is behind the front-to-back
+#     read is read by starting at the nearest preceding checkpoint, instead of at the start of the file.
+# (3) once the whole file has been indexed, large reads are split at checkpoints and decompressed in parallel
+#     (threads; zlib releases the GIL).
+# (4) optionally, a file is converted once to an uncompressed .nii cache (<cacheDir>/<name>.nii), which nibabel
+#     memory-maps, so repeated reads across stages / python calls cost no decompression at all. Each TR is a
+#     contiguous block in the uncompressed file, so TR-range reads are plain slices.
+# (5) write_trs writes a 4D NIfTI (.nii or .nii.gz) TR chunk by TR chunk (the same layout, in reverse), so outputs never
+#     have to be held in memory as a full 4D array either.
+
+# NOTE: python's zlib module cannot restart inflation at an arbitrary bit offset (zran.c uses inflatePrime for this),
+# so checkpoints hold decompressor objects and cannot be saved to disk. Across python calls, a file without an
+# uncompressed cache (4) therefore costs 1 decompression per python call (same as nibabel); pass <cacheDir> (e.g.,
+# acompcor_denoising.py) to persist across python calls.
+
+################################################
+# IMPORTS
+import os
+import gzip
+import shutil
+import bisect
+import zlib
+import threading
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-file gzip indices (in memory, for the life of the python session)
+_indexCache = {}
+
+################################################
+# Gzip seek index
+class GzipIndex:
+    '''
+    Seek index for a (single-member) gzip file; see notes at top of script. Built lazily: read() decompresses front to
+    back (storing checkpoints on the way) until the whole file has been read once.
+        spacing  : compressed bytes between checkpoints (default 4 MB; ~40 KB of memory per checkpoint).
+        readSize : compressed bytes read per zlib call.
+    '''
+    def __init__(self,gzFile,spacing=4*2**20,readSize=2**18):
+        self.gzFile = gzFile
+        self.spacing = spacing
+        self.readSize = readSize
+        self.checkpoints = [(0,0,zlib.decompressobj(zlib.MAX_WBITS|16))]
+        self.uncompressedOffsets = [0]
+        self.complete = False
+        self.uncompressedSize = None
+
+        # Front-to-back (streaming) read state; <_pending> holds decompressed bytes [_streamPos, _streamPos+len)
+        self._streamObj = self.checkpoints[0][2].copy()
+        self._compressedPos = 0
+        self._streamPos = 0
+        self._pending = memoryview(b'')
+        self._streamLock = threading.Lock()
+
+    def build(self):
+        '''Indexes the whole file (1 decompression) if it has not been read front to back yet.'''
+        with self._streamLock:
+            while not self.complete:
+                self._stream_chunk()
+
+    def _stream_chunk(self):
+        '''Decompresses the next <readSize> compressed bytes into <_pending>, storing a checkpoint every <spacing> bytes.'''
+        self._streamPos += len(self._pending)
+        with open(self.gzFile,'rb') as fileHere:
+            fileHere.seek(self._compressedPos)
+            chunkHere = fileHere.read(self.readSize)
+        dataHere = self._streamObj.decompress(chunkHere) if chunkHere else b''
+        self._compressedPos += len(chunkHere)
+        self._pending = memoryview(dataHere)
+        if not chunkHere or self._streamObj.eof:
+            if self._streamObj.unused_data:
+                print(f"WARNING: {self.gzFile} has more than 1 gzip member; only the 1st is indexed.")
+            self.complete = True
+            self.uncompressedSize = self._streamPos + len(dataHere)
+            self._streamObj = None
+        elif self._compressedPos - self.checkpoints[-1][0] >= self.spacing:
+            self.checkpoints.append((self._compressedPos,self._streamPos + len(dataHere),self._streamObj.copy()))
+            self.uncompressedOffsets.append(self._streamPos + len(dataHere))
+
+    def _read_streaming(self,startByte,numBytes,outBuffer):
+        '''Front-to-back read of [startByte, startByte+numBytes) (startByte >= the stream position); extends the index.'''
+        bytesWritten = 0
+        while bytesWritten<numBytes:
+            if len(self._pending)==0:
+                if self.complete:
+                    break
+                self._stream_chunk()
+                continue
+            bytesToSkip = startByte + bytesWritten - self._streamPos
+            if bytesToSkip>=len(self._pending):
+                self._streamPos += len(self._pending)
+                self._pending = memoryview(b'')
+                continue
+            numToCopy = min(len(self._pending)-bytesToSkip,numBytes-bytesWritten)
+            outBuffer[bytesWritten:bytesWritten+numToCopy] = self._pending[bytesToSkip:bytesToSkip+numToCopy]
+            bytesWritten += numToCopy
+            self._streamPos += bytesToSkip + numToCopy
+            self._pending = self._pending[bytesToSkip+numToCopy:]
+        if bytesWritten<numBytes:
+            raise EOFError(f"{self.gzFile}: requested bytes {startByte}-{startByte+numBytes} but file ends at {self.uncompressedSize}.")
+
+    def _read_from_checkpoint(self,startByte,numBytes,outBuffer):
+        '''Decompresses [startByte, startByte+numBytes) into outBuffer (a writable memoryview of numBytes).'''
+        checkpointIx = bisect.bisect_right(self.uncompressedOffsets,startByte) - 1
+        compressedPos,uncompressedPos,decompObj = self.checkpoints[checkpointIx]
+        decompObj = decompObj.copy()
+        bytesToSkip = startByte - uncompressedPos
+        bytesWritten = 0
+        with open(self.gzFile,'rb') as fileHere:
+            fileHere.seek(compressedPos)
+            while bytesWritten<numBytes:
+                chunkHere = fileHere.read(self.readSize)
+                if not chunkHere:
+                    break
+                dataHere = decompObj.decompress(chunkHere)
+                if bytesToSkip>=len(dataHere):
+                    bytesToSkip -= len(dataHere)
+                    continue
+                dataHere = memoryview(dataHere)[bytesToSkip:]
+                bytesToSkip = 0
+                numToCopy = min(len(dataHere),numBytes-bytesWritten)
+                outBuffer[bytesWritten:bytesWritten+numToCopy] = dataHere[:numToCopy]
+                bytesWritten += numToCopy
+        if bytesWritten<numBytes:
+            raise EOFError(f"{self.gzFile}: requested bytes {startByte}-{startByte+numBytes} but file ends at {self.uncompressedSize}.")
+
+    def read(self,startByte,numBytes,numWorkers=4):
+        '''
+        Returns uncompressed bytes [startByte, startByte+numBytes) as a bytearray. Reads at or ahead of the front-to-back
+        read continue it (extending the index); other reads start at checkpoints, split and read in parallel once the
+        whole file is indexed.
+        '''
+        outBytes = bytearray(numBytes)
+        outView = memoryview(outBytes)
+        with self._streamLock:
+            if not self.complete and startByte>=self._streamPos:
+                self._read_streaming(startByte,numBytes,outView)
+                return outBytes
+
+        stopByte = startByte + numBytes
+        if self.complete:
+            splitPoints = [startByte] + [offsetHere for offsetHere in self.uncompressedOffsets if startByte<offsetHere<stopByte] + [stopByte]
+        else:
+            splitPoints = [startByte,stopByte]
+        segmentList = list(zip(splitPoints[:-1],splitPoints[1:]))
+
+        if numWorkers<=1 or len(segmentList)==1:
+            for segStart,segStop in segmentList:
+                self._read_from_checkpoint(segStart,segStop-segStart,outView[segStart-startByte:segStop-startByte])
+        else:
+            with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+                futuresList = [executor.submit(self._read_from_checkpoint,segStart,segStop-segStart,outView[segStart-startByte:segStop-startByte])
+                               for segStart,segStop in segmentList]
+                for futureHere in futuresList:
+                    futureHere.result()
+        return outBytes
+
+def get_gzip_index(gzFile,spacing=4*2**20):
+    '''Cached GzipIndex for <gzFile> (a new one if the file changed since it was indexed; built lazily, see GzipIndex).'''
+    fileStat = os.stat(gzFile)
+    cacheKey = (os.path.abspath(gzFile),fileStat.st_size,fileStat.st_mtime_ns)
+    if cacheKey not in _indexCache:
+        _indexCache[cacheKey] = GzipIndex(gzFile,spacing=spacing)
+    return _indexCache[cacheKey]
+
+################################################
+# Uncompressed cache
+def uncompressed_cache_file(niftiFile,cacheDir):
+    '''<cacheDir>/<name>.nii for <name>.nii.gz.'''
+    return os.path.join(cacheDir,os.path.basename(niftiFile)[:-len('.gz')])
+
+def convert_to_uncompressed(niftiFile,cacheDir,verbose=False):
+    '''
+    One-time conversion of <niftiFile> (.nii.gz) to <cacheDir>/<name>.nii (the gzip stream, decompressed once). Skipped if
+    an up-to-date cache file exists. Returns the cache file name.
+    '''
+    cacheFile = uncompressed_cache_file(niftiFile,cacheDir)
+    if os.path.isfile(cacheFile) and os.path.getmtime(cacheFile)>=os.path.getmtime(niftiFile):
+        return cacheFile
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    if verbose:
+        print(f"Writing uncompressed cache of {niftiFile} to {cacheFile}...")
+    tempFile = cacheFile + '.tmp'
+    with gzip.open(niftiFile,'rb') as fileIn, open(tempFile,'wb') as fileOut:
+        shutil.copyfileobj(fileIn,fileOut,length=16*2**20)
+    os.replace(tempFile,cacheFile) # so a partial file is never used as a cache
+    return cacheFile
+
+################################################
+# Timeseries reader
+class NiftiReader:
+    '''
+    Random-access reader for 4D NIfTI timeseries (.nii.gz via GzipIndex, or uncompressed .nii via nibabel's memmap).
+        niftiFile   : REQUIRED. A string; full path to a .nii.gz or .nii file.
+        cacheDir    : OPTIONAL. If given, reads use <cacheDir>/<name>.nii when it is up to date.
+        makeCache   : OPTIONAL. Boolean; if True (and cacheDir given), the uncompressed cache is created first if needed.
+        numWorkers  : OPTIONAL. Threads used for parallel decompression; default 4.
+    '''
+    def __init__(self,niftiFile,cacheDir=None,makeCache=False,numWorkers=4):
+        self.niftiFile = niftiFile
+        self.numWorkers = numWorkers
+        if niftiFile.endswith('.gz') and cacheDir is not None:
+            if makeCache:
+                niftiFile = convert_to_uncompressed(niftiFile,cacheDir)
+            else:
+                cacheFile = uncompressed_cache_file(niftiFile,cacheDir)
+                if os.path.isfile(cacheFile) and os.path.getmtime(cacheFile)>=os.path.getmtime(niftiFile):
+                    niftiFile = cacheFile
+        self.sourceFile = niftiFile
+
+        self.img = nib.load(niftiFile)
+        self.shape = self.img.shape
+        self.affine = self.img.affine
+        self.header = self.img.header
+        self.isGzip = niftiFile.endswith('.gz')
+        if self.isGzip:
+            # NOTE: from the array proxy (img.header has scaling reset once the image is loaded)
+            self.dataDtype = np.dtype(self.img.dataobj.dtype)
+            self.dataOffset = int(self.img.dataobj.offset)
+            self.volumeBytes = int(np.prod(self.shape[:3]))*self.dataDtype.itemsize
+            self.slope,self.inter = float(self.img.dataobj.slope),float(self.img.dataobj.inter)
+
+    def read_trs(self,startTR,stopTR,dtype=np.float32):
+        '''Returns the X x Y x Z x (stopTR-startTR) block of TRs [startTR, stopTR) (scaled as nibabel would).'''
+        stopTR = min(stopTR,self.shape[3])
+        if not self.isGzip:
+            return np.asarray(self.img.dataobj[...,startTR:stopTR],dtype=dtype)
+
+        rawBytes = get_gzip_index(self.sourceFile).read(self.dataOffset + startTR*self.volumeBytes,
+                                                        (stopTR-startTR)*self.volumeBytes,
+                                                        numWorkers=self.numWorkers)
+        dataHere = np.frombuffer(rawBytes,dtype=self.dataDtype).reshape(tuple(self.shape[:3])+(stopTR-startTR,),order='F')
+        dataHere = dataHere.astype(dtype)
+        if self.slope!=1 or self.inter!=0:
+            dataHere *= self.slope
+            dataHere += self.inter
+        return dataHere
+
+    def iter_trs(self,chunkSize=100,dtype=np.float32):
+        '''Yields (startTR, X x Y x Z x TRs block) over the whole run, <chunkSize> TRs at a time.'''
+        for startTR in range(0,self.shape[3],chunkSize):
+            yield startTR,self.read_trs(startTR,startTR+chunkSize,dtype=dtype)
+
+################################################
+# Timeseries writer
+def write_trs(outputFile,chunkIterator,templateHeader,dtype=np.float32,compressLevel=1):
+    '''
+    Writes a 4D NIfTI-1 file from X x Y x Z x TRs blocks (in TR order, e.g., from NiftiReader.iter_trs), without
+    building the full 4D array. Header fields (shape, affine, TR, extensions, etc.) come from <templateHeader>; the data
+    are written unscaled as <dtype>. <outputFile> ending in .gz is gzipped (<compressLevel>; 1 = nibabel's default).
+    '''
+    headerHere = templateHeader.copy()
+    headerHere.set_data_dtype(dtype)
+    headerHere['scl_slope'] = np.nan
+    headerHere['scl_inter'] = np.nan
+    headerHere['vox_offset'] = 0 # set to the minimum (header + extensions) by write_to
+    numTRs = headerHere.get_data_shape()[3]
+
+    tempFile = outputFile + '.tmp'
+    if outputFile.endswith('.gz'):
+        fileObj = gzip.open(tempFile,'wb',compresslevel=compressLevel)
+    else:
+        fileObj = open(tempFile,'wb')
+    with fileObj:
+        headerHere.write_to(fileObj)
+        fileObj.write(b'\x00'*(int(headerHere.get_data_offset()) - fileObj.tell()))
+        numWritten = 0
+        for dataChunk in chunkIterator:
+            fileObj.write(np.asarray(dataChunk,dtype=dtype).tobytes(order='F'))
+            numWritten += dataChunk.shape[3]
+    if numWritten!=numTRs:
+        os.remove(tempFile)
+        raise ValueError(f"{outputFile}: {numWritten} TRs given, but the header has {numTRs}.")
+    os.replace(tempFile,outputFile) # so a partial file is never left under the output name
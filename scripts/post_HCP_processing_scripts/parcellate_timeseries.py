@@ -6,6 +6,7 @@
 # Instead, I extracted the labels as numpy arrays (and verified with a few methods, including fieldtrip in MATLAB and hcp-utils in python), and hand-coded 
 # the parcellation procedure (default: taking the mean; other methods supported below). 
 # I think this is more flexible (but loses some cifti functionality, like header/structure info); below is a draft (which can be improved). 
+# UPDATE: set saveCifti=True to also save a .ptseries.nii (parcel axis built from the atlas labels; see cifti_utils.py), which restores the header/structure info. 
 
 # NOTE: this is generally for cortical parcellations; the only atlas that can handle subcortical as well is the CABNP (https://github.com/ColeLab/ColeAnticevicNetPartition),
 # so there are special checks here for that atlas, but most uses will return parcellated cortices only. 
@@ -19,7 +20,9 @@
 # IMPORTS
 import numpy as np
 import nibabel as nib # See here for install info if need be: https://nipy.org/nibabel/installation.html
-import hcp_utils as hcp # See here for install info if need be: https://pypi.org/project/hcp-utils/
+import hcp_constants # see hcp_constants.py; HCP 91k vertex info shipped as data (previously computed with hcp_utils at import)
+import cifti_utils # see cifti_utils.py
+import precision_utils # see precision_utils.py
 
 ################################################
 # Set some common (given HCP conventions) variables 
@@ -29,11 +32,58 @@ numVertsList = [numVertsCort,numVertsAll]
 
 numVertsCort_Dropped = 59412 
 
-blankArr_HCP = np.ones((numVertsCort_Dropped))
-blankArr_HCP_Filled = hcp.cortex_data(blankArr_HCP, fill=0)
+# NOTE: the HCP medial wall indices (5572 vertices) are loaded on first use (hcp_constants.dropped_cortex_vertices)
 
-droppedVertsCort_HCP = np.where(blankArr_HCP_Filled==0)[0]
-numVertsDropped_HCP = droppedVertsCort_HCP.shape[0] # should be 5572
+# Parcel QC table columns (see parcel_qc_metrics)
+qcColumns = ['parcel_label','num_vertices','num_nan_vertices','num_zero_vertices','coverage','tsnr','homogeneity']
+
+################################################
+# Parcel-level signal-quality metrics (computed in the parcellation loop; computeQC=True)
+def parcel_qc_metrics(parcelTimeseries):
+    '''
+    QC metrics for 1 parcel, from its vertices x TRs block:
+        num_vertices      : vertices with this label
+        num_nan_vertices  : vertices with any NaN
+        num_zero_vertices : vertices (without NaNs) with a constant timeseries (e.g., all 0; no signal)
+        coverage          : fraction of vertices with usable signal (not NaN, not constant)
+        tsnr              : mean over usable vertices of temporal mean / temporal SD (NOTE: only meaningful if the 
+                            timeseries were not demeaned, e.g., *_hp2000_clean data)
+        homogeneity       : mean pairwise correlation between usable vertices; with u_v the centered, unit-norm 
+                            timeseries of vertex v, sum_v,w r_vw = ||sum_v u_v||^2, so the mean over the m(m-1) pairs 
+                            v != w is (||sum_v u_v||^2 - m) / (m(m-1)), i.e., O(m x TRs) rather than O(m^2 x TRs)
+    '''
+    numVerts = parcelTimeseries.shape[0]
+    isNaN = np.any(np.isnan(parcelTimeseries),axis=1)
+    dataValid = np.asarray(parcelTimeseries[~isNaN],dtype=np.float64)
+    vertMeans = dataValid.mean(axis=1)
+    dataCentered = dataValid - vertMeans[:,None]
+    vertNorms = np.sqrt(np.sum(dataCentered**2,axis=1))
+    isConstant = np.all(dataValid==dataValid[:,:1],axis=1)
+    numUsable = int(np.sum(~isConstant))
+
+    qcHere = {'num_vertices':numVerts,
+              'num_nan_vertices':int(np.sum(isNaN)),
+              'num_zero_vertices':int(np.sum(isConstant)),
+              'coverage':numUsable/numVerts if numVerts>0 else np.nan,
+              'tsnr':np.nan,
+              'homogeneity':np.nan}
+    if numUsable>0:
+        vertSDs = vertNorms[~isConstant]/np.sqrt(dataValid.shape[1])
+        qcHere['tsnr'] = np.mean(vertMeans[~isConstant]/vertSDs)
+    if numUsable>1:
+        sumUnitVecs = np.sum(dataCentered[~isConstant]/vertNorms[~isConstant,None],axis=0)
+        qcHere['homogeneity'] = (np.dot(sumUnitVecs,sumUnitVecs) - numUsable)/(numUsable*(numUsable-1))
+    return qcHere
+
+def save_qc_table(qcTable,outputFile,subjID_Str='',funcRun_Str=''):
+    '''Writes a parcel QC table (dictionary of per-parcel arrays; see qcColumns) as a .csv, with subject and run columns.'''
+    numParcels = qcTable[qcColumns[0]].shape[0]
+    with open(outputFile,'w') as fileHere:
+        fileHere.write(','.join(['subjID','funcRun'] + qcColumns) + '\n')
+        for parcelIx in range(numParcels):
+            rowValues = [f"{int(qcTable[columnName][parcelIx])}" if columnName.startswith(('num_','parcel_')) else f"{qcTable[columnName][parcelIx]:.6g}"
+                         for columnName in qcColumns]
+            fileHere.write(','.join([subjID_Str,funcRun_Str] + rowValues) + '\n')
 
 ################################################
 # Define flexible parcellation function
@@ -46,6 +96,10 @@ def parcellate_timeseries(inputAtlasLabels_File,
                           funcRun_Str='',
                           atlasSave_Str='Atlas',
                           parcellationMethod='mean',
+                          saveCifti=False,
+                          templateCifti_File=None,
+                          precision='float64',
+                          computeQC=False,
                           verbose=True):
     '''
     INPUTS:
@@ -97,6 +151,25 @@ def parcellate_timeseries(inputAtlasLabels_File,
                                    NOTE: currently supports exact string usage (i.e., will not support 'MEAN', must be 'mean'), 
                                    but will fix in future.
     
+        saveCifti                : Optional (used with saveOutput=True); default is False. If True, also saves the parcellated 
+                                   timeseries as '<subjID_Str>_<funcRun_Str>_Parcellated_Timeseries_<atlasSave_Str>.ptseries.nii', 
+                                   with a parcel axis built from the atlas labels (1 parcel per label, same row order as the 
+                                   output array) and TR info from the dense timeseries. 
+    
+        templateCifti_File       : Optional (used with saveCifti=True); full path and file name to the .dtseries.nii that the 
+                                   brain models / TR info should come from. Not needed if inputTimeseries_File is a .dtseries.nii 
+                                   (it is used as the template), but required for .npy inputs.
+    
+        precision                : Optional; 'float64' (default) or 'float32'. Precision the dense timeseries is loaded in and 
+                                   the output is returned/saved in (parcel means/sums are always accumulated in float64). 
+    
+        computeQC                : Optional; default is False. If True, per-parcel signal-quality metrics are computed in the 
+                                   same pass over the dense timeseries (see parcel_qc_metrics), and (with saveOutput=True) saved 
+                                   as a compact per-run table: 
+                                   '<subjID_Str>_<funcRun_Str>_Parcel_QC_<atlasSave_Str>.csv' 
+                                   (1 row per parcel, same order as the output array; subject and run columns are included so 
+                                   tables can be concatenated across the cohort). 
+    
         verbose                  : Optional; default is True to return prints of all steps of the function (useful for 
                                    debugging).
     
@@ -105,6 +178,9 @@ def parcellate_timeseries(inputAtlasLabels_File,
         outputTimeseries         : returned regions x TRs array. NOTE: this is also saved by default as npy array, see 
                                    saveOutput in the input section above.
     
+        qcTable                  : only returned if computeQC=True (i.e., returns outputTimeseries, qcTable); a dictionary of 
+                                   per-parcel arrays (see qcColumns at top of script).
+    
     '''
     
     if verbose:
@@ -243,17 +319,19 @@ def parcellate_timeseries(inputAtlasLabels_File,
                     
                 ################################################################################################
                 # Now load the dense timeseries and peform some checks 
+                # NOTE: previously cast to int here, which truncated the (float) timeseries values 
+                dtypeHere = precision_utils.get_dtype(precision)
                 if inputTimeseries_File.endswith('.nii'):
-                    inputTimeseries = np.squeeze(nib.load(inputTimeseries_File).get_fdata()).astype(int).copy()
+                    inputTimeseries = np.squeeze(nib.load(inputTimeseries_File).get_fdata(dtype=dtypeHere))
                     if verbose:
                         print(f"Loading dense timeseries {inputTimeseries_File}...")
 
                 elif inputTimeseries_File.endswith('.npy'):
-                    inputTimeseries = np.load(inputTimeseries_File).copy()
+                    inputTimeseries = np.load(inputTimeseries_File)
                     if verbose:
                         print(f"Loading dense timeseries {inputTimeseries_File}...")
 
-                inputTimeseries = np.asarray(inputTimeseries)
+                inputTimeseries = np.asarray(inputTimeseries,dtype=dtypeHere)
                 colShape = inputTimeseries.shape[1]
                 
                 ################################################################################################
@@ -280,7 +358,7 @@ def parcellate_timeseries(inputAtlasLabels_File,
                     elif dropOutVals==0: 
                         dropOutIxs = np.where(atlasLabels==0)[0].copy()
 
-                    if not np.array_equal(dropOutIxs,droppedVertsCort_HCP):
+                    if not np.array_equal(dropOutIxs,hcp_constants.dropped_cortex_vertices()):
                         if verbose:
                             print(f"The dropout/unlabeled indices do not match HCP conventions; still running with chosen atlas info, but please check.")
                             
@@ -298,7 +376,9 @@ def parcellate_timeseries(inputAtlasLabels_File,
                     if verbose:
                         print(f"Combining brainordinates by taking the {parcellationMethod} of vertices with a given region label...")      
 
-                    outputTimeseries = np.zeros((int(numRegions),int(numTRs)))
+                    outputTimeseries = np.zeros((int(numRegions),int(numTRs)),dtype=dtypeHere)
+                    if computeQC:
+                        qcTable = {columnName:np.zeros(int(numRegions)) for columnName in qcColumns}
 
                     for regionNum in range(int(numRegions)): 
                         regionLabelHere = int(atlasLabels_Masked[regionNum])
@@ -311,7 +391,7 @@ def parcellate_timeseries(inputAtlasLabels_File,
                         ################################################################################################
                         # Aggregate vertices in given parcel based on method chosen; taking the mean is most common 
                         if parcellationMethod=='mean':    
-                            outputTimeseries[regionNum,:] = np.nanmean(inputTimeseries[regionIndicesHere,:],axis=0).copy()
+                            outputTimeseries[regionNum,:] = np.nanmean(inputTimeseries[regionIndicesHere,:],axis=0,dtype=np.float64)
 
                         elif parcellationMethod=='min':
                             outputTimeseries[regionNum,:] = np.nanmin(inputTimeseries[regionIndicesHere,:],axis=0).copy()               
@@ -320,10 +400,17 @@ def parcellate_timeseries(inputAtlasLabels_File,
                             outputTimeseries[regionNum,:] = np.nanmax(inputTimeseries[regionIndicesHere,:],axis=0).copy()
 
                         elif parcellationMethod=='sum':
-                            outputTimeseries[regionNum,:] = np.nansum(inputTimeseries[regionIndicesHere,:],axis=0).copy()
+                            outputTimeseries[regionNum,:] = np.nansum(inputTimeseries[regionIndicesHere,:],axis=0,dtype=np.float64)
 
                         elif parcellationMethod=='stdev':
-                            outputTimeseries[regionNum,:] = np.nanstd(inputTimeseries[regionIndicesHere,:],axis=0).copy()
+                            outputTimeseries[regionNum,:] = np.nanstd(inputTimeseries[regionIndicesHere,:],axis=0,dtype=np.float64)
+
+                        # QC metrics from the same vertices (no extra read of the dense timeseries)
+                        if computeQC:
+                            qcHere = parcel_qc_metrics(inputTimeseries[regionIndicesHere,:])
+                            qcHere['parcel_label'] = regionLabelHere
+                            for columnName in qcColumns:
+                                qcTable[columnName][regionNum] = qcHere[columnName]
                             
                     ################################################################################################
                     # Save parcellated timeseries and return
@@ -333,5 +420,26 @@ def parcellate_timeseries(inputAtlasLabels_File,
                         if verbose:
                             print(f"Saving parcellated timeseries to: {outputTimeseries_Path + outFileName}...")
                         np.save(outputTimeseries_Path + outFileName,outputTimeseries)
+                        
+                        if saveCifti:
+                            if templateCifti_File is None and inputTimeseries_File.endswith('.dtseries.nii'):
+                                templateCifti_File = inputTimeseries_File
+                            if templateCifti_File is None:
+                                print(f"WARNING: saveCifti=True requires templateCifti_File for .npy inputs; skipping .ptseries.nii output.")
+                            else:
+                                outFileName_Cifti = outFileName.replace('.npy','.ptseries.nii')
+                                if verbose:
+                                    print(f"Saving parcellated timeseries to: {outputTimeseries_Path + outFileName_Cifti}...")
+                                cifti_utils.write_ptseries(outputTimeseries,templateCifti_File,outputTimeseries_Path + outFileName_Cifti,
+                                                           atlasLabels=atlasLabels,dropOutVals=dropOutVals)
+
+                        if computeQC:
+                            outFileName_QC = subjID_Str + '_' + funcRun_Str + '_Parcel_QC_' + atlasSave_Str + '.csv'
+                            if verbose:
+                                print(f"Saving parcel QC table to: {outputTimeseries_Path + outFileName_QC}...")
+                            save_qc_table(qcTable,outputTimeseries_Path + outFileName_QC,subjID_Str=subjID_Str,funcRun_Str=funcRun_Str)
+
+                    if computeQC:
+                        return outputTimeseries,qcTable
 
                     return outputTimeseries
\ No newline at end of file
@@ -4,6 +4,7 @@
 
 import numpy as np
 import nibabel as nib
+import precision_utils # see precision_utils.py
 
 def parcellate_timeseries(inputAtlasLabels_File,
                           inputTimeseries_File,
@@ -14,6 +15,7 @@ def parcellate_timeseries(inputAtlasLabels_File,
                           funcRun_Str='',
                           atlasSave_Str='Atlas_From_Vol',
                           parcellationMethod='mean',
+                          precision='float64',
                           verbose=True):
     
     '''
@@ -45,6 +47,8 @@ def parcellate_timeseries(inputAtlasLabels_File,
                                 https://www.humanconnectome.org/software/workbench-command/-cifti-parcellate); 
                                 NOTE: currently supports exact string usage (i.e., will not support 'MEAN', 
                                 must be 'mean'), but will fix in future. Default is mean.
+        precision             : Optional. 'float64' (default) or 'float32'. Precision the timeseries is loaded in and 
+                                the output is returned/saved in (parcel means/sums are always accumulated in float64).
         verbose               : Optional. default is True to return prints of all steps of the function 
                                 (useful for debugging).
                                 
@@ -77,13 +81,15 @@ def parcellate_timeseries(inputAtlasLabels_File,
 
     ################################################################################################
     # Load data:
+    # NOTE: previously cast to int here, which truncated the (float) timeseries values 
+    dtypeHere = precision_utils.get_dtype(precision)
     if inputTimeseries_File.endswith('.nii.gz'):
-        dataHere = nib.load(inputTimeseries_File).get_fdata().astype(int).copy()
+        dataHere = nib.load(inputTimeseries_File).get_fdata(dtype=dtypeHere)
         if verbose:
             print(f"Loading volumetric timeseries file {inputTimeseries_File}...")
         
     elif inputTimeseries_File.endswith('.npy'):
-        dataHere = np.load(inputTimeseries_File).copy()
+        dataHere = np.asarray(np.load(inputTimeseries_File),dtype=dtypeHere)
         if verbose:
             print(f"Loading volumetric timeseries file {inputTimeseries_File}...")
             
@@ -112,14 +118,14 @@ def parcellate_timeseries(inputAtlasLabels_File,
         
         numRegions = np.unique(atlasLabels)[-1]
         
-        dataHere_Parcels = np.zeros((numRegions,numTRs))
+        dataHere_Parcels = np.zeros((numRegions,numTRs),dtype=dtypeHere)
         for regionIx in range(numRegions):
             r,c,d = np.where(atlasLabels==(regionIx+1))
             
             ################################################################################################
             # Aggregate vertices in given parcel based on method chosen; taking the mean is most common 
             if parcellationMethod=='mean':    
-                dataHere_Parcels[regionIx,:] = np.nanmean(dataHere[r,c,d,:],axis=0).copy()
+                dataHere_Parcels[regionIx,:] = np.nanmean(dataHere[r,c,d,:],axis=0,dtype=np.float64)
 
             elif parcellationMethod=='min':
                 dataHere_Parcels[regionIx,:] = np.nanmin(dataHere[r,c,d,:],axis=0).copy()
@@ -128,10 +134,10 @@ def parcellate_timeseries(inputAtlasLabels_File,
                 dataHere_Parcels[regionIx,:] = np.nanmax(dataHere[r,c,d,:],axis=0).copy()
 
             elif parcellationMethod=='sum':
-                dataHere_Parcels[regionIx,:] = np.nansum(dataHere[r,c,d,:],axis=0).copy()
+                dataHere_Parcels[regionIx,:] = np.nansum(dataHere[r,c,d,:],axis=0,dtype=np.float64)
 
             elif parcellationMethod=='stdev':
-                dataHere_Parcels[regionIx,:] = np.nanstd(dataHere[r,c,d,:],axis=0).copy()
+                dataHere_Parcels[regionIx,:] = np.nanstd(dataHere[r,c,d,:],axis=0,dtype=np.float64)
                 
         ################################################################################################
         # Save parcellated timeseries and return
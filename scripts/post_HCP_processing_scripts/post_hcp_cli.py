@@ -0,0 +1,252 @@
+# C. Cocuzza, 2023. Command line entry point (and long-lived worker) for the python steps of post_hcp_main.sh.
+
+# post_hcp_main.sh used to start a new python interpreter for every step (python3 -c "import sys; sys.path.insert(...);
+# import ..."), so each of the hundreds of steps per participant paid interpreter + numpy + nibabel (+ scipy) start up.
+# This script:
+# (1) only imports the python standard library at start up; the module of a stage is imported the first time that
+#     stage is run (stageRegistry below), and this script's directory is added to sys.path (no hard-coded paths).
+# (2) "run": runs 1 stage in this process (same as the old python3 -c calls).
+# (3) "worker": a long-lived process that receives stage jobs over a local (unix) socket, or from a queue directory
+#     (for file systems / clusters where sockets are not an option), and runs them 1 at a time. Imported modules, and
+#     their caches (atlas files, masks, gzip indices, HCP constants), stay loaded between jobs.
+# (4) "submit": sends 1 job to a worker and waits for it; prints the job's output and exits with status 1 if the job
+#     failed (so post_hcp_main.sh can treat it like any other command). Only the standard library is imported.
+# Only stages in stageRegistry can be run (jobs name a stage, not arbitrary code); arguments are python literals.
+# NOTE: this is a script entry point, not an installable package / console script: like the rest of
+# post_HCP_processing_scripts/, it is run in place (python3 <path>/post_hcp_cli.py ...), as post_hcp_main.sh does.
+
+# Usage examples:
+#   python3 post_hcp_cli.py list
+#   python3 post_hcp_cli.py run variance_normalize --args "['<in>.nii.gz','<outDir>/','<name>_vn']" --kwargs "{'precision':'float32'}"
+#   python3 post_hcp_cli.py worker --socket /tmp/post_hcp_worker.sock &
+#   python3 post_hcp_cli.py submit variance_normalize --socket /tmp/post_hcp_worker.sock --args "[...]" --kwargs "{...}"
+#   python3 post_hcp_cli.py stop --socket /tmp/post_hcp_worker.sock
+
+################################################
+# IMPORTS (standard library only; see note 1 above)
+import os
+import sys
+import ast
+import io
+import json
+import time
+import uuid
+import socket
+import argparse
+import importlib
+import traceback
+import contextlib
+
+scriptsDir = os.path.dirname(os.path.abspath(__file__))
+if scriptsDir not in sys.path:
+    sys.path.insert(0,scriptsDir)
+
+################################################
+# Stages: name --> 'module:function' (imported on first use)
+stageRegistry = {'create_masks':'create_masks_HCP:create_masks_HCP',
+                 'variance_normalize':'variance_normalize_timeseries:variance_normalize',
+                 'variance_normalize_runs':'run_scheduler:variance_normalize_runs',
+                 'gsr_from_surface':'gsr_from_surface:gsr_from_surface',
+                 'gsr_from_surface_runs':'run_scheduler:gsr_from_surface_runs',
+                 'acompcor_denoising':'acompcor_denoising:acompcor_denoising',
+                 'acompcor_denoising_runs':'run_scheduler:acompcor_denoising_runs',
+                 'parcellate_timeseries':'parcellate_timeseries:parcellate_timeseries',
+                 'parcellate_timeseries_from_volume':'parcellate_timeseries_from_volume:parcellate_timeseries',
+                 'fc_estimation':'fcEstimation:fcEstimation',
+                 'fc_aggregation':'fc_aggregation:aggregate_fc_runs',
+                 'dynamic_fc_estimation':'dynamic_fc:dynamic_fc_estimation',
+                 'network_metrics':'network_metrics:network_metrics_from_files',
+                 'edgewise_icc':'fc_reliability:edgewise_icc_from_files',
+                 'cpm':'fc_cpm:cpm_from_files',
+                 'build_hcp_constants':'hcp_constants:build_hcp_constants'}
+
+shutdownStage = '__shutdown__'
+
+def get_stage_function(stageName):
+    '''Imports (on first use) and returns the function registered for <stageName>.'''
+    if stageName not in stageRegistry:
+        raise KeyError(f"Stage {stageName} not recognized; options: {sorted(stageRegistry.keys())}")
+    moduleName,functionName = stageRegistry[stageName].split(':')
+    return getattr(importlib.import_module(moduleName),functionName)
+
+def run_job(jobHere,captureOutput=False):
+    '''
+    Runs 1 job ({'stage':..., 'args':[...], 'kwargs':{...}}). Returns a reply dictionary: 'status' ('ok' or 'error'),
+    'error' (traceback, if any), 'output' (printed output, if captureOutput), and 'seconds'.
+    '''
+    startTime = time.time()
+    outputBuffer = io.StringIO()
+    replyHere = {'status':'ok'}
+    try:
+        stageFunction = get_stage_function(jobHere['stage'])
+        with (contextlib.redirect_stdout(outputBuffer) if captureOutput else contextlib.nullcontext()):
+            stageFunction(*jobHere.get('args',[]),**jobHere.get('kwargs',{}))
+    except KeyboardInterrupt:
+        raise
+    except BaseException: # incl. SystemExit (e.g., sys.exit in a stage), so the worker keeps running and the client gets the error
+        replyHere = {'status':'error','error':traceback.format_exc()}
+    replyHere['output'] = outputBuffer.getvalue()
+    replyHere['seconds'] = time.time() - startTime
+    return replyHere
+
+def parse_literal(argStr,defaultValue):
+    '''Python literal (list / dict) from the command line; e.g., "['a',1]" or "{'precision':'float32'}".'''
+    return defaultValue if argStr is None else ast.literal_eval(argStr)
+
+################################################
+# Worker: socket
+def _recv_line(connHere):
+    chunkList = []
+    while True:
+        chunkHere = connHere.recv(65536)
+        if not chunkHere:
+            break
+        chunkList.append(chunkHere)
+        if chunkHere.endswith(b'\n'):
+            break
+    return b''.join(chunkList).decode()
+
+def serve_socket(socketPath,preloadModules=('numpy','nibabel'),verbose=True):
+    '''Runs jobs received on a unix socket (1 JSON job per connection; the reply is sent back when the job is done).'''
+    for moduleName in preloadModules:
+        importlib.import_module(moduleName)
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    serverSocket = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    serverSocket.bind(socketPath)
+    os.chmod(socketPath,0o600) # only this user can submit jobs
+    serverSocket.listen(8)
+    if verbose:
+        print(f"post_hcp worker (pid {os.getpid()}) listening on {socketPath}",flush=True)
+    try:
+        while True:
+            connHere,_ = serverSocket.accept()
+            with connHere:
+                jobHere = json.loads(_recv_line(connHere))
+                if jobHere.get('stage')==shutdownStage:
+                    connHere.sendall((json.dumps({'status':'ok','output':'','seconds':0})+'\n').encode())
+                    break
+                replyHere = run_job(jobHere,captureOutput=True)
+                if verbose:
+                    print(f"{jobHere['stage']}: {replyHere['status']} ({replyHere['seconds']:.1f} s)",flush=True)
+                connHere.sendall((json.dumps(replyHere)+'\n').encode())
+    finally:
+        serverSocket.close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+
+def submit_socket(socketPath,jobHere):
+    clientSocket = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    with clientSocket:
+        clientSocket.connect(socketPath)
+        clientSocket.sendall((json.dumps(jobHere)+'\n').encode())
+        return json.loads(_recv_line(clientSocket))
+
+################################################
+# Worker: queue directory
+def serve_queue_dir(queueDir,pollSeconds=0.2,preloadModules=('numpy','nibabel'),verbose=True):
+    '''
+    Runs jobs written to <queueDir> as <id>.job (JSON), oldest first; each job is renamed to <id>.running while it runs,
+    and the reply is written to <id>.result.
+    '''
+    for moduleName in preloadModules:
+        importlib.import_module(moduleName)
+    if not os.path.isdir(queueDir):
+        os.makedirs(queueDir)
+    if verbose:
+        print(f"post_hcp worker (pid {os.getpid()}) watching {queueDir}",flush=True)
+    while True:
+        jobFiles = sorted((fileName for fileName in os.listdir(queueDir) if fileName.endswith('.job')),
+                          key=lambda fileName: os.path.getmtime(os.path.join(queueDir,fileName)))
+        if not jobFiles:
+            time.sleep(pollSeconds)
+            continue
+        jobId = jobFiles[0][:-len('.job')]
+        runningFile = os.path.join(queueDir,jobId + '.running')
+        os.replace(os.path.join(queueDir,jobId + '.job'),runningFile)
+        with open(runningFile) as fileHere:
+            jobHere = json.load(fileHere)
+        if jobHere.get('stage')==shutdownStage:
+            replyHere = {'status':'ok','output':'','seconds':0}
+        else:
+            replyHere = run_job(jobHere,captureOutput=True)
+            if verbose:
+                print(f"{jobHere['stage']}: {replyHere['status']} ({replyHere['seconds']:.1f} s)",flush=True)
+        with open(runningFile + '.tmp','w') as fileHere:
+            json.dump(replyHere,fileHere)
+        os.replace(runningFile + '.tmp',os.path.join(queueDir,jobId + '.result'))
+        os.remove(runningFile)
+        if jobHere.get('stage')==shutdownStage:
+            break
+
+def submit_queue_dir(queueDir,jobHere,pollSeconds=0.2):
+    jobId = uuid.uuid4().hex
+    with open(os.path.join(queueDir,jobId + '.tmp'),'w') as fileHere:
+        json.dump(jobHere,fileHere)
+    os.replace(os.path.join(queueDir,jobId + '.tmp'),os.path.join(queueDir,jobId + '.job'))
+    resultFile = os.path.join(queueDir,jobId + '.result')
+    while not os.path.isfile(resultFile):
+        time.sleep(pollSeconds)
+    with open(resultFile) as fileHere:
+        replyHere = json.load(fileHere)
+    os.remove(resultFile)
+    return replyHere
+
+################################################
+# Command line
+def main(argList=None):
+    parser = argparse.ArgumentParser(description='Python steps of post_hcp_main.sh (see notes at top of post_hcp_cli.py).')
+    subParsers = parser.add_subparsers(dest='command',required=True)
+
+    subParsers.add_parser('list',help='List available stages.')
+    for commandName in ['run','submit']:
+        subParser = subParsers.add_parser(commandName,help='Run a stage here.' if commandName=='run' else 'Send a stage job to a worker.')
+        subParser.add_argument('stage')
+        subParser.add_argument('--args',default=None,help='Python literal list of positional arguments.')
+        subParser.add_argument('--kwargs',default=None,help='Python literal dict of keyword arguments.')
+    for commandName in ['worker','submit','stop']:
+        subParser = subParsers.choices.get(commandName) or subParsers.add_parser(commandName,help='Start a worker.' if commandName=='worker' else 'Stop a worker.')
+        subParser.add_argument('--socket',default=None,help='Unix socket path.')
+        subParser.add_argument('--queue-dir',default=None,help='Queue directory (alternative to --socket).')
+
+    argsHere = parser.parse_args(argList)
+
+    if argsHere.command=='list':
+        for stageName in sorted(stageRegistry.keys()):
+            print(f"{stageName}: {stageRegistry[stageName]}")
+        return 0
+
+    if argsHere.command=='run':
+        jobHere = {'stage':argsHere.stage,'args':parse_literal(argsHere.args,[]),'kwargs':parse_literal(argsHere.kwargs,{})}
+        replyHere = run_job(jobHere,captureOutput=False)
+        if replyHere['status']!='ok':
+            print(replyHere['error'],file=sys.stderr)
+            return 1
+        return 0
+
+    if argsHere.socket is None and argsHere.queue_dir is None:
+        parser.error(f"{argsHere.command} requires --socket or --queue-dir")
+
+    if argsHere.command=='worker':
+        if argsHere.socket is not None:
+            serve_socket(argsHere.socket)
+        else:
+            serve_queue_dir(argsHere.queue_dir)
+        return 0
+
+    if argsHere.command=='submit':
+        jobHere = {'stage':argsHere.stage,'args':parse_literal(argsHere.args,[]),'kwargs':parse_literal(argsHere.kwargs,{})}
+    else:
+        jobHere = {'stage':shutdownStage}
+    if argsHere.socket is not None:
+        replyHere = submit_socket(argsHere.socket,jobHere)
+    else:
+        replyHere = submit_queue_dir(argsHere.queue_dir,jobHere)
+    sys.stdout.write(replyHere.get('output',''))
+    if replyHere['status']!='ok':
+        print(replyHere['error'],file=sys.stderr)
+        return 1
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
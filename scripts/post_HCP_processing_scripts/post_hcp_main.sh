@@ -66,6 +66,10 @@ Usage: post_hcp_main.sh [options]
                                                           Required before surface based GSR and maybe runTaskDenoising. 
     --runCreateMasks_ICAFIX_MultiRun=<"true">  (optional) "true" to create physiological masks; multi-run ICA-FIX'd data. 
                                                           Required before surface based GSR and maybe runTaskDenoising. 
+    --maskBuilder="python"                     (optional) Tool used by the 3 runCreateMasks options above: "python" (default) 
+                                                          uses create_masks_HCP.py (wmparc loaded once; resampling/dilation/erosion 
+                                                          shared across runs on the same functional grid; anatomical masks shared 
+                                                          across variants); "afni" uses create_masks_HCP.sh (1 call per run).
     --runGSR_Vol_NonVN=<"true">                (optional) "true" to run GSR. Performed per functional run. 
                                                           This variant: GSR on ICA-FIX'd, non-variance-normalized 
                                                           volumetric timeseries.
@@ -90,9 +94,9 @@ Usage: post_hcp_main.sh [options]
                                                           (dense) timeseries. Saved with "MSMAll_vn" to avoid overwriting 
                                                           above. NOTE: this variant requires variance normalizing in-script
                                                           (HCP does not perform this for some reason).
-    --runTaskDenoising=<"true">                (optional) "true" to run non-ICA-FIX rest denoising 
+    --runTaskDenoising=<"true">                (optional) "true" to run non-ICA-FIX task denoising 
                                                           (motion regression + aCompCor).
-    --runRestDenoising=<"true">                (optional) Input "true" to run non-ICA-FIX task denoising 
+    --runRestDenoising=<"true">                (optional) Input "true" to run non-ICA-FIX rest denoising 
                                                           (motion regression + aCompCor).
     --runParcellateData=<"true">               (optional) Input "true" to parcellate (vertices >> regions) using various 
                                                           popular atlases.
@@ -129,6 +133,13 @@ Usage: post_hcp_main.sh [options]
                                                           Default is "false".
     --fcUseVN=<"false">                        (optional) "true" to use variance normalized data in FC estimation.
                                                           Default is "false".
+    --computePrecision="float64"               (optional) Input "float32" to load/compute/save in single precision in the python 
+                                                          steps (variance normalization, GSR, parcellation, FC). Means and 
+                                                          Gram matrices are still accumulated in float64; see 
+                                                          precision_utils.py for accuracy vs. the default "float64".
+    --pyWorker=<"true">                       (optional) "true" to run all python steps in 1 long-lived python worker (see 
+                                                          post_hcp_cli.py), instead of starting python (numpy, nibabel, etc.)
+                                                          for every step. Default: a new python process per step.
     --fcExtraSaveStr=<"">                      (optional) Input string of your choosing to tag onto saved FC estimates 
                                                           file names. Default is an empty string.
     --runRestFC=<"true">                       (optional) "true" to estimate resting-state functional connectivity (rest-FC) 
@@ -165,6 +176,8 @@ dirSetUp=`opts_GetOpt1 "--dirSetUp" $@`
 runCreateMasks_NotDenoised=`opts_GetOpt1 "--runCreateMasks_NotDenoised" $@`
 runCreateMasks_ICAFIX_SingleRun=`opts_GetOpt1 "--runCreateMasks_ICAFIX_SingleRun" $@`
 runCreateMasks_ICAFIX_MultiRun=`opts_GetOpt1 "--runCreateMasks_ICAFIX_MultiRun" $@`
+maskBuilder=`opts_GetOpt1 "--maskBuilder" $@`
+if [ -z "$maskBuilder" ]; then maskBuilder="python"; fi
 
 runGSR_Vol_NonVN=`opts_GetOpt1 "--runGSR_Vol_NonVN" $@`
 runGSR_Vol_NonVN_NonDenoised=`opts_GetOpt1 "--runGSR_Vol_NonVN_NonDenoised" $@`
@@ -190,6 +203,7 @@ runTaskNetMetricsGeneral=`opts_GetOpt1 "--runTaskNetMetricsGeneral" $@`
 runTaskNetMetricsByCond=`opts_GetOpt1 "--runTaskNetMetricsByCond" $@`
 
 runGSR_Vol_VN_TEST=`opts_GetOpt1 "--runGSR_Vol_VN_TEST" $@`
+pyWorker=`opts_GetOpt1 "--pyWorker" $@`
 
 fcMethod=`opts_GetOpt1 "--fcMethod" $@`
 fcDataType=`opts_GetOpt1 "--fcDataType" $@`
@@ -198,6 +212,8 @@ fcDenoisingType=`opts_GetOpt1 "--fcDenoisingType" $@`
 fcUseGSR=`opts_GetOpt1 "--fcUseGSR" $@`
 fcUseVN=`opts_GetOpt1 "--fcUseVN" $@`
 fcExtraSaveStr=`opts_GetOpt1 "--fcExtraSaveStr" $@`
+computePrecision=`opts_GetOpt1 "--computePrecision" $@`
+if [ -z "$computePrecision" ]; then computePrecision="float64"; fi
 
 # Check for required input argument: --subj=participant_ID. participant_ID should match the string used throughout your project's directories. 
 if [ -z "$subj" ]; then 
@@ -209,6 +225,38 @@ fi
 
 ########################################################
 
+########################################################
+# Python steps: run through post_hcp_cli.py (stage name + python literal arguments). With --pyWorker=true, 1 worker 
+# process is started here and every step is sent to it (numpy, nibabel, atlas files, etc. are loaded once).
+pyCLI="${baseDir_Scripts}post_hcp_cli.py"
+
+run_python_stage() {
+    # Usage: run_python_stage <stage name> "<python list of positional arguments>" ["<python dict of keyword arguments>"]
+    # Exits this script if the stage fails (later steps use its outputs).
+    if [ -n "$pyWorkerSocket" ]; then
+        python3 ${pyCLI} submit $1 --socket ${pyWorkerSocket} --args "$2" --kwargs "${3:-{\}}"
+    else
+        python3 ${pyCLI} run $1 --args "$2" --kwargs "${3:-{\}}"
+    fi
+    stageStatus=$?
+    if [ $stageStatus -ne 0 ]; then
+        echo "ERROR: python stage $1 failed (exit status ${stageStatus}); stopping."
+        exit $stageStatus
+    fi
+}
+
+if [ "$pyWorker" = true ]; then
+    pyWorkerSocket="/tmp/post_hcp_worker_${subj}_$$.sock"
+    python3 ${pyCLI} worker --socket ${pyWorkerSocket} &
+    trap "python3 ${pyCLI} stop --socket ${pyWorkerSocket} > /dev/null" EXIT
+    for waitIx in $(seq 1 300); do 
+        if [ -S "$pyWorkerSocket" ]; then break; fi
+        sleep 0.1
+    done
+fi
+
+########################################################
+
 ########################################################
 # Directory set up: 
 
@@ -355,21 +403,40 @@ elif [ $dirSetUp = true ]; then
 fi
 ########################################################
 
+########################################################
+# Physiological masks for 1 data variant (see --maskBuilder); the 3 sections below differ only in the file names.
+run_create_masks() {
+    # Usage: run_create_masks <file suffix> (e.g., "" for non-denoised, "_hp2000_clean" for single-run ICA-FIX'd data)
+    local fileSuffix=$1
+    if [ "$maskBuilder" = "afni" ]; then
+        for runName in "${funcRunNames_Present[@]}" ; do
+            echo "....on ${runName}${fileSuffix}..."
+            sh ${baseDir_Scripts}create_masks_HCP.sh ${subj} ${runName} ${runName}${fileSuffix} ${baseDir_Input_Data} ${baseDir_Output_Data}
+        done
+    elif [ "$maskBuilder" = "python" ]; then
+        local runDirListStr=""
+        local runFileListStr=""
+        for runName in "${funcRunNames_Present[@]}" ; do
+            runDirListStr="${runDirListStr}'${runName}',"
+            runFileListStr="${runFileListStr}'${runName}${fileSuffix}',"
+        done
+        run_python_stage create_masks "['${subj}',[${runDirListStr}],[${runFileListStr}],'${baseDir_Input_Data}','${baseDir_Output_Data}']"
+    else
+        echo -e "ERROR: --maskBuilder=${maskBuilder} not recognized (options: python, afni); masks not created.\n"
+    fi
+}
+
 ########################################################
 # Create physiological masks: use non-denoised data here.
 # NOTE: This is required before running alternative denoising (next sections). 
-# This section calls: create_masks_HCP.sh 
+# This section calls: create_masks_HCP.py (or create_masks_HCP.sh) 
 
 if [ -z "$runCreateMasks_NotDenoised" ]; then
     echo -e "Skipping physiological mask creation (non-denoised data).\n"
 elif [ $runCreateMasks_NotDenoised = true ]; then
     echo -e "Running physiological mask creation (non-denoised data)...\n"
     
-    # Create masks:
-    for runName in "${funcRunNames_Present[@]}" ; do
-        echo "....on ${runName}..."
-        sh ${baseDir_Scripts}create_masks_HCP.sh ${subj} ${runName} ${runName} ${baseDir_Input_Data} ${baseDir_Output_Data}
-    done
+    run_create_masks ""
     
 fi
 ########################################################
@@ -377,19 +444,14 @@ fi
 ########################################################
 # Create physiological masks: use ICA-FIX'd (single run; i.e., each run denoised by itself) data here.
 # NOTE: This is required before running surface-based GSR and potentially some alternative denoising steps.
-# This section calls: create_masks_HCP.sh 
+# This section calls: create_masks_HCP.py (or create_masks_HCP.sh) 
 
 if [ -z "$runCreateMasks_ICAFIX_SingleRun" ]; then
     echo -e "Skipping physiological mask creation (single run ICA-FIX'd data).\n"
 elif [ $runCreateMasks_ICAFIX_SingleRun = true ]; then
     echo -e "Running physiological mask creation (single run ICA-FIX'd data)...\n"
     
-    # Create masks:
-    for runName in "${funcRunNames_Present[@]}" ; do
-        runNameHere="${runName}_hp2000_clean"
-        echo "....on ${runNameHere}..."
-        sh ${baseDir_Scripts}create_masks_HCP.sh ${subj} ${runName} ${runNameHere} ${baseDir_Input_Data} ${baseDir_Output_Data}
-    done
+    run_create_masks "_hp2000_clean"
     
 fi
 
@@ -398,19 +460,14 @@ fi
 ########################################################
 # Create physiological masks: use ICA-FIX'd (single run; i.e., each run denoised by itself) data here.
 # NOTE: This is required before running surface-based GSR and potentially some alternative denoising steps.
-# This section calls: create_masks_HCP.sh 
+# This section calls: create_masks_HCP.py (or create_masks_HCP.sh) 
 
 if [ -z "$runCreateMasks_ICAFIX_MultiRun" ]; then
     echo -e "Skipping physiological mask creation (multi-run ICA-FIX'd data).\n"
 elif [ $runCreateMasks_ICAFIX_MultiRun = true ]; then
     echo -e "Running physiological mask creation (multi-run ICA-FIX'd data)...\n"
     
-    # Create masks:
-    for runName in "${funcRunNames_Present[@]}" ; do
-        runNameHere="${runName}_hp0_clean"
-        echo "....on ${runNameHere}..."
-        sh ${baseDir_Scripts}create_masks_HCP.sh ${subj} ${runName} ${runNameHere} ${baseDir_Input_Data} ${baseDir_Output_Data}
-    done
+    run_create_masks "_hp0_clean"
     
 fi
 
@@ -527,7 +584,7 @@ elif [ $runGSR_Vol_VN_TEST = true ]; then
     savePath="${baseDir_Output_Data}${subj}/variance_normalized_timeseries/"
     saveFile="${runName}_hp${bandpass}_clean_vn"
 
-    python3 -c "import sys; sys.path.insert(0, '${docsDir}'); import variance_normalize_timeseries as vnts; fileHere='${fileHere}'; savePath='${savePath}'; saveFile='${saveFile}'; vnts.variance_normalize(fileHere,savePath,saveFile)"        
+    run_python_stage variance_normalize "['${fileHere}','${savePath}','${saveFile}']" "{'precision':'${computePrecision}'}"
 
     # EXTRACT GLOBAL SIGNAL:
     #inputFileHere_Extract="${baseDir_Input_Data}/${subj}/MNINonLinear/Results/${runName}/${runName}_hp${bandpass}_clean_vn.nii.gz"
@@ -568,19 +625,22 @@ elif [ $runGSR_Vol_VN = true ]; then
     atlasFileHere="${baseDir_Scripts}/atlas_files/FC419_MNI2mm.nii.gz"
     filterHere=1
     
+    # VARIANCE NORMALIZE (all runs in 1 call): run_scheduler.py loads the next run while the current run is normalized, 
+    # and writes outputs in the background (see run_scheduler.py):
+    docsDir="${baseDir_Scripts}"
+    savePath="${baseDir_Output_Data}${subj}/variance_normalized_timeseries/"
+    fileListStr=""
+    saveFileListStr=""
+    for runName in "${funcRunNames_Present[@]}" ; do
+        fileListStr="${fileListStr}'${baseDir_Input_Data}${subj}/MNINonLinear/Results/${runName}/${runName}_hp${bandpass}_clean.nii.gz',"
+        saveFileListStr="${saveFileListStr}'${runName}_hp${bandpass}_clean_vn',"
+    done
+    run_python_stage variance_normalize_runs "[[${fileListStr}],'${savePath}',[${saveFileListStr}]]" "{'precision':'${computePrecision}'}"
+    
     # Run GSR on ICA-FIX'd (clean), variance-normalized, volumetric timeseries (takes 5-10 minutes):
     for runName in "${funcRunNames_Present[@]}" ; do
         echo "....on ${runName}..."
         
-        # VARIANCE NORMALIZE: 
-        docsDir="${baseDir_Scripts}"
-        dirHere="${baseDir_Input_Data}${subj}/MNINonLinear/Results/${runName}/"
-        fileHere="${dirHere}${runName}_hp${bandpass}_clean.nii.gz"
-        savePath="${baseDir_Output_Data}${subj}/variance_normalized_timeseries/"
-        saveFile="${runName}_hp${bandpass}_clean_vn"
-
-        python3 -c "import sys; sys.path.insert(0, '${docsDir}'); import variance_normalize_timeseries as vnts; fileHere='${fileHere}'; savePath='${savePath}'; saveFile='${saveFile}'; vnts.variance_normalize(fileHere,savePath,saveFile)"        
-
         # EXTRACT GLOBAL SIGNAL:
         #inputFileHere_Extract="${baseDir_Input_Data}/${subj}/MNINonLinear/Results/${runName}/${runName}_hp${bandpass}_clean_vn.nii.gz"
         inputFileHere_Extract="${baseDir_Output_Data}${subj}/variance_normalized_timeseries/${runName}_hp${bandpass}_clean_vn.nii.gz"
@@ -795,11 +855,43 @@ fi
 # Denoise rest data with motion regression and aCompCor:
 # NOTE: This is an alternative to ICA-FIX, and is supported by Ciric et al., 2017
 
-if [ -z "$restRestDenoising" ]; then
+if [ -z "$runRestDenoising" ]; then
     echo -e "Skipping rest denoising.\n"
-elif [ $restRestDenoising = true ]; then
+elif [ $runRestDenoising = true ]; then
     echo -e "Running rest denoising...\n"
     
+    # EDIT: these variables could be edited (see acompcor_denoising.py):
+    # motionModel: "6", "12", or "24" HCP movement regressors; useSpikes: "True" adds 1 regressor per TR with FD > fdThreshold.
+    numComponents=5
+    motionModel="12"
+    useSpikes="False"
+    fdThreshold=0.25
+    docsDir="${baseDir_Scripts}"
+    
+    # Run aCompCor (+ motion) on non-denoised (minimally preprocessed) data; requires runCreateMasks_NotDenoised. 
+    # Volume and surface (dense) data of each run are cleaned with the same regressors (1 shared solve). All runs in 1 
+    # call: run_scheduler.py extracts the next run's mask timeseries while the current run is denoised:
+    runNameListStr=""
+    wmMaskListStr=""
+    csfMaskListStr=""
+    volFileListStr=""
+    surfFileListStr=""
+    brainMaskListStr=""
+    movementFileListStr=""
+    for runName in "${funcRunNames_Present_REST[@]}" ; do
+        echo "....on ${runName}..."
+        runDirHere="${baseDir_Input_Data}/${subj}/MNINonLinear/Results/${runName}"
+        surfFileHere="${runDirHere}/${runName}_Atlas_MSMAll.dtseries.nii"
+        if [[ ! -f ${surfFileHere} ]] ; then surfFileHere="${runDirHere}/${runName}_Atlas.dtseries.nii"; fi
+        runNameListStr="${runNameListStr}'${runName}',"
+        wmMaskListStr="${wmMaskListStr}'${subjDir_Masks}/${subj}_${runName}_wmMask_func_eroded.nii.gz',"
+        csfMaskListStr="${csfMaskListStr}'${subjDir_Masks}/${subj}_${runName}_ventricles_func_eroded.nii.gz',"
+        volFileListStr="${volFileListStr}'${runDirHere}/${runName}.nii.gz',"
+        surfFileListStr="${surfFileListStr}'${surfFileHere}',"
+        brainMaskListStr="${brainMaskListStr}'${subjDir_Masks}/${subj}_${runName}_wholebrainmask_func_dil1vox.nii.gz',"
+        movementFileListStr="${movementFileListStr}'${runDirHere}/Movement_Regressors.txt',"
+    done
+    run_python_stage acompcor_denoising_runs "['${subj}',[${runNameListStr}],[${wmMaskListStr}],[${csfMaskListStr}],[${volFileListStr}],'${subjDir_Denoising}']" "{'timeSeriesSurfaceFileList':[${surfFileListStr}],'brainMaskFileList':[${brainMaskListStr}],'movementFileList':[${movementFileListStr}],'motionModel':'${motionModel}','useSpikeRegressors':${useSpikes},'fdThreshold':${fdThreshold},'numComponents':${numComponents},'precision':'${computePrecision}'}"
 fi
 
 ########################################################
@@ -879,43 +971,63 @@ if [ -z "$runTaskFCByCond" ]; then
     echo -e "Skipping task-FC (by condition) estimation.\n"
 elif [ $runTaskFCByCond = true ]; then
     echo -e "Running task-FC (by condition) estimation...\n"
+    # NOTE: save as FC_<subj>_<fcMethod>_<runName>_ByCond<fcExtraSaveStr>.npy (fcEstimation.py with fcForSepBlocks=True, 
+    # extraSaveStr="<runName>_ByCond<fcExtraSaveStr>"); runTaskNetMetricsByCond reads these files. 
     
 fi
 
 ########################################################
 
 ########################################################
-# Run common network diagnostics on rest-FC graphs
+# Run common network diagnostics on FC graphs (rest, task general, task by condition)
+# NOTE: all of this participant's FC files are stacked and run through network_metrics.py at once. 
+# FC files follow fcEstimation.py naming: FC_<subj>_<fcMethod>_<runName><fcFileTag><fcExtraSaveStr>.npy, where 
+# <fcFileTag> is "" for rest / task general FC (nodes x nodes, 1 per run), and "_ByCond" for task-FC by condition 
+# (nodes x nodes x conditions, 1 per run; fcEstimation.py with fcForSepBlocks=True; see runTaskFCByCond). 
+# EDIT: atlasVariant can be changed to "Cerebellum_Cortical_Nets" (see atlas_files/).
+
+if [ -z "$fcMethod" ]; then fcMethod="pearson"; fi
+atlasVariant="Cerebellum_Seperate"
+
+run_net_metrics() {
+    # Usage: run_net_metrics <FC directory> <fcFileTag> <output directory> <output tag> <run names...>
+    local fcDirHere=$1 fcFileTag=$2 outputDirHere=$3 outputTag=$4
+    shift 4
+    local fcFileListStr=""
+    for runName in "$@" ; do
+        fcFileHere="${fcDirHere}FC_${subj}_${fcMethod}_${runName}${fcFileTag}${fcExtraSaveStr}.npy"
+        if [ -f "$fcFileHere" ]; then
+            fcFileListStr="${fcFileListStr}'${fcFileHere}',"
+        else
+            echo "WARNING: FC file missing for run: ${runName} (${fcFileHere}). This run will be skipped."
+        fi
+    done
+    if [ -z "$fcFileListStr" ]; then
+        echo "WARNING: no FC files found for ${outputTag}; skipping network diagnostics."
+        return
+    fi
+    run_python_stage network_metrics "[[${fcFileListStr}],'${outputDirHere}','${subj}']" "{'extraSaveStr':'_${outputTag}_${fcMethod}${fcExtraSaveStr}','atlasVariant':'${atlasVariant}'}"
+}
 
 if [ -z "$runRestNetMetrics" ]; then
     echo -e "Skipping network diagnostics for rest-FC.\n"
 elif [ $runRestNetMetrics = true ]; then
     echo -e "Running network diagnostics for rest-FC...\n"
-    
+    run_net_metrics "${subjDir_FC_Rest}" "" "${subjDir_NetMetrics_Rest}" "RestFC" "${funcRunNames_Present_REST[@]}"
 fi
 
-########################################################
-
-########################################################
-# Run common network diagnostics on task-FC (general) graphs
-
 if [ -z "$runTaskNetMetricsGeneral" ]; then
     echo -e "Skipping network diagnostics for task-FC (general).\n"
 elif [ $runTaskNetMetricsGeneral = true ]; then
     echo -e "Running network diagnostics for task-FC (general)...\n"
-    
+    run_net_metrics "${subjDir_FC_Task}" "" "${subjDir_NetMetrics_Task}" "TaskFC_General" "${funcRunNames_Present_TASK[@]}"
 fi
 
-########################################################
-
-########################################################
-# Run common network diagnostics on task-FC (by condition) graphs
-
 if [ -z "$runTaskNetMetricsByCond" ]; then
     echo -e "Skipping network diagnostics for task-FC (by condition).\n"
 elif [ $runTaskNetMetricsByCond = true ]; then
     echo -e "Running network diagnostics for task-FC (by condition)...\n"
-    
+    run_net_metrics "${subjDir_FC_Task}" "_ByCond" "${subjDir_NetMetrics_Task}" "TaskFC_ByCond" "${funcRunNames_Present_TASK[@]}"
 fi
 
 ########################################################
\ No newline at end of file
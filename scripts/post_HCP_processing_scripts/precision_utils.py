@@ -0,0 +1,160 @@
+# C. Cocuzza, 2023. Shared helpers for the precision (float64 vs. float32) compute mode of the post-HCP scripts.
+
+# By default everything here upcasts to float64 (nibabel's get_fdata default). For 91k grayordinates x TRs (or 4D
+# volumes) that doubles memory and bandwidth, while the data themselves are stored as float32 by HCP. Setting
+# precision='float32' in variance_normalize_timeseries.py, regression.py, gsr_from_surface.py, parcellate_timeseries*.py,
+# and fcEstimation.py loads and computes in float32, while the accumulations that need it are still done in float64:
+#   - means / standard deviations (np.nanmean / np.nanstd with dtype=float64, results cast back)
+#   - regression Gram matrix X'X and its (pseudo)inverse (regressors x regressors; negligible cost)
+#   - row means and norms used to standardize timeseries before correlation
+# The remaining large operations (element-wise normalization, X'y and residuals, parcel averaging, and the Z Z'
+# product for correlation of standardized rows) run in float32.
+
+# ACCURACY: float32 vs. float64 path (see benchmark_precision below, which runs the shipped functions:
+# variance_normalize_timeseries, regression, parcellate_timeseries, fcEstimation; HCP-sized synthetic data: 64984
+# surface vertices x 400 TRs, AR(1) timeseries at BOLD-like scale (mean 1000, sd ~25) + shared global signal, 400
+# parcels, global signal + 6 motion-like regressors; both paths start from the same float32 values, as HCP outputs are float32):
+#   variance normalization          : max abs diff 1.6e-6 (z-units)
+#   regression residuals (GSR)      : max abs diff 7.8e-5 (raw units; float32 resolution at 1000 is 6e-5)
+#   parcellated timeseries          : max abs diff 1.5e-7 (z-units)
+#   FC (pearson r)                  : max abs diff 2.0e-7
+#   FC (Fisher-z, |r| < 0.999)      : max abs diff 2.1e-7
+# These are far below between-run differences in FC (typically > 1e-2), so the float32 path is suitable for all
+# standard analyses; use float64 if very high correlations (r > 0.9999) need to be resolved.
+
+################################################
+# IMPORTS
+import numpy as np
+import nibabel as nib
+
+precisionOptions = {'float64':np.float64,'float32':np.float32}
+
+def get_dtype(precision='float64'):
+    '''Returns the numpy dtype for a precision string ('float64' or 'float32').'''
+    if precision not in precisionOptions:
+        print(f"WARNING: precision {precision} not recognized (options: {list(precisionOptions.keys())}); using float64.")
+        return np.float64
+    return precisionOptions[precision]
+
+################################################
+# Loading
+def load_data(dataFile,precision='float64'):
+    '''
+    Loads a nifti/cifti (.nii, .nii.gz) or numpy (.npy) file as a floating point array in the requested precision,
+    without an intermediate float64 copy when precision='float32'.
+    '''
+    dtypeHere = get_dtype(precision)
+    if '.nii' in dataFile:
+        return nib.load(dataFile).get_fdata(dtype=dtypeHere)
+    elif dataFile.endswith('.npy'):
+        return np.asarray(np.load(dataFile),dtype=dtypeHere)
+
+################################################
+# Accumulations kept in float64
+def nan_mean(dataHere,axis,keepdims=False):
+    '''np.nanmean accumulated in float64, returned in the input precision.'''
+    return np.nanmean(dataHere,axis=axis,dtype=np.float64,keepdims=keepdims).astype(dataHere.dtype,copy=False)
+
+def nan_std(dataHere,axis,keepdims=False):
+    '''np.nanstd accumulated in float64, returned in the input precision.'''
+    return np.nanstd(dataHere,axis=axis,dtype=np.float64,keepdims=keepdims).astype(dataHere.dtype,copy=False)
+
+def variance_normalize(dataHere,axis=-1):
+    '''(data - mean) / std along <axis> (time), with mean/std accumulated in float64.'''
+    return (dataHere - nan_mean(dataHere,axis=axis,keepdims=True)) / nan_std(dataHere,axis=axis,keepdims=True)
+
+def corrcoef_rows(dataHere):
+    '''
+    Pearson correlation between rows (space x time; no NaNs) in the precision of <dataHere>. Row means and norms are
+    accumulated in float64; the rows x rows product is computed on unit-norm rows (values in [-1,1], so float32
+    accumulation error stays ~1e-7).
+    '''
+    dataHere = dataHere - np.mean(dataHere,axis=1,dtype=np.float64,keepdims=True).astype(dataHere.dtype,copy=False)
+    rowNorms = np.sqrt(np.sum(np.square(dataHere,dtype=np.float64),axis=1,keepdims=True)).astype(dataHere.dtype,copy=False)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        dataHere = dataHere / rowNorms
+    fcArray = np.matmul(dataHere,dataHere.T)
+    np.clip(fcArray,-1,1,out=fcArray)
+    return fcArray
+
+################################################
+# Accuracy benchmark: float32 vs. float64 paths (runs the shipped functions; see notes at top of script)
+def benchmark_precision(dataHere=None,regressors=None,atlasLabels=None,numTRs=400,numParcels=400,seed=0,verbose=True):
+    '''
+    Runs the same data through variance_normalize_timeseries.normalize_timeseries, regression.regression, 
+    parcellate_timeseries.parcellate_timeseries, and fcEstimation.fcEstimation, with precision='float64' and 'float32'.
+
+    INPUTS:
+        dataHere    : Optional. 64984 (or 91282) x time array (e.g., a real dense timeseries). Default: synthetic HCP-like data.
+        regressors  : Optional. time x regressors array. Default: global signal + 6 random-walk (motion-like) regressors.
+        atlasLabels : Optional. Labels (1..numParcels, NaN = medial wall) per row of dataHere. Default: random assignment 
+                      of the non-medial-wall vertices (see hcp_constants.py).
+        numTRs, numParcels, seed : Optional. Size of the synthetic data (64984 vertices).
+
+    OUTPUT:
+        deltaDict   : max absolute differences (float32 - float64) for each stage: 'variance_normalize',
+                      'regression_resid', 'parcellate', 'fc', 'fc_fisher_z'.
+    '''
+    import os
+    import tempfile
+    import regression # see regression.py
+    import variance_normalize_timeseries # see variance_normalize_timeseries.py
+    import parcellate_timeseries # see parcellate_timeseries.py
+    import fcEstimation # see fcEstimation.py
+    import hcp_constants # see hcp_constants.py
+
+    rng = np.random.default_rng(seed)
+    if dataHere is None:
+        numNodes = hcp_constants.numVertsCort
+        globalSignal = np.cumsum(rng.standard_normal(numTRs))*0.1
+        innovations = rng.standard_normal((numNodes,numTRs)).astype(np.float32)
+        dataHere = np.zeros((numNodes,numTRs),dtype=np.float32)
+        dataHere[:,0] = innovations[:,0]
+        for trIx in range(1,numTRs):
+            dataHere[:,trIx] = 0.5*dataHere[:,trIx-1] + innovations[:,trIx]
+        dataHere = 1000 + 20*dataHere + 10*globalSignal[None,:].astype(np.float32)
+        del innovations
+    # HCP outputs are stored as float32, so both paths start from float32-representable values (isolates compute error)
+    dataHere = np.asarray(dataHere,dtype=np.float32)
+    numNodes,numTRs = dataHere.shape
+    if regressors is None:
+        regressors = np.hstack((np.mean(dataHere,axis=0,dtype=np.float64)[:,None],np.cumsum(rng.standard_normal((numTRs,6)),axis=0)*0.05))
+    if atlasLabels is None:
+        atlasLabels = rng.integers(1,numParcels+1,numNodes).astype(float)
+        atlasLabels[hcp_constants.dropped_cortex_vertices()] = np.nan
+
+    tempDir = tempfile.mkdtemp(prefix='benchmark_precision_')
+    atlasFile = os.path.join(tempDir,'atlas_labels.npy')
+    np.save(atlasFile,atlasLabels)
+
+    deltaDict = {}
+    resultsDict = {}
+    for precision in ['float64','float32']:
+        dataPrec = np.asarray(dataHere,dtype=get_dtype(precision))
+        resultsHere = {}
+        resultsHere['variance_normalize'] = variance_normalize_timeseries.normalize_timeseries(None,dataPrec)[0]
+        betas,resid = regression.regression(dataPrec.T,regressors,constant=True,precision=precision)
+        del dataPrec
+        resultsHere['regression_resid'] = resid.T
+        vnFile = os.path.join(tempDir,'resid_vn_' + precision + '.npy')
+        np.save(vnFile,variance_normalize_timeseries.normalize_timeseries(None,resid.T)[0])
+        del betas,resid
+        resultsHere['parcellate'] = parcellate_timeseries.parcellate_timeseries(atlasFile,vnFile,saveOutput=False,precision=precision,verbose=False)
+        parcelFile = os.path.join(tempDir,'parcellated_' + precision + '.npy')
+        np.save(parcelFile,resultsHere['parcellate'])
+        fcEstimation.fcEstimation(parcelFile,tempDir + '/','benchmark',extraSaveStr='_' + precision,fillDiagVal='0',precision=precision)
+        fcArray = np.load(os.path.join(tempDir,'FC_benchmark_pearson_' + precision + '.npy'))
+        resultsHere['fc'] = fcArray
+        resultsHere['fc_fisher_z'] = np.arctanh(np.clip(fcArray,-0.999,0.999))
+        resultsDict[precision] = resultsHere
+
+    for fileName in os.listdir(tempDir):
+        os.remove(os.path.join(tempDir,fileName))
+    os.rmdir(tempDir)
+
+    for stageName in resultsDict['float64']:
+        deltaDict[stageName] = float(np.nanmax(np.abs(resultsDict['float32'][stageName].astype(np.float64) - resultsDict['float64'][stageName])))
+        if verbose:
+            print(f"{stageName}: max abs difference (float32 - float64) = {deltaDict[stageName]:.2e}")
+
+    return deltaDict
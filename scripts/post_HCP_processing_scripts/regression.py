@@ -5,8 +5,9 @@
 
 
 import numpy as np
+import precision_utils # see precision_utils.py
 
-def regression(data,regressors,alpha=0,constant=True):
+def regression(data,regressors,alpha=0,constant=True,precision='float64',factorization=None):
     """
     Taku Ito
     2/21/2019
@@ -18,28 +19,91 @@ def regression(data,regressors,alpha=0,constant=True):
         regressors = observation x feature matrix
         alpha = regularization term. 0 for regular multiple regression. >0 for ridge penalty
         constant = True/False - pad regressors with 1s?
+        precision = 'float64' (default) or 'float32'. With 'float32', data, X'y and residuals are float32, but the Gram 
+                    matrix X'X, its inverse, and the data means are computed in float64 (see precision_utils.py)
+        factorization = optional output of regression_factorize(). Use this to apply the same regressors to several 
+                        datasets (e.g., volume and surface data of 1 run, or chunks of voxels) with 1 shared solve; 
+                        regressors/alpha/constant/precision are then taken from the factorization.
     OUTPUT
         betas = coefficients X n target variables
-        resid = observations X n target variables
+        resid = observations X n target variables; data - X*betas (X: regressors, with the constant column if constant=True)
+    NOTE: before the precision option, resid was data - (betas[0] + X[:,1:]*betas[1:]) for any <constant>; same result
+    with constant=True, but with constant=False the 1st regressor's fit was subtracted as a constant (its values were
+    ignored). resid is now the least squares residual for both (no script here calls constant=False).
     """
-    # Add 'constant' regressor
-    if constant:
-        ones = np.ones((regressors.shape[0],1))
-        regressors = np.hstack((ones,regressors))
-    X = regressors.copy()
+    if factorization is None:
+        factorization = regression_factorize(regressors,alpha=alpha,constant=constant,precision=precision)
 
-    # construct regularization term
-    LAMBDA = np.identity(X.shape[1])*alpha
+    if factorization['precision']=='float32':
+        return _regression_float32(data,factorization)
 
-    # Least squares minimization
-    C_ss_inv = np.linalg.pinv(np.matmul(X.T,X) + LAMBDA)
+    X = factorization['X']
+    C_ss_inv = factorization['C_ss_inv']
     
     betas = np.dot(C_ss_inv,np.matmul(X.T,data))
     # Calculate residuals
-    resid = data - (betas[0] + np.matmul(X[:,1:],betas[1:]))
+    resid = data - np.matmul(X,betas)
 
     # Remove imaginary portion (will be all 0s anyway)
     betas = betas.real
     resid = resid.real
 
     return betas, resid
+
+
+def regression_factorize(regressors,alpha=0,constant=True,precision='float64'):
+    """
+    Precomputes the design matrix and (X'X + alpha*I)^(-1) for regression() (see its PARAMETERS; same meaning here).
+    The Gram matrix and its inverse are always float64 (regressors x regressors; negligible cost).
+    OUTPUT
+        factorization = dictionary to pass to regression(..., factorization=factorization)
+    """
+    # Unknown precision strings fall back to float64 (with a WARNING; see precision_utils.get_dtype)
+    precision = 'float32' if precision_utils.get_dtype(precision)==np.float32 else 'float64'
+    X = np.asarray(regressors,dtype=np.float64)
+    XMean = None
+
+    if precision=='float32':
+        # Constant handled by centering (see _regression_float32)
+        if constant:
+            XMean = np.mean(X,axis=0)
+            X = X - XMean
+    elif constant:
+        # Add 'constant' regressor
+        ones = np.ones((X.shape[0],1))
+        X = np.hstack((ones,X))
+
+    # construct regularization term
+    LAMBDA = np.identity(X.shape[1])*alpha
+
+    # Least squares minimization
+    C_ss_inv = np.linalg.pinv(np.matmul(X.T,X) + LAMBDA)
+
+    return {'X':X,'C_ss_inv':C_ss_inv,'XMean':XMean,'constant':constant,'precision':precision}
+
+
+def _regression_float32(data,factorization):
+    """
+    float32 version of regression() (same outputs). The constant is handled by centering data and regressors
+    (means accumulated in float64), so the large-magnitude part of the signal (e.g., BOLD ~1e3-1e4) never goes through
+    float32 products; X'X and its inverse are float64.
+    NOTE: with alpha > 0 the intercept is not penalized here (it is in the float64 path).
+    """
+    data = np.asarray(data,dtype=np.float32)
+    X = factorization['X']
+    C_ss_inv = factorization['C_ss_inv']
+
+    if factorization['constant']:
+        dataMean = np.mean(data,axis=0,dtype=np.float64)
+        data = data - dataMean.astype(np.float32)
+
+    X32 = X.astype(np.float32)
+    betas = np.dot(C_ss_inv,np.matmul(X32.T,data).astype(np.float64))
+
+    # Calculate residuals
+    resid = data - np.matmul(X32,betas.astype(np.float32))
+
+    if factorization['constant']:
+        betas = np.vstack((dataMean - np.matmul(factorization['XMean'],betas),betas))
+
+    return betas.astype(np.float32), resid
@@ -0,0 +1,186 @@
+# C. Cocuzza, 2023. Run scheduler that overlaps loading of the next run (and writing of the previous run) with compute.
+
+# In post_hcp_main.sh each run is loaded (multi-GB .nii.gz / .dtseries.nii), processed, and saved strictly in turn, so
+# the CPU waits on gzip decompression / file system reads, and the disk waits on compute. run_prefetched splits each
+# run into load -> compute -> save:
+# (1) a background thread loads (and decodes) the next run(s) while the current run is computed; at most
+#     <prefetchDepth> runs are loaded (or being loaded) and not yet computed at once (a slot is taken before a run is
+#     loaded, and freed when the run is handed to compute, so the loader never holds an extra run while it waits).
+# (2) outputs are written by background writer thread(s), with at most <maxPendingWrites> results waiting to be
+#     written (again, bounding memory).
+# Threads (not processes) are used: gzip decompression/compression (zlib) and numpy/BLAS release the GIL, so they do
+# run in parallel, and multi-GB arrays do not have to be pickled between processes.
+
+# In post_hcp_main.sh, variance_normalize_runs (runGSR_Vol_VN) and acompcor_denoising_runs (runRestDenoising) are used.
+# The GSR steps there run FSL tools (fslmeants / fsl_regfilt), 1 process per run, so they are not scheduled here;
+# gsr_from_surface_runs is for python callers of gsr_from_surface.py (no post_hcp_main.sh step uses it).
+
+# Peak memory is (prefetchDepth + 2 + maxPendingWrites) run-sized arrays: prefetched run(s), the run being computed
+# (its inputs and its result both exist at the end of computeFunc), and result(s) waiting to be (or being) written; the
+# defaults (1, 1) give 4 runs (measured).
+
+################################################
+# IMPORTS
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import variance_normalize_timeseries as vnts # see variance_normalize_timeseries.py
+
+################################################
+# Generic scheduler
+def run_prefetched(runList,loadFunc,computeFunc,saveFunc=None,prefetchDepth=1,numWriters=1,maxPendingWrites=1,verbose=False):
+    '''
+    INPUTS:
+        runList          : REQUIRED. A list; 1 entry per run (e.g., run names, or tuples of file names). Passed to each function below.
+        loadFunc         : REQUIRED. loadFunc(runHere) --> loaded inputs (runs on the prefetch thread).
+        computeFunc      : REQUIRED. computeFunc(runHere,loadedInputs) --> result (runs on the calling thread).
+        saveFunc         : OPTIONAL. saveFunc(runHere,result) (runs on a writer thread). If None, results are returned instead.
+        prefetchDepth    : OPTIONAL. Number of runs loaded (or being loaded) ahead of compute; default 1 (minimum 1).
+        numWriters       : OPTIONAL. Number of writer threads; default 1.
+        maxPendingWrites : OPTIONAL. Number of computed results that can wait to be written; default 1.
+        verbose          : OPTIONAL. If True, will print extra info.
+
+    OUTPUT:
+        resultsList      : computeFunc outputs (in run order) if saveFunc is None, else saveFunc outputs.
+        Errors raised in loadFunc / computeFunc / saveFunc are re-raised here (after pending writes finish).
+    '''
+    loadQueue = queue.Queue() # bounded by loadSlots, so put never blocks
+    loadSlots = threading.Semaphore(max(prefetchDepth,1))
+    stopEvent = threading.Event()
+
+    def _loader():
+        for runIx,runHere in enumerate(runList):
+            while not loadSlots.acquire(timeout=0.1):
+                if stopEvent.is_set():
+                    return
+            if stopEvent.is_set():
+                return
+            try:
+                loadedHere = loadFunc(runHere)
+                errorHere = None
+            except Exception as errorHere_:
+                loadedHere,errorHere = None,errorHere_
+            loadQueue.put((runIx,runHere,loadedHere,errorHere))
+            del loadedHere # otherwise this run stays referenced here while the loader waits for the next slot
+            if errorHere is not None:
+                return
+
+    loaderThread = threading.Thread(target=_loader,daemon=True)
+    loaderThread.start()
+
+    writeSlots = threading.BoundedSemaphore(maxPendingWrites)
+    futuresList = [None]*len(runList)
+    resultsList = [None]*len(runList)
+
+    def _save(runHere,resultHolder):
+        # The result is passed in a list and popped here, so it is freed before its write slot is (the executor keeps
+        # its own reference to the call's arguments until after the call returns)
+        resultHere = resultHolder.pop()
+        try:
+            return saveFunc(runHere,resultHere)
+        finally:
+            del resultHere
+            writeSlots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=numWriters) as writerPool:
+            for _ in range(len(runList)):
+                runIx,runHere,loadedHere,errorHere = loadQueue.get()
+                loadSlots.release()
+                if errorHere is not None:
+                    raise errorHere
+                if verbose:
+                    print(f"Computing run {runIx+1} of {len(runList)} ({runHere}); {loadQueue.qsize()} run(s) loaded and waiting...")
+                resultHere = computeFunc(runHere,loadedHere)
+                del loadedHere
+
+                if saveFunc is None:
+                    resultsList[runIx] = resultHere
+                else:
+                    writeSlots.acquire()
+                    futuresList[runIx] = writerPool.submit(_save,runHere,[resultHere])
+                del resultHere
+    finally:
+        stopEvent.set()
+        loaderThread.join()
+
+    if saveFunc is not None:
+        resultsList = [futureHere.result() for futureHere in futuresList]
+    return resultsList
+
+################################################
+# Stage wrappers
+def variance_normalize_runs(timeseriesFileList,savePathList,saveFileList,precision='float64',prefetchDepth=1,verbose=True):
+    '''
+    variance_normalize_timeseries.variance_normalize for several runs, with the next run loaded while the current run is
+    normalized, and outputs written in the background. Inputs are lists (1 entry per run) of the same inputs as
+    variance_normalize; savePathList can also be a single string (shared by all runs).
+    '''
+    if isinstance(savePathList,str):
+        savePathList = [savePathList]*len(timeseriesFileList)
+    runList = list(zip(timeseriesFileList,savePathList,saveFileList))
+
+    return run_prefetched(runList,
+                          loadFunc=lambda runHere: vnts.load_timeseries(runHere[0],precision=precision),
+                          computeFunc=lambda runHere,loadedHere: vnts.normalize_timeseries(*loadedHere),
+                          saveFunc=lambda runHere,resultHere: vnts.save_normalized(resultHere,runHere[1],runHere[2]),
+                          prefetchDepth=prefetchDepth,
+                          verbose=verbose)
+
+def gsr_from_surface_runs(subjID,functionalRunStrList,globalMaskFileList,timeSeriesSurfaceFileList,timeSeriesVolumeFileList,
+                          outputSavePath,prefetchDepth=1,verbose=True,**gsrKwargs):
+    '''
+    gsr_from_surface.gsr_from_surface for several runs, with the next run's volume and surface data loaded while the
+    current run is regressed, and outputs written in the background (gsr_from_surface.save_gsr_outputs). Inputs are lists
+    (1 entry per run) of the same inputs as gsr_from_surface; other keyword arguments (extraSaveStr, useDerivatives,
+    saveCifti, precision) are passed on.
+    '''
+    import gsr_from_surface as gsr # see gsr_from_surface.py
+    precision = gsrKwargs.get('precision','float64')
+    extraSaveStr = gsrKwargs.get('extraSaveStr','')
+    saveCifti = gsrKwargs.get('saveCifti',False)
+    runList = list(zip(functionalRunStrList,globalMaskFileList,timeSeriesSurfaceFileList,timeSeriesVolumeFileList))
+
+    return run_prefetched(runList,
+                          loadFunc=lambda runHere: gsr.load_gsr_inputs(runHere[1],runHere[2],runHere[3],precision=precision),
+                          computeFunc=lambda runHere,loadedHere: gsr.gsr_from_surface(subjID,runHere[0],runHere[1],runHere[2],runHere[3],outputSavePath,
+                                                                                       loadedInputs=loadedHere,saveOutput=False,verbose=verbose,**gsrKwargs),
+                          saveFunc=lambda runHere,resultHere: gsr.save_gsr_outputs(resultHere,runHere[0],runHere[2],outputSavePath,extraSaveStr=extraSaveStr,
+                                                                                   saveCifti=saveCifti,verbose=verbose),
+                          prefetchDepth=prefetchDepth,
+                          verbose=verbose)
+
+def acompcor_denoising_runs(subjID,functionalRunStrList,wmMaskFileList,csfMaskFileList,timeSeriesVolumeFileList,outputSavePath,
+                            timeSeriesSurfaceFileList=None,brainMaskFileList=None,movementFileList=None,prefetchDepth=1,verbose=True,
+                            **acompcorKwargs):
+    '''
+    acompcor_denoising.acompcor_denoising for several runs, with the next run's mask voxel timeseries extracted (the
+    pass over the .nii.gz) while the current run is denoised. Outputs are written by acompcor_denoising itself (the
+    volume is streamed out in TR chunks, from a 2nd read of the input), so there is no background writer here. Inputs
+    are lists (1 entry per run) of the same inputs as acompcor_denoising; other keyword arguments (motionModel,
+    useSpikeRegressors, fdThreshold, numComponents, extraSaveStr, chunkSize, precision, cacheDir) are passed on.
+    '''
+    import acompcor_denoising as acc # see acompcor_denoising.py
+    numRuns = len(functionalRunStrList)
+    if timeSeriesSurfaceFileList is None:
+        timeSeriesSurfaceFileList = [None]*numRuns
+    if brainMaskFileList is None:
+        brainMaskFileList = [None]*numRuns
+    if movementFileList is None:
+        movementFileList = [None]*numRuns
+    chunkSize = acompcorKwargs.get('chunkSize',100)
+    precision = acompcorKwargs.get('precision','float64')
+    cacheDir = acompcorKwargs.get('cacheDir',None)
+    runList = list(zip(functionalRunStrList,wmMaskFileList,csfMaskFileList,timeSeriesVolumeFileList,timeSeriesSurfaceFileList,
+                       brainMaskFileList,movementFileList))
+
+    return run_prefetched(runList,
+                          loadFunc=lambda runHere: acc.load_acompcor_inputs(runHere[1],runHere[2],runHere[3],brainMaskFile=runHere[5],
+                                                                            chunkSize=chunkSize,precision=precision,cacheDir=cacheDir),
+                          computeFunc=lambda runHere,loadedHere: acc.acompcor_denoising(subjID,runHere[0],runHere[1],runHere[2],runHere[3],outputSavePath,
+                                                                                         timeSeriesSurfaceFile=runHere[4],brainMaskFile=runHere[5],
+                                                                                         movementFile=runHere[6],loadedInputs=loadedHere,verbose=verbose,
+                                                                                         **acompcorKwargs),
+                          prefetchDepth=prefetchDepth,
+                          verbose=verbose)
@@ -0,0 +1,62 @@
+# C. Cocuzza, 2023. Tests for fc_aggregation.py: concatenated-run FC (all concatModes) vs. np.corrcoef on concatenated
+# data, with unequal run lengths. Run with: python -m pytest -q test_fc_aggregation.py
+
+################################################
+# IMPORTS
+import numpy as np
+import pytest
+import fc_aggregation # see fc_aggregation.py
+
+runLengths = [100,300,60]
+numNodes = 20
+
+def make_runs(seed=0):
+    '''Runs (nodes x TRs) with different means, scales, and lengths, sharing a common signal.'''
+    rng = np.random.default_rng(seed)
+    runList = []
+    for numFrames in runLengths:
+        sharedSignal = rng.standard_normal(numFrames)
+        dataHere = rng.standard_normal((numNodes,numFrames)) + rng.uniform(0,1,(numNodes,1))*sharedSignal[None,:]
+        runList.append(dataHere*rng.uniform(0.5,3,(numNodes,1)) + rng.uniform(-50,50,(numNodes,1)))
+    return runList
+
+def concatenate_runs(runList,concatMode):
+    '''Concatenates runs as each concatMode describes (see notes at top of fc_aggregation.py).'''
+    if concatMode=='demean':
+        runList = [dataHere - np.mean(dataHere,axis=1,keepdims=True) for dataHere in runList]
+    elif concatMode=='zscore':
+        runList = [(dataHere - np.mean(dataHere,axis=1,keepdims=True)) / np.std(dataHere,axis=1,keepdims=True) for dataHere in runList]
+    return np.concatenate(runList,axis=1)
+
+@pytest.mark.parametrize('concatMode',fc_aggregation.concatModes)
+@pytest.mark.parametrize('useStore',[False,True])
+def test_concatenated_fc(concatMode,useStore,tmp_path):
+    runList = make_runs()
+    fcAccum = fc_aggregation.FCAccumulator(numNodes,storeDir=str(tmp_path) if useStore else None,blockSize=7)
+    for runIx,dataHere in enumerate(runList):
+        fcAccum.add_run(dataHere,'run' + str(runIx))
+
+    fcHere = np.array(fcAccum.concatenated_fc(concatMode=concatMode,fillDiagVal=1))
+    fcExpected = np.corrcoef(concatenate_runs(runList,concatMode))
+    # 'zscore' is accumulated in float32 (see disk footprint notes at top of fc_aggregation.py)
+    np.testing.assert_allclose(fcHere,fcExpected,atol=1e-6 if concatMode=='zscore' else 1e-10)
+
+def test_run_fc(tmp_path):
+    runList = make_runs()
+    fcAccum = fc_aggregation.FCAccumulator(numNodes,keepRunCross=True)
+    for runIx,dataHere in enumerate(runList):
+        runFCFile = str(tmp_path / ('run' + str(runIx) + '.npy'))
+        fcAccum.add_run(dataHere,'run' + str(runIx),runFCFile=runFCFile,fillDiagVal=1)
+        np.testing.assert_allclose(np.load(runFCFile),np.corrcoef(dataHere),atol=1e-6) # float32 output
+    for runIx,dataHere in enumerate(runList):
+        np.testing.assert_allclose(np.array(fcAccum.run_fc('run' + str(runIx),fillDiagVal=1)),np.corrcoef(dataHere),atol=1e-6)
+
+def test_load_and_add_run(tmp_path):
+    runList = make_runs()
+    fcAccum = fc_aggregation.FCAccumulator(numNodes,storeDir=str(tmp_path))
+    fcAccum.add_run(runList[0],'run0')
+    fcAccum = fc_aggregation.FCAccumulator.load(str(tmp_path))
+    for runIx,dataHere in enumerate(runList[1:]):
+        fcAccum.add_run(dataHere,'run' + str(runIx+1))
+    fcHere = np.array(fcAccum.concatenated_fc(concatMode='demean',fillDiagVal=1))
+    np.testing.assert_allclose(fcHere,np.corrcoef(concatenate_runs(runList,'demean')),atol=1e-10)
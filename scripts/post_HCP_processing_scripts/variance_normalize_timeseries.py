@@ -3,27 +3,41 @@
 import os
 import numpy as np
 import nibabel as nib
+import precision_utils # see precision_utils.py
 
 
-def variance_normalize(timeseriesFile,savePath,saveFile):
+def variance_normalize(timeseriesFile,savePath,saveFile,precision='float64'):
     '''
     timeseriesFile: entire path with filename; either .nii.gz (4D) or .dtseries.nii (2D)
     savePath:       entire path to save (make sure to close with /) 
     saveFile:       file name to save, use extra string like "_vn" if need be 
-    '''
+    precision:      'float64' (default) or 'float32'; load/compute/save precision (mean & std always accumulated in float64)
     
-    dataHere = nib.load(timeseriesFile).get_fdata().copy()
+    NOTE: split into load_timeseries / normalize_timeseries / save_normalized so that run_scheduler.py can load the 
+    next run and write the previous run while the current one is normalized (see run_scheduler.variance_normalize_runs).
+    '''
+    dataHereAff,dataHere = load_timeseries(timeseriesFile,precision=precision)
+    resultHere = normalize_timeseries(dataHereAff,dataHere)
+    save_normalized(resultHere,savePath,saveFile)
+
+
+def load_timeseries(timeseriesFile,precision='float64'):
+    dataHereAff = nib.load(timeseriesFile)
+    dataHere = dataHereAff.get_fdata(dtype=precision_utils.get_dtype(precision))
+    return dataHereAff,dataHere
+
+
+def normalize_timeseries(dataHereAff,dataHere):
+    '''Returns (variance normalized data, affine or None, number of dimensions); None data if not 2D or 4D.'''
     nDims = dataHere.ndim
     
     if nDims==4:
-        dataHereVN = (dataHere - np.nanmean(dataHere,axis=3)[:,:,:,None]) / np.nanstd(dataHere,axis=3)[:,:,:,None]
-        dataHereAff = nib.load(timeseriesFile)
-        dataHereNII = nib.Nifti1Image(dataHereVN, dataHereAff.affine)
-        nib.save(dataHereNII, savePath + saveFile + '.nii.gz')
-        #np.save(savePath + saveFile + '.npy',dataHereVN)
+        dataHereVN = precision_utils.variance_normalize(dataHere,axis=3)
+        return dataHereVN,dataHereAff.affine,nDims
         
     elif nDims==3: 
         print(f"Timeseries file has 3 dimensions, expected either 4D volumetric or 2D surface, please check and re-run")
+        return None,None,nDims
         
     elif nDims==2: 
         nRows,nCols = dataHere.shape
@@ -32,5 +46,15 @@ def variance_normalize(timeseriesFile,savePath,saveFile):
             print(f"Original timeseries file has {nRows} x {nCols} dimensions. "+
                   f"Expected dimensions is vertices x TRs, where vertices are likely > TRs, "+
                   f"so transposing to be {nCols} x {nRows} dimensions, but please correct and rerun if need be")
-        dataHereVN = (dataHere - np.nanmean(dataHere,axis=1)[:,None]) / np.nanstd(dataHere,axis=1)[:,None]
-        np.save(savePath + saveFile + '.npy',dataHereVN)
\ No newline at end of file
+        dataHereVN = precision_utils.variance_normalize(dataHere,axis=1)
+        return dataHereVN,None,nDims
+
+
+def save_normalized(resultHere,savePath,saveFile):
+    dataHereVN,affineHere,nDims = resultHere
+    if nDims==4:
+        dataHereNII = nib.Nifti1Image(dataHereVN, affineHere)
+        nib.save(dataHereNII, savePath + saveFile + '.nii.gz')
+        #np.save(savePath + saveFile + '.npy',dataHereVN)
+    elif nDims==2:
+        np.save(savePath + saveFile + '.npy',dataHereVN)